@@ -17,8 +17,10 @@ import pandas as pd
 
 from config import raw_data_path
 from core.backtest import step6_simulate_performance
+from core.equity import get_sim_dtype
 from core.model.backtest_config import MultiEquityBacktestConfig
 from core.utils.log_kit import logger, divider
+from core.utils.pivot_store import load_pivot_data
 from core.version import version_prompt
 
 # ====================================================================================================
@@ -84,8 +86,8 @@ if __name__ == '__main__':
     # ====================================================================================================
     divider('模拟交易', sep='-')
     conf = me_conf.factory.generate_all_factor_config()
-    pivot_dict_spot = pd.read_pickle(raw_data_path / 'market_pivot_spot.pkl')
-    pivot_dict_swap = pd.read_pickle(raw_data_path / 'market_pivot_swap.pkl')
+    pivot_dict_spot = load_pivot_data(raw_data_path, 'spot', get_sim_dtype())
+    pivot_dict_swap = load_pivot_data(raw_data_path, 'swap', get_sim_dtype())
 
     # 读入子策略的资金曲线，传入给模拟交易，最后绘图的时候会用
     extra_equities = {}
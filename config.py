@@ -219,6 +219,19 @@ data_source_dict = {
 # ====================================================================================================
 job_num = 6  # 回测并行数量
 # job_num = 2  # 回测并行数量
+factor_job_mode = 'thread'  # 时序因子计算的并行方式，配合 job_num 使用
+# - thread: 多线程（默认），适合因子缓存命中率高、或者 pandas/numba 计算为主的情况
+# - process: 多进程，K线数据放入共享内存，子进程零拷贝读取，适合大量纯 python 计算的自定义因子（不受 GIL 限制）
+select_rank_mode = 'topk'  # 选币排名方式，只对配置因子的策略（use_custom_func=False）生效
+# - topk: 每个周期只对排名靠前、需要选中的币种排序（默认），并列的排名和 method='min' 一致，选币结果和完整排名相同
+# - full: 每个周期对所有币种完整排名
+sim_precision = 'float64'  # 模拟交易中价格、资金占比的精度，账户权益始终使用 float64 累加
+# - float64: 双精度（默认）
+# - float32: 单精度，行情数据的内存映射存储、传入模拟器的价格和资金占比都减半，适合内存紧张、大量参数遍历的情况
+#   和 float64 的资金曲线偏差可以用 tools/tool2_模拟精度验证.py 检查
+save_trade_ledger = False  # 是否保存模拟交易的成交明细
+# - True: 每笔成交记录 (时间, 币种, 市场, 调仓手数, 成交价, 手续费)，保存为回测结果文件夹中的 成交明细.parquet，方便做逐笔归因
+# - False: 不记录（默认）
 
 # ==== factor_col_limit 介绍 ====
 factor_col_limit = 128  # [优化] 针对 M4 24GB 内存，提升单次计算因子列数 (基准: 64 -> 128)
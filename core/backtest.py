@@ -10,13 +10,19 @@
 Author: 邢不行
 """
 import logging
+import math
+import multiprocessing
 import shutil
+import sys
 import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numba as nb
 import pandas as pd
 
 from config import job_num, raw_data_path, backtest_path
-from core.equity import calc_equity, show_plot_performance
+from core.equity import calc_equity, calc_equity_batch, get_batch_params, get_sim_dtype, show_plot_performance
 from core.model.backtest_config import BacktestConfig
 from core.model.backtest_config import BacktestConfigFactory
 from core.model.timing_signal import TimingSignal
@@ -24,6 +30,8 @@ from core.select_coin import calc_factors, select_coins, concat_select_results,
     agg_multi_strategy_ratio, calc_cross_sections
 from core.utils.functions import load_spot_and_swap_data, save_performance_df_csv
 from core.utils.log_kit import logger, divider
+from core.utils.pivot_store import load_pivot_data
+from core.utils.sparse_ratio import RatioCoords
 
 
 def step2_load_data(conf: BacktestConfig):
@@ -73,11 +81,11 @@ def step4_select_coins(conf: BacktestConfig):
     logger.ok(f'完成选币，花费时间：{time.time() - s_time:.3f}秒')
 
 
-def step5_aggregate_select_results(conf: BacktestConfig, save_final_result=False):
+def step5_aggregate_select_results(conf: BacktestConfig, save_final_result=False, coords: RatioCoords = None):
     logger.info(f'整理{conf.name}选币结果...')
     # 整理选币结果
-    concat_select_results(conf)  # 合并多个策略的选币结果
-    select_results = process_select_results(conf)  # 生成整理后的选币结果
+    select_results = concat_select_results(conf)  # 合并多个策略的选币结果，直接在内存中传递
+    select_results = process_select_results(conf, select_results)  # 生成整理后的选币结果
     logger.debug(f'💾 {conf.name}选币结果df大小：'
                  f'{select_results.memory_usage(deep=True).sum() / 1024 / 1024 / 1024:.4f} G')
     if save_final_result:
@@ -87,7 +95,7 @@ def step5_aggregate_select_results(conf: BacktestConfig, save_final_result=False
     # 聚合大杂烩中多策略的权重，以及多offset选币的权重聚合
     s_time = time.time()
     logger.debug(f'🔃 开始{conf.name}权重聚合...')
-    df_spot_ratio, df_swap_ratio = agg_multi_strategy_ratio(conf, select_results)
+    df_spot_ratio, df_swap_ratio = agg_multi_strategy_ratio(conf, select_results, coords)
 
     # 始终输出ratios
     df_spot_ratio.to_pickle(conf.get_result_folder() / 'df_spot_ratio.pkl')
@@ -128,6 +136,46 @@ def step6_simulate_performance(conf: BacktestConfig, df_spot_ratio, df_swap_rati
     return conf.report
 
 
+def step6_simulate_performance_batch(conf_list, ratio_list, pivot_dict_spot, pivot_dict_swap):
+    """
+    批量模拟交易：多组目标资金占比共用同一份行情数据，一次并行模拟，主要用于参数遍历
+    :param conf_list: 每一组的回测配置
+    :param ratio_list: 每一组的 (现货目标资金占比, 永续合约目标资金占比)
+    :param pivot_dict_spot: 现货行情数据
+    :param pivot_dict_swap: 永续合约行情数据
+    :return: 每一组的回测报告
+    """
+    logger.info(f'批量模拟交易，共{len(conf_list)}组...')
+    # 时间索引、交易参数都相同的才能放在同一批里面模拟
+    groups = {}
+    for idx, (df_spot_ratio, _) in enumerate(ratio_list):
+        key = (len(df_spot_ratio), df_spot_ratio.index[0], df_spot_ratio.index[-1]) if len(df_spot_ratio) else ()
+        groups.setdefault((key, get_batch_params(conf_list[idx])), []).append(idx)
+
+    results = [None] * len(conf_list)
+    for idx_list in groups.values():
+        group_results = calc_equity_batch([conf_list[idx] for idx in idx_list], pivot_dict_spot, pivot_dict_swap,
+                                          [ratio_list[idx] for idx in idx_list])
+        for idx, result in zip(idx_list, group_results):
+            results[idx] = result
+
+    report_list = []
+    for conf, (df_spot_ratio, df_swap_ratio), result in zip(conf_list, ratio_list, results):
+        account_df, rtn, year_return, month_return, quarter_return = result
+        save_performance_df_csv(conf,
+                                资金曲线=account_df,
+                                策略评价=rtn,
+                                年度账户收益=year_return,
+                                季度账户收益=quarter_return,
+                                月度账户收益=month_return)
+        # 再择时依赖各自的资金曲线生成动态杠杆，仍然逐个模拟
+        if isinstance(conf.timing, TimingSignal):
+            simu_timing(conf, df_spot_ratio, df_swap_ratio, pivot_dict_spot, pivot_dict_swap)
+        report_list.append(conf.report)
+
+    return report_list
+
+
 def simu_timing(conf: BacktestConfig, df_spot_ratio, df_swap_ratio, pivot_dict_spot, pivot_dict_swap):
     s_time = time.time()
     logger.info(f'{conf.get_fullname(as_folder_name=True)} 资金曲线择时，生成动态杠杆')
@@ -162,42 +210,36 @@ def simu_timing(conf: BacktestConfig, df_spot_ratio, df_swap_ratio, pivot_dict_s
     return account_df, rtn, year_return
 
 
-def load_pivot_data(base_path, market_type):
-    """从 Parquet 加载 Pivot 数据 (V2 优化)"""
-    res = {}
-    prefix = f'market_pivot_{market_type}'
-    import polars as pl
-    for pq_file in base_path.glob(f"{prefix}_*.parquet"):
-        key = pq_file.stem.replace(f"{prefix}_", "")
-        # V2 修正: 使用 Polars 加载后再转 Pandas，并恢复 DatetimeIndex
-        df = pl.read_parquet(pq_file).to_pandas()
-        if 'candle_begin_time' in df.columns:
-            df['candle_begin_time'] = pd.to_datetime(df['candle_begin_time'])
-            df.set_index('candle_begin_time', inplace=True)
-        res[key] = df
-    return res
+def select_and_aggregate(conf: BacktestConfig, factor_df=None, coords: RatioCoords = None):
+    """
+    选币并立刻聚合成目标资金占比，选币结果不再保留在内存中
+    :param conf: 回测配置
+    :param factor_df: 所有配置共用的因子数据
+    :param coords: 所有配置共用的 (时间, 币种) 坐标系
+    :return: (df_spot_ratio, df_swap_ratio)
+    """
+    select_coins(conf, True, factor_df)
+    return step5_aggregate_select_results(conf, coords=coords)
 
 
-def simu_performance_on_select(conf: BacktestConfig, silent=True, pivot_dict_spot=None, pivot_dict_swap=None):
+def simu_performance_on_select(conf: BacktestConfig, silent=True, pivot_dict_spot=None, pivot_dict_swap=None,
+                               coords: RatioCoords = None, ratio_pair=None):
     import logging
     if silent:
         logger.setLevel(logging.WARNING)  # 可以减少中间输出的log
     # ====================================================================================================
     # 5. 整理大杂烩选币结果
-    # - 把大杂烩中每一个策略的选币结果聚合成一个df
+    # - 把大杂烩中每一个策略的选币结果聚合成一个df，已经聚合过的（ratio_pair）直接使用
     # ====================================================================================================
-    df_spot_ratio, df_swap_ratio = step5_aggregate_select_results(conf)
+    if ratio_pair is None:
+        ratio_pair = step5_aggregate_select_results(conf, coords=coords)
+    df_spot_ratio, df_swap_ratio = ratio_pair
 
     # V2 优化: 优先使用传入的 Pivot 数据，减少磁盘 I/O
     if pivot_dict_spot is None:
-        pivot_dict_spot = load_pivot_data(raw_data_path, 'spot')
-        if not pivot_dict_spot:
-            pivot_dict_spot = pd.read_pickle(raw_data_path / 'market_pivot_spot.pkl')
-    
+        pivot_dict_spot = load_pivot_data(raw_data_path, 'spot', get_sim_dtype())
     if pivot_dict_swap is None:
-        pivot_dict_swap = load_pivot_data(raw_data_path, 'swap')
-        if not pivot_dict_swap:
-            pivot_dict_swap = pd.read_pickle(raw_data_path / 'market_pivot_swap.pkl')
+        pivot_dict_swap = load_pivot_data(raw_data_path, 'swap', get_sim_dtype())
 
     res = step6_simulate_performance(conf, df_spot_ratio, df_swap_ratio, pivot_dict_spot, pivot_dict_swap)
     logger.setLevel(logging.DEBUG)  # 中间结果恢复一下
@@ -254,13 +296,8 @@ def run_backtest(conf: BacktestConfig):
     # ====================================================================================================
     # 6. 根据目标持仓计算资金曲线
     # ====================================================================================================
-    pivot_dict_spot = load_pivot_data(raw_data_path, 'spot')
-    if not pivot_dict_spot:
-        pivot_dict_spot = pd.read_pickle(raw_data_path / 'market_pivot_spot.pkl')
-        
-    pivot_dict_swap = load_pivot_data(raw_data_path, 'swap')
-    if not pivot_dict_swap:
-        pivot_dict_swap = pd.read_pickle(raw_data_path / 'market_pivot_swap.pkl')
+    pivot_dict_spot = load_pivot_data(raw_data_path, 'spot', get_sim_dtype())
+    pivot_dict_swap = load_pivot_data(raw_data_path, 'swap', get_sim_dtype())
 
     step6_simulate_performance(conf, df_spot_ratio, df_swap_ratio, pivot_dict_spot, pivot_dict_swap, if_show_plot=True)
     logger.ok(f'完成，回测时间：{time.time() - r_time:.3f}秒')
@@ -325,7 +362,7 @@ def run_backtest_multi(factory: BacktestConfigFactory):
     # 在这里一次性把所有 shard 和截面因子的 Parquet 全加载进来并 Join 好
     # 这样子策略在选币时就不需要再做任何硬盘 IO 或 Join，速度将提升一个数量级
     logger.debug("💿 正在构建全局 Master Factor 数据集 (Zero-Wait Selection)...")
-    from core.select_coin import ALL_KLINE_PATH_TUPLE
+    from core.select_coin import ALL_KLINE_PATH_TUPLE, build_selection_master
     from core.utils.path_kit import get_file_path
     import polars as pl
     
@@ -351,52 +388,63 @@ def run_backtest_multi(factory: BacktestConfigFactory):
                 master_pl = master_pl.join(f_df.select(['candle_begin_time', 'symbol', 'is_spot'] + cols), 
                                          on=['candle_begin_time', 'symbol', 'is_spot'], how='left')
         
-        # 最终转回 Pandas 交付给选币引擎
-        master_shared_df = master_pl.to_pandas()
+        # 直接以 Polars 交付给选币引擎，只排序、索引一次，所有配置、所有子策略共用
+        master_shared_df = build_selection_master(master_pl)
         del master_pl
+        # 统计所有子策略用到的截面排名，相同选币范围、相同排名方式的只计算一次
+        master_shared_df.prepare_rank_cache([stg for conf in factory.config_list for stg in conf.strategy_list])
     else:
         master_shared_df = None
 
+    # V2 优化: 预先加载并按时间对齐 Pivot 数据 (L3 级共享内存优化)
+    logger.debug("💿 正在初始化预对齐 Pivot 模拟数据 (Time-Aligned)...")
+    p_s_time = time.time()
+
+    raw_pivot_spot = load_pivot_data(raw_data_path, 'spot', get_sim_dtype())
+    raw_pivot_swap = load_pivot_data(raw_data_path, 'swap', get_sim_dtype())
+
+    # 所有配置的回测时间范围一致时，预先按时间裁切，这样子策略模拟只需要按币种 (columns) 裁切，速度极快，
+    # 并且共用同一个 (时间, 币种) 坐标系，选币结果直接转换成整数坐标聚合。
+    # 时间范围不一致时，每个配置按照自己的时间范围模拟
+    global_pivot_spot, global_pivot_swap, ratio_coords = raw_pivot_spot, raw_pivot_swap, None
+    if len({(conf.start_date, conf.end_date) for conf in conf_list}) == 1:
+        test_start = pd.to_datetime(conf_list[0].start_date)
+        test_end = pd.to_datetime(conf_list[0].end_date)
+        global_pivot_spot = {k: df.loc[test_start:test_end] for k, df in raw_pivot_spot.items()}
+        global_pivot_swap = {k: df.loc[test_start:test_end] for k, df in raw_pivot_swap.items()}
+        ratio_coords = RatioCoords.from_range(
+            conf_list[0].start_date, conf_list[0].end_date,
+            [symbol for pivot in (global_pivot_spot, global_pivot_swap) if pivot for symbol in pivot['close'].columns])
+    logger.debug(f"✅ 全对齐 Pivot 数据准备完成，耗时: {time.time() - p_s_time:.2f}s")
+
     # [V2 - L4 优化] 并行化多策略选币
+    # 每个配置选币完成之后立刻聚合成稀疏的目标资金占比，选币结果随即释放，
+    # 内存中只保留每个配置的 SparseRatio，不会随配置数量线性增长
+    ratio_list = [None] * len(conf_list)
     from concurrent.futures import ThreadPoolExecutor, as_completed
-    with ThreadPoolExecutor(max_workers=min(len(factory.config_list), job_num)) as executor:
-        f_list = [executor.submit(select_coins, conf, True, master_shared_df) for conf in factory.config_list]
-        for _ in as_completed(f_list):
-            pass
+    with ThreadPoolExecutor(max_workers=min(len(conf_list), job_num)) as executor:
+        future_to_idx = {executor.submit(select_and_aggregate, conf, master_shared_df, ratio_coords): i
+                         for i, conf in enumerate(conf_list)}
+        for future in as_completed(future_to_idx):
+            ratio_list[future_to_idx[future]] = future.result()
+    del master_shared_df
 
     logger.ok(f'完成选币，花费时间：{time.time() - s_time:.3f}秒，累计时间：{(time.time() - r_time):.3f}秒')
 
     # ====================================================================================================
-    # 5. 针对选币结果进行聚合
+    # 5. 子策略模拟
     # ====================================================================================================
     divider('子策略模拟', sep='-')
     logger.setLevel(logging.DEBUG)
     logger.debug(f'注意：主要和选币数量有关...')
     s_time = time.time()
-    
-    # V2 优化: 预先加载并按时间对齐 Pivot 数据 (L3 级共享内存优化)
-    logger.debug("💿 正在初始化预对齐 Pivot 模拟数据 (Time-Aligned)...")
-    p_s_time = time.time()
-    
-    # 确定回测的时间范围，用于预先裁切 Pivot 数据
-    # 我们以第一个 config 的时间范围为准（假设多策略回测时间范围一致）
-    test_start = pd.to_datetime(conf_list[0].start_date)
-    test_end = pd.to_datetime(conf_list[0].end_date)
-    
-    raw_pivot_spot = load_pivot_data(raw_data_path, 'spot')
-    raw_pivot_swap = load_pivot_data(raw_data_path, 'swap')
-    
-    # 预先按时间裁切，这样子策略模拟只需要按币种 (columns) 裁切，速度极快
-    global_pivot_spot = {k: df.loc[test_start:test_end] for k, df in raw_pivot_spot.items()}
-    global_pivot_swap = {k: df.loc[test_start:test_end] for k, df in raw_pivot_swap.items()}
-    
-    logger.debug(f"✅ 全对齐 Pivot 数据准备完成，耗时: {time.time() - p_s_time:.2f}s")
 
     # [V2 - L4 优化] 并行化多策略模拟 (保持顺序)
     report_list = [None] * len(conf_list)
     with ThreadPoolExecutor(max_workers=min(len(conf_list), job_num)) as executor:
         future_to_idx = {
-            executor.submit(simu_performance_on_select, conf, False, global_pivot_spot, global_pivot_swap): i 
+            executor.submit(simu_performance_on_select, conf, False, global_pivot_spot, global_pivot_swap,
+                            ratio_pair=ratio_list[i]): i
             for i, conf in enumerate(conf_list)
         }
         for future in as_completed(future_to_idx):
@@ -409,3 +457,93 @@ def run_backtest_multi(factory: BacktestConfigFactory):
     logger.ok(f'--- 总体回测结束，总计耗时：{total_duration:.2f}s ---')
     
     return report_list
+
+
+# ====================================================================================================
+# ** 仓位管理参数遍历 **
+# 计算仓位比例 -> 聚合选币结果 -> 模拟交易，多进程并行
+# ====================================================================================================
+# 子进程中的遍历上下文，由 init_pos_search_worker 初始化
+_search_me_conf_list: list | None = None
+_search_pivot_dicts: tuple | None = None
+
+
+def init_pos_search_worker(me_conf_list, single_thread=False):
+    """
+    仓位管理参数遍历的子进程初始化
+    :param me_conf_list: 所有的仓位管理配置，共用同一份子策略资金曲线（equity_dfs）和选币仓位（ratio_dfs），
+                         为空时表示 fork 的子进程已经继承了父进程初始化好的数据
+    :param single_thread: 是否限制 numba 只使用一个线程，多进程的时候进程之间已经并行
+    """
+    global _search_me_conf_list, _search_pivot_dicts
+    if single_thread:
+        nb.set_num_threads(1)
+    if me_conf_list is None:
+        return
+    _search_me_conf_list = me_conf_list
+    # 行情数据是内存映射存储，所有进程共享同一份 page cache
+    _search_pivot_dicts = (load_pivot_data(raw_data_path, 'spot', get_sim_dtype()),
+                           load_pivot_data(raw_data_path, 'swap', get_sim_dtype()))
+
+
+def simu_pos_search_batch(idx_list) -> list:
+    """
+    计算一批仓位管理配置的回测报告，这一批共用行情数据批量模拟
+    :param idx_list: 仓位管理配置的序号
+    :return: 每个配置的回测报告
+    """
+    conf_list, ratio_list = [], []
+    for idx in idx_list:
+        me_conf_i = _search_me_conf_list[idx]
+        # 仓位管理策略接入，计算每一个时间周期中，子策略应该持仓的资金比例
+        pos_ratio = me_conf_i.calc_ratios()
+        # 根据子策略的资金比例，重新聚合成一个选币结果，及对应周期内币种的资金分配
+        df_spot_ratio, df_swap_ratio = me_conf_i.agg_pos_ratio(pos_ratio)
+
+        conf_all = me_conf_i.factory.generate_all_factor_config()
+        conf_all.name = me_conf_i.factory.backtest_name
+        # 用于参数遍历场景，每组参数的回测结果保存在各自的文件夹：backtest_name/backtest_name_参数N
+        conf_all.is_param_search = True
+        conf_list.append(conf_all)
+        ratio_list.append((df_spot_ratio, df_swap_ratio))
+
+    return step6_simulate_performance_batch(conf_list, ratio_list, *_search_pivot_dicts)
+
+
+def run_pos_search(me_conf_list, n_jobs=job_num, batch_size=32):
+    """
+    并行执行仓位管理参数遍历，按照完成的顺序逐批返回回测报告
+    :param me_conf_list: 仓位管理配置列表，需要已经完成 process_equities
+    :param n_jobs: 并行的进程数，1 表示在当前进程中串行执行
+    :param batch_size: 每个子进程一次处理的配置数量上限，同一批共用行情数据批量模拟
+    :return: 生成器，每次返回 (配置序号, 回测报告)
+    """
+    # 每组参数按照 backtest_name 保存资金曲线等结果，多个进程同时写同一个文件夹会互相覆盖
+    name_counts = Counter(me_conf_i.factory.backtest_name for me_conf_i in me_conf_list)
+    duplicated = sorted(name for name, count in name_counts.items() if count > 1)
+    if duplicated:
+        raise ValueError(f'参数遍历的回测名称重复，结果会保存到同一个文件夹：{duplicated}')
+
+    n = len(me_conf_list)
+    n_jobs = max(1, min(n_jobs, n))
+    chunk_size = max(1, min(batch_size, math.ceil(n / n_jobs)))
+    idx_chunks = [list(range(start, min(start + chunk_size, n))) for start in range(0, n, chunk_size)]
+
+    if n_jobs == 1:
+        init_pos_search_worker(me_conf_list)
+        for idx_list in idx_chunks:
+            yield from zip(idx_list, simu_pos_search_batch(idx_list))
+        return
+
+    if 'fork' in multiprocessing.get_all_start_methods() and sys.platform != 'darwin':
+        # fork 的子进程直接继承父进程中已经处理好的 equity_dfs / ratio_dfs 和行情数据，不需要序列化，也不需要重新读取
+        init_pos_search_worker(me_conf_list)
+        mp_context, initargs = multiprocessing.get_context('fork'), (None, True)
+    else:
+        # spawn / forkserver 的子进程不继承父进程的内存：所有配置会序列化传给每一个子进程，行情数据在子进程中重新读取
+        mp_context, initargs = None, (me_conf_list, True)
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context, initializer=init_pos_search_worker,
+                             initargs=initargs) as executor:
+        future_to_idx = {executor.submit(simu_pos_search_batch, idx_list): idx_list for idx_list in idx_chunks}
+        for future in as_completed(future_to_idx):
+            yield from zip(future_to_idx[future], future.result())
@@ -11,55 +11,529 @@ Author: 邢不行
 """
 import time
 from datetime import datetime
+from itertools import product
+from typing import List
 
 import numba as nb
 import numpy as np
 import pandas as pd
+import polars as pl
 
+import config
 from config import swap_path
 from core.evaluate import strategy_evaluate
 from core.figure import draw_equity_curve_plotly
 from core.model.backtest_config import BacktestConfig
-from core.simulator import Simulator
+from core.model.sim_checkpoint import MarketState, SimCheckpoint
+from core.simulator import MARKET_SPOT, MARKET_SWAP, Simulator, TradeLedger
 from core.utils.functions import load_min_qty
 from core.utils.log_kit import logger
+from core.utils.sparse_ratio import SparseRatio
 from update_min_qty import min_qty_path
 
 pd.set_option('display.max_rows', 1000)
 pd.set_option('expand_frame_repr', False)  # 当列太多时不换行
 
+# 模拟交易中价格、资金占比的精度，账户权益始终使用 float64 累加
+sim_precision = getattr(config, 'sim_precision', 'float64')
+SIM_DTYPES = {'float64': np.float64, 'float32': np.float32}
+# 是否保存模拟交易的成交明细
+save_trade_ledger = getattr(config, 'save_trade_ledger', False)
+
+# 敏感性分析支持的交易参数，名称和 BacktestConfig 的属性一致
+SENSITIVITY_PARAMS = ['spot_c_rate', 'swap_c_rate', 'leverage', 'margin_rate', 'spot_min_order_limit',
+                      'swap_min_order_limit']
+
+# 批量模拟交易时所有账户共用的参数（行情数据、手续费、最小下单金额、调仓模式），名称和 BacktestConfig 的属性一致
+BATCH_SHARED_PARAMS = ['start_date', 'end_date', 'is_day_period', 'spot_c_rate', 'swap_c_rate', 'margin_rate',
+                       'spot_min_order_limit', 'swap_min_order_limit', 'rebalance_mode']
+
+
+def get_sim_dtype(precision=None):
+    """
+    模拟交易中价格、资金占比的数据类型
+    :param precision: float64 或者 float32，默认使用 config 中的 sim_precision
+    """
+    precision = precision or sim_precision
+    if precision not in SIM_DTYPES:
+        raise ValueError(f'sim_precision 只支持 {list(SIM_DTYPES)}，当前为 {precision}')
+    return SIM_DTYPES[precision]
+
 
 def calc_equity(conf: BacktestConfig,
                 pivot_dict_spot: dict,
                 pivot_dict_swap: dict,
-                df_spot_ratio: pd.DataFrame,
-                df_swap_ratio: pd.DataFrame,
-                leverage: float | pd.Series = None):
+                df_spot_ratio: SparseRatio | pd.DataFrame,
+                df_swap_ratio: SparseRatio | pd.DataFrame,
+                leverage: float | pd.Series = None,
+                precision: str = None):
     """
     计算回测结果的函数
     :param conf: 回测配置
     :param pivot_dict_spot: 现货行情数据
     :param pivot_dict_swap: 永续合约行情数据
-    :param df_spot_ratio: 现货目标资金占比
-    :param df_swap_ratio: 永续合约目标资金占比
+    :param df_spot_ratio: 现货目标资金占比，SparseRatio 或者稠密的 DataFrame
+    :param df_swap_ratio: 永续合约目标资金占比，SparseRatio 或者稠密的 DataFrame
     :param leverage: 杠杆
+    :param precision: 价格、资金占比的精度，默认使用 config 中的 sim_precision
     :return: 没有返回值
     """
     # ====================================================================================================
     # 1. 数据预检和准备数据
     # 数据预检，对齐所有数据的长度（防御性编程）
     # ====================================================================================================
-    # noinspection PyUnresolvedReferences
-    if len(df_spot_ratio) != len(df_swap_ratio) or (df_swap_ratio.index != df_spot_ratio.index).any():
-        raise RuntimeError(f'数据长度不一致，现货数据长度：{len(df_spot_ratio)}, 永续合约数据长度：{len(df_swap_ratio)}')
+    df_spot_ratio, df_swap_ratio = check_ratio_pair(df_spot_ratio, df_swap_ratio)
 
     # 开始时间列
     candle_begin_times = df_spot_ratio.index.to_series().reset_index(drop=True)
 
-    # 获取现货和永续合约的币种，并且排序
-    spot_symbols = sorted(df_spot_ratio.columns)
-    swap_symbols = sorted(df_swap_ratio.columns)
+    # ====================================================================================================
+    # 2. 开始模拟交易
+    # 开始策马奔腾啦 🐎
+    # ====================================================================================================
+    s_time = time.perf_counter()
+    logger.debug(f'▶️ 模拟交易开始{datetime.now()}...')
+    ledger = TradeLedger(True, len(df_spot_ratio)) if save_trade_ledger else None
+    sim_results = simulate_ratio_pair(conf, pivot_dict_spot, pivot_dict_swap, candle_begin_times, df_spot_ratio,
+                                      df_swap_ratio, leverage, precision, ledger)
+    logger.ok(f'完成模拟交易，花费时间: {time.perf_counter() - s_time:.3f}秒')
+
+    if ledger is not None:
+        df_trades = build_trade_ledger(ledger.to_array(), candle_begin_times, df_spot_ratio.symbols,
+                                       df_swap_ratio.symbols)
+        ledger_path = conf.get_result_folder() / '成交明细.parquet'
+        df_trades.write_parquet(ledger_path)
+        logger.ok(f'成交明细已保存：{ledger_path}，共{len(df_trades)}笔')
+
+    # ====================================================================================================
+    # 3. 回测结果汇总，并输出相关文件
+    # ====================================================================================================
+    return summarize_account(conf, candle_begin_times, sim_results, df_spot_ratio, df_swap_ratio)
+
+
+def simulate_ratio_pair(conf: BacktestConfig, pivot_dict_spot, pivot_dict_swap, candle_begin_times,
+                        df_spot_ratio: SparseRatio, df_swap_ratio: SparseRatio, leverage=None, precision=None,
+                        ledger: TradeLedger = None):
+    """
+    对齐行情数据，模拟一组目标资金占比
+    :param ledger: 成交明细，模拟过程中写入，None 表示不记录
+    :return: start_simulation 的返回值
+    """
+    dtype = get_sim_dtype(precision)
+
+    # 对齐行情数据，读入最小下单量，确定rebalance接入的时间点
+    market_kwargs = prepare_market_data(conf, pivot_dict_spot, pivot_dict_swap, candle_begin_times,
+                                        df_spot_ratio.symbols, df_swap_ratio.symbols, precision)
+    leverages = to_leverage_array(conf, leverage, len(df_spot_ratio))
+    if ledger is not None:
+        market_kwargs['ledger'] = ledger
+
+    return start_simulation(
+        init_capital=conf.initial_usdt,  # 初始资金，单位：USDT
+        leverages=leverages,  # 杠杆
+        # 选币结果计算聚合得到的每个周期目标资金占比（CSR 稀疏格式）
+        spot_ratio_indptr=df_spot_ratio.indptr,  # 现货目标资金占比
+        spot_ratio_indices=df_spot_ratio.indices,
+        spot_ratio_data=df_spot_ratio.data.astype(dtype, copy=False),
+        swap_ratio_indptr=df_swap_ratio.indptr,  # 永续合约目标资金占比
+        swap_ratio_indices=df_swap_ratio.indices,
+        swap_ratio_data=df_swap_ratio.data.astype(dtype, copy=False),
+        **market_kwargs  # 行情数据、最小下单量、手续费等
+    )
+
+
+def simulate_with_checkpoint(conf: BacktestConfig, pivot_dict_spot, pivot_dict_swap, df_spot_ratio, df_swap_ratio,
+                             leverage: float | pd.Series = None, precision: str = None,
+                             checkpoint: SimCheckpoint = None, checkpoint_time=None,
+                             record_trades=False) -> (pd.DataFrame, SimCheckpoint):
+    """
+    支持检查点的模拟交易：可以从之前保存的检查点继续模拟，并导出任意一根 K 线之后的状态
+    :param conf: 回测配置
+    :param pivot_dict_spot: 现货行情数据
+    :param pivot_dict_swap: 永续合约行情数据
+    :param df_spot_ratio: 现货目标资金占比，传入检查点时只模拟检查点之后的 K 线
+    :param df_swap_ratio: 永续合约目标资金占比，同上
+    :param leverage: 杠杆，动态杠杆的长度需要和目标资金占比一致
+    :param precision: 价格、资金占比的精度，默认使用 config 中的 sim_precision
+    :param checkpoint: 从这个检查点继续模拟，None 表示从初始资金开始
+    :param checkpoint_time: 导出这根 K 线收盘之后的状态，默认为最后一根 K 线
+    :param record_trades: 是否记录成交明细。记录时检查点的 trades 包含从最开始到 checkpoint_time 的所有成交
+                          （接上 checkpoint 中已有的成交），checkpoint_time 之后的成交在从检查点继续模拟时重新记录
+    :return: (模拟的 K 线对应的资金曲线, 检查点)
+    """
+    df_spot_ratio, df_swap_ratio = check_ratio_pair(df_spot_ratio, df_swap_ratio)
+
+    # ====================================================================================================
+    # 1. 从检查点继续时，只保留检查点之后的 K 线，检查点中有持仓的币种都要参与模拟
+    # ====================================================================================================
+    if checkpoint is not None:
+        keep = df_spot_ratio.index > checkpoint.candle_begin_time
+        new_times = df_spot_ratio.index[keep]
+        if len(new_times) and new_times[0] != checkpoint.candle_begin_time + pd.Timedelta(hours=1):
+            raise ValueError(f'检查点 {checkpoint.candle_begin_time} 之后的数据不连续，下一根 K 线为 {new_times[0]}')
+        df_spot_ratio = df_spot_ratio.select_rows(new_times)
+        df_swap_ratio = df_swap_ratio.select_rows(new_times)
+        if isinstance(leverage, pd.Series):
+            leverage = leverage.iloc[np.flatnonzero(keep)]
+
+        spot_symbols = _merge_symbols(df_spot_ratio.symbols, checkpoint.spot.active_symbols)
+        swap_symbols = _merge_symbols(df_swap_ratio.symbols, checkpoint.swap.active_symbols)
+        df_spot_ratio = df_spot_ratio.reindex_columns(spot_symbols)
+        df_swap_ratio = df_swap_ratio.reindex_columns(swap_symbols)
+
+    candle_begin_times = df_spot_ratio.index.to_series().reset_index(drop=True)
+    n_bars = len(df_spot_ratio)
+    if checkpoint_time is None:
+        checkpoint_end = n_bars
+    else:
+        checkpoint_end = int(df_spot_ratio.index.searchsorted(pd.Timestamp(checkpoint_time), side='right'))
+        if checkpoint_end == 0:
+            raise ValueError(f'checkpoint_time {checkpoint_time} 早于模拟的第一根 K 线')
+
+    # ====================================================================================================
+    # 2. 准备数据，初始化模拟对象
+    # ====================================================================================================
+    dtype = get_sim_dtype(precision)
+    market_kwargs = prepare_market_data(conf, pivot_dict_spot, pivot_dict_swap, candle_begin_times,
+                                        df_spot_ratio.symbols, df_swap_ratio.symbols, precision)
+    leverages = to_leverage_array(conf, leverage, n_bars)
+
+    if checkpoint is None:
+        spot_state = MarketState(df_spot_ratio.symbols, conf.initial_usdt,
+                                 np.zeros(len(df_spot_ratio.symbols), dtype=np.int64),
+                                 np.zeros(len(df_spot_ratio.symbols), dtype=np.int64),
+                                 np.zeros(len(df_spot_ratio.symbols), dtype=np.float64))
+        swap_state = MarketState(df_swap_ratio.symbols, 0.,
+                                 np.zeros(len(df_swap_ratio.symbols), dtype=np.int64),
+                                 np.zeros(len(df_swap_ratio.symbols), dtype=np.int64),
+                                 np.zeros(len(df_swap_ratio.symbols), dtype=np.float64))
+        has_last_prices, is_liquidated = False, False
+    else:
+        spot_state = checkpoint.spot.reindex(df_spot_ratio.symbols)
+        swap_state = checkpoint.swap.reindex(df_swap_ratio.symbols)
+        has_last_prices, is_liquidated = checkpoint.has_last_prices, checkpoint.is_liquidated
+
+    ledger = TradeLedger(True, n_bars) if record_trades else TradeLedger(False, 0)
+    sim_spot = spot_state.create_simulator(market_kwargs['spot_lot_sizes'], market_kwargs['spot_c_rate'],
+                                           market_kwargs['spot_min_order_limit'], has_last_prices, ledger,
+                                           MARKET_SPOT)
+    sim_swap = swap_state.create_simulator(market_kwargs['swap_lot_sizes'], market_kwargs['swap_c_rate'],
+                                           market_kwargs['swap_min_order_limit'], has_last_prices, ledger,
+                                           MARKET_SWAP)
+
+    # ====================================================================================================
+    # 3. 分两段模拟：检查点之前、检查点之后，已经爆仓的不再模拟，结果都是 0
+    # ====================================================================================================
+    sim_results = [np.zeros(n_bars, dtype=np.float64) for _ in range(7)]
+    run_kwargs = dict(zip(['equities', 'turnovers', 'fees', 'funding_fees', 'margin_rates', 'long_pos_values',
+                           'short_pos_values'], sim_results))
+    run_kwargs.update(
+        leverages=leverages,
+        min_margin_rate=market_kwargs['min_margin_rate'],
+        spot_ratio_indptr=df_spot_ratio.indptr,
+        spot_ratio_indices=df_spot_ratio.indices,
+        spot_ratio_data=df_spot_ratio.data.astype(dtype, copy=False),
+        swap_ratio_indptr=df_swap_ratio.indptr,
+        swap_ratio_indices=df_swap_ratio.indices,
+        swap_ratio_data=df_swap_ratio.data.astype(dtype, copy=False),
+        **{k: market_kwargs[k] for k in ['spot_open_p', 'spot_close_p', 'spot_vwap1m_p', 'swap_open_p',
+                                         'swap_close_p', 'swap_vwap1m_p', 'funding_rates', 'pos_calc',
+                                         'require_rebalance']},
+    )
+    new_checkpoint = None
+    for start, end in [(0, checkpoint_end), (checkpoint_end, n_bars)]:
+        if not is_liquidated and end > start:
+            is_liquidated = run_simulation(sim_spot, sim_swap, start, end, **run_kwargs)
+        if end == checkpoint_end and new_checkpoint is None:
+            new_checkpoint = SimCheckpoint(
+                candle_begin_time=df_spot_ratio.index[checkpoint_end - 1] if checkpoint_end else checkpoint.candle_begin_time,
+                spot=MarketState.from_simulator(sim_spot, df_spot_ratio.symbols),
+                swap=MarketState.from_simulator(sim_swap, df_swap_ratio.symbols),
+                has_last_prices=sim_spot.has_last_prices,
+                is_liquidated=is_liquidated,
+                trades=_checkpoint_trades(checkpoint, ledger, checkpoint_end, candle_begin_times,
+                                          df_spot_ratio.symbols, df_swap_ratio.symbols) if record_trades else None,
+            )
+
+    account_df = build_account_df(candle_begin_times, sim_results)
+    account_df['净值'] = account_df['equity'] / conf.initial_usdt
+    return account_df, new_checkpoint
+
+
+def _checkpoint_trades(checkpoint: SimCheckpoint | None, ledger: TradeLedger, checkpoint_end, candle_begin_times,
+                       spot_symbols, swap_symbols) -> pl.DataFrame:
+    """
+    检查点中的成交明细：上一个检查点的成交 + 本次模拟到检查点为止的成交
+    """
+    records = ledger.to_array()
+    df_trades = build_trade_ledger(records[records['bar'] < checkpoint_end], candle_begin_times, spot_symbols,
+                                   swap_symbols)
+    if checkpoint is not None and checkpoint.trades is not None:
+        df_trades = pl.concat([checkpoint.trades, df_trades])
+    return df_trades
+
+
+def _merge_symbols(symbols, extra_symbols) -> list:
+    """
+    币种列表中加入检查点中有持仓的币种，都已经存在时保持原来的顺序，否则重新排序
+    """
+    if set(extra_symbols).issubset(symbols):
+        return list(symbols)
+    return sorted(set(symbols) | set(extra_symbols))
+
+
+def compare_sim_precision(conf: BacktestConfig, pivot_dict_spot, pivot_dict_swap, df_spot_ratio, df_swap_ratio,
+                          leverage: float | pd.Series = None) -> pd.Series:
+    """
+    同一组目标资金占比分别用 float64、float32 模拟，统计 float32 资金曲线相对 float64 的偏差
+    :param conf: 回测配置
+    :param pivot_dict_spot: 现货行情数据，需要传入 float64 的数据，float32 模拟时再转换精度
+    :param pivot_dict_swap: 永续合约行情数据，同上
+    :param df_spot_ratio: 现货目标资金占比
+    :param df_swap_ratio: 永续合约目标资金占比
+    :param leverage: 杠杆
+    :return: 偏差统计
+    """
+    df_spot_ratio, df_swap_ratio = check_ratio_pair(df_spot_ratio, df_swap_ratio)
+    candle_begin_times = df_spot_ratio.index.to_series().reset_index(drop=True)
+    res_64 = simulate_ratio_pair(conf, pivot_dict_spot, pivot_dict_swap, candle_begin_times, df_spot_ratio,
+                                 df_swap_ratio, leverage, 'float64')
+    res_32 = simulate_ratio_pair(conf, pivot_dict_spot, pivot_dict_swap, candle_begin_times, df_spot_ratio,
+                                 df_swap_ratio, leverage, 'float32')
+    equity_64, turnover_64, fee_64 = res_64[0], res_64[1], res_64[2]
+    equity_32, turnover_32, fee_32 = res_32[0], res_32[1], res_32[2]
+
+    # 爆仓之后的资金曲线为 0，不参与相对偏差的计算
+    valid = equity_64 != 0
+    rel_diff = np.zeros(len(equity_64))
+    rel_diff[valid] = np.abs(equity_32[valid] - equity_64[valid]) / np.abs(equity_64[valid])
+    max_idx = int(np.argmax(rel_diff)) if len(rel_diff) else 0
+
+    def _rel(a, b):
+        return abs(a - b) / abs(b) if b != 0 else abs(a - b)
+
+    return pd.Series({
+        '周期数': len(equity_64),
+        '最终净值_float64': equity_64[-1] / conf.initial_usdt if len(equity_64) else np.nan,
+        '最终净值_float32': equity_32[-1] / conf.initial_usdt if len(equity_32) else np.nan,
+        '最终净值相对偏差': _rel(equity_32[-1], equity_64[-1]) if len(equity_64) else np.nan,
+        '资金曲线最大相对偏差': rel_diff[max_idx] if len(rel_diff) else np.nan,
+        '最大偏差时间': candle_begin_times.iloc[max_idx] if len(rel_diff) else pd.NaT,
+        '资金曲线平均相对偏差': rel_diff[valid].mean() if valid.any() else np.nan,
+        '总成交额相对偏差': _rel(turnover_32.sum(), turnover_64.sum()),
+        '总手续费相对偏差': _rel(fee_32.sum(), fee_64.sum()),
+        '调仓次数差异': int(np.sum((turnover_32 > 0) != (turnover_64 > 0))),
+    })
+
+
+def calc_sensitivity(conf: BacktestConfig, pivot_dict_spot, pivot_dict_swap, df_spot_ratio, df_swap_ratio,
+                     param_grid: dict, leverage: float | pd.Series = None, precision: str = None) -> pd.DataFrame:
+    """
+    交易参数敏感性分析：同一组目标资金占比，在一次 numba 并行调用中模拟所有参数组合
+    :param conf: 回测配置，param_grid 中没有的参数使用回测配置中的值
+    :param pivot_dict_spot: 现货行情数据
+    :param pivot_dict_swap: 永续合约行情数据
+    :param df_spot_ratio: 现货目标资金占比
+    :param df_swap_ratio: 永续合约目标资金占比
+    :param param_grid: 参数网格，例如 {'swap_c_rate': [6e-4, 1e-3], 'leverage': [1, 1.5]}，取所有组合。
+                       支持的参数见 SENSITIVITY_PARAMS
+    :param leverage: 杠杆，param_grid 中有 leverage 时以 param_grid 为准
+    :param precision: 价格、资金占比的精度，默认使用 config 中的 sim_precision
+    :return: 每个参数组合一行，包含参数和回测指标
+    """
+    unknown = set(param_grid) - set(SENSITIVITY_PARAMS)
+    if unknown:
+        raise ValueError(f'不支持的敏感性分析参数：{sorted(unknown)}，只支持 {SENSITIVITY_PARAMS}')
+
+    # 生成所有参数组合
+    keys = list(param_grid)
+    df_params = pd.DataFrame(list(product(*[param_grid[k] for k in keys])), columns=keys)
+    for k in SENSITIVITY_PARAMS:
+        if k not in df_params.columns:
+            df_params[k] = getattr(conf, k)
+    if 'leverage' not in param_grid and leverage is not None:
+        # 动态杠杆没有单一的值
+        df_params['leverage'] = np.nan if isinstance(leverage, pd.Series) else leverage
+    df_params = df_params[SENSITIVITY_PARAMS]
+
+    df_spot_ratio, df_swap_ratio = check_ratio_pair(df_spot_ratio, df_swap_ratio)
+    candle_begin_times = df_spot_ratio.index.to_series().reset_index(drop=True)
+    n_bars = len(df_spot_ratio)
+
+    dtype = get_sim_dtype(precision)
+    market_kwargs = prepare_market_data(conf, pivot_dict_spot, pivot_dict_swap, candle_begin_times,
+                                        df_spot_ratio.symbols, df_swap_ratio.symbols, precision)
+    for k in ['spot_c_rate', 'swap_c_rate', 'spot_min_order_limit', 'swap_min_order_limit', 'min_margin_rate']:
+        del market_kwargs[k]
+
+    # param_grid 中没有杠杆的时候，使用传入的杠杆（可以是动态杠杆）
+    if 'leverage' in param_grid:
+        leverages = np.vstack([to_leverage_array(conf, lev, n_bars) for lev in df_params['leverage']])
+    else:
+        leverages = np.tile(to_leverage_array(conf, leverage, n_bars), (len(df_params), 1))
+
+    s_time = time.perf_counter()
+    logger.debug(f'▶️ 敏感性分析开始{datetime.now()}，共{len(df_params)}组参数...')
+    sim_results = start_simulation_sweep(
+        init_capital=conf.initial_usdt,
+        leverages=leverages,  # 每组参数的杠杆
+        spot_c_rates=df_params['spot_c_rate'].to_numpy(dtype=np.float64),
+        swap_c_rates=df_params['swap_c_rate'].to_numpy(dtype=np.float64),
+        spot_min_order_limits=df_params['spot_min_order_limit'].to_numpy(dtype=np.float64),
+        swap_min_order_limits=df_params['swap_min_order_limit'].to_numpy(dtype=np.float64),
+        min_margin_rates=df_params['margin_rate'].to_numpy(dtype=np.float64),
+        spot_ratio_indptr=df_spot_ratio.indptr,
+        spot_ratio_indices=df_spot_ratio.indices,
+        spot_ratio_data=df_spot_ratio.data.astype(dtype, copy=False),
+        swap_ratio_indptr=df_swap_ratio.indptr,
+        swap_ratio_indices=df_swap_ratio.indices,
+        swap_ratio_data=df_swap_ratio.data.astype(dtype, copy=False),
+        **market_kwargs
+    )
+    logger.ok(f'完成敏感性分析，花费时间: {time.perf_counter() - s_time:.3f}秒')
+
+    return pd.concat([df_params, summarize_sweep(conf, candle_begin_times, sim_results, df_params)], axis=1)
+
+
+def summarize_sweep(conf: BacktestConfig, candle_begin_times, sim_results, df_params) -> pd.DataFrame:
+    """
+    统计每组参数的回测指标，口径和 strategy_evaluate 一致，数值不转换成百分比字符串，方便排序和画图
+    :param conf: 回测配置
+    :param candle_begin_times: 开始时间列
+    :param sim_results: start_simulation_sweep 的返回值，每一项都是 (参数组数 × 周期数) 的矩阵
+    :param df_params: 参数组合
+    :return: 每组参数一行的回测指标
+    """
+    equities, turnovers, fees, funding_fees, margin_rates, _, _ = sim_results
+    net = equities / conf.initial_usdt
+    if net.shape[1] == 0:
+        return pd.DataFrame(index=df_params.index)
+
+    # 年化收益和最大回撤
+    days = (candle_begin_times.iloc[-1] - candle_begin_times.iloc[0]) / pd.Timedelta(days=1)
+    annual_return = net[:, -1] ** (365 / days) - 1 if days > 0 else np.full(len(net), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        max_draw_down = np.nanmin(net / np.maximum.accumulate(net, axis=1) - 1, axis=1)
+        return_drawdown_ratio = annual_return / np.abs(max_draw_down)
+
+    return pd.DataFrame({
+        '累积净值': net[:, -1],
+        '年化收益': annual_return,
+        '最大回撤': max_draw_down,
+        '年化收益/回撤比': return_drawdown_ratio,
+        '总成交额': turnovers.sum(axis=1),
+        '总手续费': fees.sum(axis=1),
+        '总资金费': funding_fees.sum(axis=1),
+        '是否爆仓': (margin_rates < df_params['margin_rate'].to_numpy()[:, None]).any(axis=1).astype(int),
+    }, index=df_params.index)
+
+
+def get_batch_params(conf: BacktestConfig) -> tuple:
+    """
+    批量模拟交易时所有账户共用的参数，只有这些参数完全一致的配置才能放在同一批里面模拟
+    """
+    return tuple(repr(getattr(conf, k)) for k in BATCH_SHARED_PARAMS)
+
+
+def calc_equity_batch(conf_list: List[BacktestConfig],
+                      pivot_dict_spot: dict,
+                      pivot_dict_swap: dict,
+                      ratio_list: list,
+                      leverage_list: list = None):
+    """
+    批量计算回测结果：多组目标资金占比共用同一份行情数据，在一次 numba 并行调用中同时模拟所有账户
+    :param conf_list: 每一组的回测配置，手续费、最小下单金额、调仓模式等交易参数（BATCH_SHARED_PARAMS）必须一致
+    :param pivot_dict_spot: 现货行情数据
+    :param pivot_dict_swap: 永续合约行情数据
+    :param ratio_list: 每一组的 (现货目标资金占比, 永续合约目标资金占比)，时间索引必须一致
+    :param leverage_list: 每一组的杠杆，None 表示使用回测配置中的杠杆
+    :return: 每一组的 (account_df, rtn, year_return, month_return, quarter_return)
+    """
+    conf = conf_list[0]
+    for conf_i in conf_list[1:]:
+        diff_params = [k for k, v, v0 in zip(BATCH_SHARED_PARAMS, get_batch_params(conf_i), get_batch_params(conf))
+                       if v != v0]
+        if diff_params:
+            raise ValueError(f'批量模拟交易时，所有配置的交易参数必须一致，{conf_i.name} 和 {conf.name} 不一致：{diff_params}')
+    ratio_list = [check_ratio_pair(df_spot_ratio, df_swap_ratio) for df_spot_ratio, df_swap_ratio in ratio_list]
+    times = ratio_list[0][0].index
+    for df_spot_ratio, _ in ratio_list[1:]:
+        if not df_spot_ratio.index.equals(times):
+            raise RuntimeError('批量模拟交易时，所有目标资金占比的时间索引必须一致')
+    candle_begin_times = times.to_series().reset_index(drop=True)
+
+    # 所有账户使用同一套币种（并集），没有仓位的币种不会产生交易，不影响模拟结果
+    spot_symbols = sorted(set().union(*[df_spot_ratio.symbols for df_spot_ratio, _ in ratio_list]))
+    swap_symbols = sorted(set().union(*[df_swap_ratio.symbols for _, df_swap_ratio in ratio_list]))
+    spot_ratios = [df_spot_ratio.reindex_columns(spot_symbols) for df_spot_ratio, _ in ratio_list]
+    swap_ratios = [df_swap_ratio.reindex_columns(swap_symbols) for _, df_swap_ratio in ratio_list]
+
+    dtype = get_sim_dtype()
+    market_kwargs = prepare_market_data(conf, pivot_dict_spot, pivot_dict_swap, candle_begin_times,
+                                        spot_symbols, swap_symbols)
+    if leverage_list is None:
+        leverage_list = [None] * len(conf_list)
+    leverages = np.vstack([to_leverage_array(conf_i, leverage, len(times))
+                           for conf_i, leverage in zip(conf_list, leverage_list)])
+    init_capitals = np.array([conf_i.initial_usdt for conf_i in conf_list], dtype=np.float64)
+
+    s_time = time.perf_counter()
+    logger.debug(f'▶️ 批量模拟交易开始{datetime.now()}，共{len(conf_list)}组...')
+    batch_results = start_simulation_batch(
+        init_capitals=init_capitals,  # 每个账户的初始资金
+        leverages=leverages,  # 每个账户的杠杆
+        # 每个账户的目标资金占比，CSR 格式拼接在一起，indptr 的每一行对应一个账户
+        spot_ratio_indptr=stack_ratio_indptr(spot_ratios),
+        spot_ratio_indices=np.concatenate([ratio.indices for ratio in spot_ratios]),
+        spot_ratio_data=np.concatenate([ratio.data for ratio in spot_ratios]).astype(dtype, copy=False),
+        swap_ratio_indptr=stack_ratio_indptr(swap_ratios),
+        swap_ratio_indices=np.concatenate([ratio.indices for ratio in swap_ratios]),
+        swap_ratio_data=np.concatenate([ratio.data for ratio in swap_ratios]).astype(dtype, copy=False),
+        **market_kwargs
+    )
+    logger.ok(f'完成批量模拟交易，花费时间: {time.perf_counter() - s_time:.3f}秒')
+
+    return [summarize_account(conf_i, candle_begin_times, [res[k] for res in batch_results], *ratio_list[k])
+            for k, conf_i in enumerate(conf_list)]
+
+
+def check_ratio_pair(df_spot_ratio, df_swap_ratio) -> (SparseRatio, SparseRatio):
+    """
+    兼容稠密的 DataFrame，统一转换成稀疏格式，并检查现货、合约的时间索引是否一致
+    """
+    df_spot_ratio = SparseRatio.from_dense(df_spot_ratio)
+    df_swap_ratio = SparseRatio.from_dense(df_swap_ratio)
+
+    if len(df_spot_ratio) != len(df_swap_ratio) or not df_swap_ratio.index.equals(df_spot_ratio.index):
+        raise RuntimeError(f'数据长度不一致，现货数据长度：{len(df_spot_ratio)}, 永续合约数据长度：{len(df_swap_ratio)}')
+    return df_spot_ratio, df_swap_ratio
+
 
+def stack_ratio_indptr(ratio_list: List[SparseRatio]) -> np.ndarray:
+    """
+    把多个 CSR 的行指针叠成 (账户 × 行数+1) 的矩阵，行指针加上偏移之后直接指向拼接后的 indices/data
+    """
+    offsets = np.cumsum([0] + [ratio.nnz for ratio in ratio_list[:-1]])
+    return np.vstack([ratio.indptr + offset for ratio, offset in zip(ratio_list, offsets)])
+
+
+def to_leverage_array(conf: BacktestConfig, leverage, n_bars) -> np.ndarray:
+    if leverage is None:
+        leverage = conf.leverage
+
+    if isinstance(leverage, pd.Series):
+        return leverage.to_numpy(dtype=np.float64)
+    return np.full(n_bars, leverage, dtype=np.float64)
+
+
+def prepare_market_data(conf: BacktestConfig, pivot_dict_spot, pivot_dict_swap, candle_begin_times,
+                        spot_symbols, swap_symbols, precision=None) -> dict:
+    """
+    准备模拟交易中除了目标资金占比和杠杆之外的参数：行情数据、最小下单量、手续费、调仓模式等
+    :param precision: 行情数据的精度，默认使用 config 中的 sim_precision。精度和 Pivot 数据一致时不会拷贝
+    :return: start_simulation 的参数
+    """
+    dtype = get_sim_dtype(precision)
     # 裁切现货数据，保证open，close，vwap1m，对应的df中，现货币种、时间长度一致
     pivot_dict_spot = align_pivot_dimensions(pivot_dict_spot, spot_symbols, candle_begin_times)
 
@@ -67,10 +541,8 @@ def calc_equity(conf: BacktestConfig,
     pivot_dict_swap = align_pivot_dimensions(pivot_dict_swap, swap_symbols, candle_begin_times)
 
     # 读入最小下单量数据
-    spot_lot_sizes = read_lot_sizes(min_qty_path / '最小下单量_spot.csv', spot_symbols)
-    swap_lot_sizes = read_lot_sizes(min_qty_path / '最小下单量_swap.csv', swap_symbols)
-
-    pos_calc = conf.rebalance_mode.create(spot_lot_sizes.to_numpy(), swap_lot_sizes.to_numpy())
+    spot_lot_sizes = read_lot_sizes(min_qty_path / '最小下单量_spot.csv', spot_symbols).to_numpy()
+    swap_lot_sizes = read_lot_sizes(min_qty_path / '最小下单量_swap.csv', swap_symbols).to_numpy()
 
     # 确定rebalance接入的时间点
     if conf.is_day_period:
@@ -78,60 +550,40 @@ def calc_equity(conf: BacktestConfig,
     else:
         require_rebalance = np.ones(len(candle_begin_times), dtype=np.int8)
 
-    if leverage is None:
-        leverage = conf.leverage
-
-    if isinstance(leverage, pd.Series):
-        leverages = leverage.to_numpy(dtype=np.float64)
-    else:
-        leverages = np.full(len(df_spot_ratio), leverage, dtype=np.float64)
-
-    # ====================================================================================================
-    # 2. 开始模拟交易
-    # 开始策马奔腾啦 🐎
-    # ====================================================================================================
-    s_time = time.perf_counter()
-    logger.debug(f'▶️ 模拟交易开始{datetime.now()}...')
-    equities, turnovers, fees, funding_fees, margin_rates, long_pos_values, short_pos_values = start_simulation(
-        init_capital=conf.initial_usdt,  # 初始资金，单位：USDT
-        leverages=leverages,  # 杠杆
-        spot_lot_sizes=spot_lot_sizes.to_numpy(),  # 现货最小下单量
-        swap_lot_sizes=swap_lot_sizes.to_numpy(),  # 永续合约最小下单量
+    return dict(
+        spot_lot_sizes=spot_lot_sizes,  # 现货最小下单量
+        swap_lot_sizes=swap_lot_sizes,  # 永续合约最小下单量
         spot_c_rate=conf.spot_c_rate,  # 现货杠杆率
         swap_c_rate=conf.swap_c_rate,  # 永续合约杠杆率
         spot_min_order_limit=float(conf.spot_min_order_limit),  # 现货最小下单金额
         swap_min_order_limit=float(conf.swap_min_order_limit),  # 永续合约最小下单金额
         min_margin_rate=conf.margin_rate,  # 最低保证金比例
-        # 选币结果计算聚合得到的每个周期目标资金占比
-        spot_ratio=df_spot_ratio[spot_symbols].to_numpy(),  # 现货目标资金占比
-        swap_ratio=df_swap_ratio[swap_symbols].to_numpy(),  # 永续合约目标资金占比
         # 现货行情数据
-        spot_open_p=pivot_dict_spot['open'].to_numpy(),  # 现货开盘价
-        spot_close_p=pivot_dict_spot['close'].to_numpy(),  # 现货收盘价
-        spot_vwap1m_p=pivot_dict_spot['vwap1m'].to_numpy(),  # 现货开盘一分钟均价
+        spot_open_p=pivot_dict_spot['open'].to_numpy(dtype=dtype),  # 现货开盘价
+        spot_close_p=pivot_dict_spot['close'].to_numpy(dtype=dtype),  # 现货收盘价
+        spot_vwap1m_p=pivot_dict_spot['vwap1m'].to_numpy(dtype=dtype),  # 现货开盘一分钟均价
         # 永续合约行情数据
-        swap_open_p=pivot_dict_swap['open'].to_numpy(),  # 永续合约开盘价
-        swap_close_p=pivot_dict_swap['close'].to_numpy(),  # 永续合约收盘价
-        swap_vwap1m_p=pivot_dict_swap['vwap1m'].to_numpy(),  # 永续合约开盘一分钟均价
-        funding_rates=pivot_dict_swap['funding_rate'].to_numpy(),  # 永续合约资金费率
-        pos_calc=pos_calc,  # 仓位计算
+        swap_open_p=pivot_dict_swap['open'].to_numpy(dtype=dtype),  # 永续合约开盘价
+        swap_close_p=pivot_dict_swap['close'].to_numpy(dtype=dtype),  # 永续合约收盘价
+        swap_vwap1m_p=pivot_dict_swap['vwap1m'].to_numpy(dtype=dtype),  # 永续合约开盘一分钟均价
+        funding_rates=pivot_dict_swap['funding_rate'].to_numpy(dtype=dtype),  # 永续合约资金费率
+        pos_calc=conf.rebalance_mode.create(spot_lot_sizes, swap_lot_sizes),  # 仓位计算
         require_rebalance=require_rebalance,  # 是否需要rebalance
     )
-    logger.ok(f'完成模拟交易，花费时间: {time.perf_counter() - s_time:.3f}秒')
 
-    # ====================================================================================================
-    # 3. 回测结果汇总，并输出相关文件
-    # ====================================================================================================
-    account_df = pd.DataFrame({
-        'candle_begin_time': candle_begin_times,
-        'equity': equities,
-        'turnover': turnovers,
-        'fee': fees,
-        'funding_fee': funding_fees,
-        'marginRatio': margin_rates,
-        'long_pos_value': long_pos_values,
-        'short_pos_value': short_pos_values
-    })
+
+def summarize_account(conf: BacktestConfig, candle_begin_times, sim_results, df_spot_ratio: SparseRatio,
+                      df_swap_ratio: SparseRatio):
+    """
+    汇总模拟交易的结果，生成资金曲线并做策略评价
+    :param conf: 回测配置
+    :param candle_begin_times: 开始时间列
+    :param sim_results: start_simulation 的返回值
+    :param df_spot_ratio: 现货目标资金占比
+    :param df_swap_ratio: 永续合约目标资金占比
+    :return: account_df, rtn, year_return, month_return, quarter_return
+    """
+    account_df = build_account_df(candle_begin_times, sim_results)
 
     account_df['净值'] = account_df['equity'] / conf.initial_usdt
     account_df['涨跌幅'] = account_df['净值'].pct_change()
@@ -141,46 +593,8 @@ def calc_equity(conf: BacktestConfig,
     account_df['long_short_ratio'] = account_df['long_pos_value'] / (account_df['short_pos_value'] + 1e-8)
     account_df['leverage_ratio'] = (account_df['long_pos_value'] + account_df['short_pos_value']) / account_df['equity']
 
-    account_df.set_index('candle_begin_time', inplace=True)
-    df_swap_ratio = df_swap_ratio * conf.leverage
-    df_spot_ratio = df_spot_ratio * conf.leverage
-    account_df['symbol_long_num'] = df_spot_ratio[df_spot_ratio > 0].count(axis=1) + df_swap_ratio[df_swap_ratio > 0].count(axis=1)
-    account_df['symbol_short_num'] = df_spot_ratio[df_spot_ratio < 0].count(axis=1) + df_swap_ratio[df_swap_ratio < 0].count(axis=1)
-
-    # 计算全局多头最大ratio和对应symbol（现货+合约多头部分）
-    long_combined = pd.concat([
-        df_spot_ratio.fillna(0).add_prefix('SPOT_'),
-        df_swap_ratio[df_swap_ratio > 0].fillna(0).add_prefix('SWAP_')
-    ], axis=1)
-    account_df['long_max_ratio'] = long_combined.max(axis=1).fillna(0)
-    # 转换为字符串类型避免Categorical错误
-    account_df['long_max_ratio_symbol'] = 'NO_LONG' if long_combined.empty else long_combined.idxmax(axis=1).astype(str).fillna('NO_LONG')
-    account_df.loc[account_df['long_max_ratio'] <= 0, 'long_max_ratio_symbol'] = 'NO_LONG'
-
-    # 计算空头最大ratio（绝对值最大）和对应symbol
-    short_only = df_swap_ratio[df_swap_ratio < 0].add_prefix('SWAP_')  # 添加SWAP_前缀保持一致
-    account_df['short_max_ratio'] = short_only.min(axis=1).fillna(0)
-    # 转换为字符串类型避免Categorical错误
-    account_df['short_max_ratio_symbol'] = 'NO_SHORT' if short_only.empty else short_only.idxmin(axis=1).astype(str).fillna('NO_SHORT')
-    account_df['short_max_ratio_abs'] = account_df['short_max_ratio'].abs()
-
-    # 计算前3名持仓 - 简洁实现（百分比格式）
-    # 多头前3名：利用pandas的nlargest，转换为百分比显示
-    account_df['top3_long'] = long_combined.apply(
-        lambda row: "; ".join(
-            [f"{sym}({val * 100:.2f}%)" for sym, val in row[row > 0].nlargest(3).items()]) or "NO_LONG",
-        axis=1
-    )
-
-    # 空头前3名：按绝对值排序（已包含SWAP_前缀），转换为百分比显示
-    account_df['top3_short'] = short_only.apply(
-        lambda row: "; ".join(
-            [f"{sym}({val * 100:.2f}%)" for sym, val in row[row < 0].abs().nlargest(3).items()]) or "NO_SHORT",
-        axis=1
-    )
-
-    # 如果需要重置索引，可以执行以下操作
-    account_df.reset_index(inplace=True)
+    # 持仓币种的统计：多空数量、最大仓位、前3名持仓，直接从稀疏的资金占比计算
+    account_df = pd.concat([account_df, calc_ratio_stats(df_spot_ratio, df_swap_ratio, conf.leverage)], axis=1)
 
     # 策略评价
     rtn, year_return, month_return, quarter_return = strategy_evaluate(account_df, net_col='净值', pct_col='涨跌幅')
@@ -189,6 +603,118 @@ def calc_equity(conf: BacktestConfig,
     return account_df, rtn, year_return, month_return, quarter_return
 
 
+def build_account_df(candle_begin_times, sim_results) -> pd.DataFrame:
+    """
+    把模拟交易的结果整理成资金曲线
+    :param candle_begin_times: 开始时间列
+    :param sim_results: start_simulation 的返回值
+    """
+    equities, turnovers, fees, funding_fees, margin_rates, long_pos_values, short_pos_values = sim_results
+    return pd.DataFrame({
+        'candle_begin_time': candle_begin_times,
+        'equity': equities,
+        'turnover': turnovers,
+        'fee': fees,
+        'funding_fee': funding_fees,
+        'marginRatio': margin_rates,
+        'long_pos_value': long_pos_values,
+        'short_pos_value': short_pos_values
+    })
+
+
+def build_trade_ledger(records: np.ndarray, candle_begin_times, spot_symbols, swap_symbols) -> pl.DataFrame:
+    """
+    把 TradeLedger 记录的结构化数组转换成成交明细，K 线序号、币种序号替换成时间和币种
+    :param records: TradeLedger.to_array() 的返回值
+    :param candle_begin_times: 开始时间列
+    :param spot_symbols: 现货币种，和模拟时的顺序一致
+    :param swap_symbols: 永续合约币种，和模拟时的顺序一致
+    :return: 每笔成交一行
+    """
+    symbols = np.array(list(spot_symbols) + list(swap_symbols), dtype=object)
+    is_swap = records['market'] == MARKET_SWAP
+    # 合约币种的序号排在现货之后
+    symbol_pos = records['symbol_id'] + np.where(is_swap, len(spot_symbols), 0)
+
+    return pl.DataFrame({
+        'candle_begin_time': pd.DatetimeIndex(candle_begin_times).to_numpy()[records['bar']],
+        'symbol': pl.Series(symbols[symbol_pos].tolist(), dtype=pl.String),
+        'market': pl.Series(np.where(is_swap, 'swap', 'spot').tolist(), dtype=pl.String),
+        'delta_lots': records['delta_lots'],
+        'price': records['price'],
+        'fee': records['fee'],
+    })
+
+
+def _top_ratio_text(n_rows, rows, values, col_pos, names, empty_str, top_n=3):
+    """
+    每一行按照绝对值从大到小取仓位，值相同的时候按照列的顺序（和 pandas 的 idxmax、nlargest 一致）
+    :return: (最大仓位的币种, 前 top_n 名拼接成的 "币种(xx.xx%); ..." 字符串)
+    """
+    order = np.lexsort((col_pos, -np.abs(values), rows))
+    rows, values, names = rows[order], values[order], names[order]
+    ranks = np.arange(len(rows)) - np.searchsorted(rows, rows, side='left')
+
+    top_names = np.full(n_rows, empty_str, dtype=object)
+    top_names[rows[ranks == 0]] = names[ranks == 0]
+
+    keep = ranks < top_n
+    texts = [f"{name}({abs(val) * 100:.2f}%)" for name, val in zip(names[keep], values[keep])]
+    top_texts = pd.Series(texts, index=rows[keep], dtype=object).groupby(level=0).agg('; '.join)
+    return top_names, top_texts.reindex(range(n_rows), fill_value=empty_str).to_numpy()
+
+
+def calc_ratio_stats(spot_ratio: SparseRatio, swap_ratio: SparseRatio, leverage: float) -> pd.DataFrame:
+    """
+    根据稀疏的目标资金占比，统计每个周期的持仓情况
+    :param spot_ratio: 现货目标资金占比
+    :param swap_ratio: 永续合约目标资金占比
+    :param leverage: 杠杆
+    :return: 多空持仓数量、多空最大仓位及对应币种、多空前3名持仓
+    """
+    n_rows = len(spot_ratio)
+    spot_rows, swap_rows = spot_ratio.row_ids(), swap_ratio.row_ids()
+    spot_vals, swap_vals = spot_ratio.data * leverage, swap_ratio.data * leverage
+    spot_names = np.array([f'SPOT_{symbol}' for symbol in spot_ratio.symbols], dtype=object)
+    swap_names = np.array([f'SWAP_{symbol}' for symbol in swap_ratio.symbols], dtype=object)
+
+    stats = pd.DataFrame(index=range(n_rows))
+    stats['symbol_long_num'] = (np.bincount(spot_rows[spot_vals > 0], minlength=n_rows) +
+                                np.bincount(swap_rows[swap_vals > 0], minlength=n_rows))
+    stats['symbol_short_num'] = (np.bincount(spot_rows[spot_vals < 0], minlength=n_rows) +
+                                 np.bincount(swap_rows[swap_vals < 0], minlength=n_rows))
+
+    # 多头：现货多头 + 合约多头，现货排在合约前面
+    spot_mask, swap_mask = spot_vals > 0, swap_vals > 0
+    long_rows = np.concatenate([spot_rows[spot_mask], swap_rows[swap_mask]])
+    long_vals = np.concatenate([spot_vals[spot_mask], swap_vals[swap_mask]])
+    long_pos = np.concatenate([spot_ratio.indices[spot_mask], len(spot_names) + swap_ratio.indices[swap_mask]])
+    long_names = np.concatenate([spot_names[spot_ratio.indices[spot_mask]], swap_names[swap_ratio.indices[swap_mask]]])
+
+    # 空头：合约空头
+    short_mask = swap_vals < 0
+    short_rows, short_vals = swap_rows[short_mask], swap_vals[short_mask]
+    short_pos, short_names = swap_ratio.indices[short_mask], swap_names[swap_ratio.indices[short_mask]]
+
+    long_max = np.zeros(n_rows)
+    np.maximum.at(long_max, long_rows, long_vals)
+    short_min = np.zeros(n_rows)
+    np.minimum.at(short_min, short_rows, short_vals)
+
+    # 前3名持仓（百分比格式），空头按绝对值排序
+    long_symbols, top3_long = _top_ratio_text(n_rows, long_rows, long_vals, long_pos, long_names, 'NO_LONG')
+    short_symbols, top3_short = _top_ratio_text(n_rows, short_rows, short_vals, short_pos, short_names, 'NO_SHORT')
+
+    stats['long_max_ratio'] = long_max
+    stats['long_max_ratio_symbol'] = long_symbols
+    stats['short_max_ratio'] = short_min
+    stats['short_max_ratio_symbol'] = short_symbols
+    stats['short_max_ratio_abs'] = np.abs(short_min)
+    stats['top3_long'] = top3_long
+    stats['top3_short'] = top3_short
+    return stats
+
+
 def show_plot_performance(conf: BacktestConfig, account_df, rtn, year_return, title_prefix='', description=None, **kwargs):
     # 计算仓位比例
     account_df['long_pos_ratio'] = account_df['long_pos_value'] / account_df['equity']
@@ -269,26 +795,48 @@ def read_lot_sizes(path, symbols):
 def align_pivot_dimensions(market_pivot_dict, symbols, candle_begin_times):
     """
     对不同维度的数据进行对齐 (V2 优化: 如果索引已对齐，则只切片列)
+    - 时间是连续的一段时，使用行切片，对于内存映射的 Pivot 数据不会产生拷贝
+    - 币种和 Pivot 的列完全一致时，直接返回，不会产生拷贝
     """
+    times = pd.DatetimeIndex(candle_begin_times)
     res = {}
     for k, df in market_pivot_dict.items():
-        # 检查索引是否完全一致 (时间范围预对齐的情况下，这里会非常快)
-        if len(df) == len(candle_begin_times) and (df.index == candle_begin_times).all():
-            # 检查列是否存在，如果存在则直接切片，否则用 reindex
-            if set(symbols).issubset(df.columns):
-                res[k] = df[symbols]
-            else:
-                res[k] = df.reindex(columns=symbols, fill_value=0)
+        # 时间对齐：先尝试找到连续的一段，使用切片
+        start = df.index.searchsorted(times[0]) if len(times) else 0
+        if start + len(times) <= len(df) and df.index[start:start + len(times)].equals(times):
+            df = df.iloc[start:start + len(times)]
+        else:
+            df = df.loc[times]
+
+        # 币种对齐：检查列是否存在，如果存在则直接切片，否则用 reindex
+        if len(df.columns) == len(symbols) and (df.columns == symbols).all():
+            res[k] = df
+        elif set(symbols).issubset(df.columns):
+            res[k] = df[symbols]
         else:
-            res[k] = df.loc[candle_begin_times, symbols]
+            res[k] = df.reindex(columns=symbols, fill_value=0)
     return res
 
 
+@nb.njit
+def fill_ratio_row(ratio_row, indptr, indices, data, prev_i, i):
+    """
+    把 CSR 格式的第 i 行写入目标资金占比，只会清空上一次写入（第 prev_i 行）的非零位置
+    """
+    if prev_i >= 0:
+        for k in range(indptr[prev_i], indptr[prev_i + 1]):
+            ratio_row[indices[k]] = 0.
+    for k in range(indptr[i], indptr[i + 1]):
+        ratio_row[indices[k]] = data[k]
+
+
 @nb.jit(nopython=True, nogil=True, boundscheck=True)
 def start_simulation(init_capital, leverages, spot_lot_sizes, swap_lot_sizes, spot_c_rate, swap_c_rate,
-                     spot_min_order_limit, swap_min_order_limit, min_margin_rate, spot_ratio, swap_ratio,
+                     spot_min_order_limit, swap_min_order_limit, min_margin_rate,
+                     spot_ratio_indptr, spot_ratio_indices, spot_ratio_data,
+                     swap_ratio_indptr, swap_ratio_indices, swap_ratio_data,
                      spot_open_p, spot_close_p, spot_vwap1m_p, swap_open_p, swap_close_p, swap_vwap1m_p,
-                     funding_rates, pos_calc, require_rebalance):
+                     funding_rates, pos_calc, require_rebalance, ledger=None):
     """
     模拟交易
     :param init_capital: 初始资金
@@ -300,8 +848,12 @@ def start_simulation(init_capital, leverages, spot_lot_sizes, swap_lot_sizes, sp
     :param spot_min_order_limit: spot 现货最小下单金额
     :param swap_min_order_limit: swap 合约最小下单金额
     :param min_margin_rate: 维持保证金率
-    :param spot_ratio: spot 的仓位透视表 (numpy 矩阵)
-    :param swap_ratio: swap 的仓位透视表 (numpy 矩阵)
+    :param spot_ratio_indptr: spot 的仓位透视表 (CSR 格式的行指针)
+    :param spot_ratio_indices: spot 的仓位透视表 (CSR 格式的列号)
+    :param spot_ratio_data: spot 的仓位透视表 (CSR 格式的非零值)
+    :param swap_ratio_indptr: swap 的仓位透视表 (CSR 格式的行指针)
+    :param swap_ratio_indices: swap 的仓位透视表 (CSR 格式的列号)
+    :param swap_ratio_data: swap 的仓位透视表 (CSR 格式的非零值)
     :param spot_open_p: spot 的开仓价格透视表 (numpy 矩阵)
     :param spot_close_p: spot 的平仓价格透视表 (numpy 矩阵)
     :param spot_vwap1m_p: spot 的 vwap1m 价格透视表 (numpy 矩阵)
@@ -311,20 +863,19 @@ def start_simulation(init_capital, leverages, spot_lot_sizes, swap_lot_sizes, sp
     :param funding_rates: swap 的 funding rate 透视表 (numpy 矩阵)
     :param pos_calc: 仓位计算
     :param require_rebalance: 是否需要调仓
+    :param ledger: 成交明细 TradeLedger，None 表示不记录
     :return:
     """
     # ====================================================================================================
     # 1. 初始化回测空间
     # 设置几个固定长度的数组变量，并且重置为0，到时候每一个周期的数据，都按照index的顺序，依次填充进去
     # ====================================================================================================
-    n_bars = spot_ratio.shape[0]
-    n_syms_spot = spot_ratio.shape[1]
-    n_syms_swap = swap_ratio.shape[1]
+    n_bars = len(spot_ratio_indptr) - 1
+    n_syms_spot = len(spot_lot_sizes)
+    n_syms_swap = len(swap_lot_sizes)
 
     start_lots_spot = np.zeros(n_syms_spot, dtype=np.int64)
     start_lots_swap = np.zeros(n_syms_swap, dtype=np.int64)
-    # 现货不设置资金费
-    funding_rates_spot = np.zeros(n_syms_spot, dtype=np.float64)
 
     turnovers = np.zeros(n_bars, dtype=np.float64)
     fees = np.zeros(n_bars, dtype=np.float64)
@@ -337,11 +888,58 @@ def start_simulation(init_capital, leverages, spot_lot_sizes, swap_lot_sizes, sp
     # ====================================================================================================
     # 2. 初始化模拟对象
     # ====================================================================================================
-    sim_spot = Simulator(init_capital, spot_lot_sizes, spot_c_rate, start_lots_spot, spot_min_order_limit)
-    sim_swap = Simulator(0, swap_lot_sizes, swap_c_rate, start_lots_swap, swap_min_order_limit)
+    if ledger is None:
+        trade_ledger = TradeLedger(False, 0)
+    else:
+        trade_ledger = ledger
+    sim_spot = Simulator(init_capital, spot_lot_sizes, spot_c_rate, start_lots_spot, spot_min_order_limit,
+                         trade_ledger, MARKET_SPOT)
+    sim_swap = Simulator(0, swap_lot_sizes, swap_c_rate, start_lots_swap, swap_min_order_limit,
+                         trade_ledger, MARKET_SWAP)
 
     # ====================================================================================================
     # 3. 开始回测
+    # ====================================================================================================
+    run_simulation(sim_spot, sim_swap, 0, n_bars, leverages, min_margin_rate,
+                   spot_ratio_indptr, spot_ratio_indices, spot_ratio_data,
+                   swap_ratio_indptr, swap_ratio_indices, swap_ratio_data,
+                   spot_open_p, spot_close_p, spot_vwap1m_p, swap_open_p, swap_close_p, swap_vwap1m_p,
+                   funding_rates, pos_calc, require_rebalance,
+                   equities, turnovers, fees, funding_fees, margin_rates, long_pos_values, short_pos_values)
+
+    return equities, turnovers, fees, funding_fees, margin_rates, long_pos_values, short_pos_values
+
+
+@nb.jit(nopython=True, nogil=True, boundscheck=True)
+def run_simulation(sim_spot, sim_swap, start, end, leverages, min_margin_rate,
+                   spot_ratio_indptr, spot_ratio_indices, spot_ratio_data,
+                   swap_ratio_indptr, swap_ratio_indices, swap_ratio_data,
+                   spot_open_p, spot_close_p, spot_vwap1m_p, swap_open_p, swap_close_p, swap_vwap1m_p,
+                   funding_rates, pos_calc, require_rebalance,
+                   equities, turnovers, fees, funding_fees, margin_rates, long_pos_values, short_pos_values):
+    """
+    从第 start 根 K 线模拟到第 end 根（不含），结果写入传入的数组。
+    模拟器的状态保存在 sim_spot、sim_swap 中，分几段调用和一次模拟到底的结果完全一致
+    :param sim_spot: 现货模拟器
+    :param sim_swap: 合约模拟器
+    :param start: 开始的 K 线
+    :param end: 结束的 K 线（不含）
+    :param equities: 输出，账户权益，以下均为输出
+    其余参数和 start_simulation 一致
+    :return: 是否爆仓
+    """
+    n_syms_spot = len(sim_spot.lots)
+    n_syms_swap = len(sim_swap.lots)
+
+    # 现货不设置资金费
+    funding_rates_spot = np.zeros(n_syms_spot, dtype=np.float64)
+
+    # 当前的目标资金占比，调仓的时候只更新非零的位置
+    spot_ratio = np.zeros(n_syms_spot, dtype=np.float64)
+    swap_ratio = np.zeros(n_syms_swap, dtype=np.float64)
+    last_rebalance_i = -1
+
+    # ====================================================================================================
     # 每次循环包含以下四个步骤：
     # 1. 模拟开盘on_open
     # 2. 模拟执行on_execution
@@ -355,15 +953,14 @@ def start_simulation(init_capital, leverages, spot_lot_sizes, swap_lot_sizes, sp
     # tN: on_open -> on_execution -> on_close -> set_target_lots
     # 并且在每一个t时刻，都会记录账户的截面数据，包括equity，funding_fee，margin_rate，等等
     # ====================================================================================================
-    #
-    for i in range(n_bars):
+    for i in range(start, end):
         """1. 模拟开盘on_open"""
         # 根据开盘价格，计算账户权益，当前持仓的名义价值，以及资金费
         equity_spot, _, pos_value_spot = sim_spot.on_open(spot_open_p[i], funding_rates_spot, spot_open_p[i])
         equity_swap, funding_fee, pos_value_swap = sim_swap.on_open(swap_open_p[i], funding_rates[i], swap_open_p[i])
 
-        # 当前持仓的名义价值
-        position_val = np.sum(np.abs(pos_value_spot)) + np.sum(np.abs(pos_value_swap))
+        # 当前持仓的名义价值（on_open 返回的是各自仓位名义价值的绝对值之和）
+        position_val = pos_value_spot + pos_value_swap
         if position_val < 1e-8:
             # 没有持仓
             margin_rate = 10000.0
@@ -373,23 +970,20 @@ def start_simulation(init_capital, leverages, spot_lot_sizes, swap_lot_sizes, sp
         # 当前保证金率小于维持保证金率，爆仓 💀
         if margin_rate < min_margin_rate:
             margin_rates[i] = margin_rate
-            break
+            return True
 
         """2. 模拟开仓on_execution"""
         # 根据开仓价格，计算账户权益，换手，手续费
-        equity_spot, turnover_spot, fee_spot = sim_spot.on_execution(spot_vwap1m_p[i])
-        equity_swap, turnover_swap, fee_swap = sim_swap.on_execution(swap_vwap1m_p[i])
+        equity_spot, turnover_spot, fee_spot = sim_spot.on_execution(spot_vwap1m_p[i], i)
+        equity_swap, turnover_swap, fee_swap = sim_swap.on_execution(swap_vwap1m_p[i], i)
 
         """3. 模拟K线结束on_close"""
         # 根据收盘价格，计算账户权益
-        equity_spot_close, pos_value_spot_close = sim_spot.on_close(spot_close_p[i])
-        equity_swap_close, pos_value_swap_close = sim_swap.on_close(swap_close_p[i])
+        equity_spot_close, long_value_spot, short_value_spot = sim_spot.on_close(spot_close_p[i])
+        equity_swap_close, long_value_swap, short_value_swap = sim_swap.on_close(swap_close_p[i])
 
-        long_pos_value = (np.sum(pos_value_spot_close[pos_value_spot_close > 0]) +
-                          np.sum(pos_value_swap_close[pos_value_swap_close > 0]))
-
-        short_pos_value = -(np.sum(pos_value_spot_close[pos_value_spot_close < 0]) +
-                            np.sum(pos_value_swap_close[pos_value_swap_close < 0]))
+        long_pos_value = long_value_spot + long_value_swap
+        short_pos_value = -(short_value_spot + short_value_swap)
 
         # 把中间结果更新到之前初始化的空间
         funding_fees[i] = funding_fee
@@ -406,11 +1000,109 @@ def start_simulation(init_capital, leverages, spot_lot_sizes, swap_lot_sizes, sp
         """4. 计算目标持仓"""
         # 并不是所有的时间点都需要计算目标持仓，比如D持仓下，只需要在23点更新0点的目标持仓
         if require_rebalance[i] == 1:
+            fill_ratio_row(spot_ratio, spot_ratio_indptr, spot_ratio_indices, spot_ratio_data, last_rebalance_i, i)
+            fill_ratio_row(swap_ratio, swap_ratio_indptr, swap_ratio_indices, swap_ratio_data, last_rebalance_i, i)
+            last_rebalance_i = i
+
             target_lots_spot, target_lots_swap = pos_calc.calc_lots(equity_leveraged, spot_close_p[i], sim_spot.lots,
-                                                                    spot_ratio[i], swap_close_p[i], sim_swap.lots,
-                                                                    swap_ratio[i])
+                                                                    spot_ratio, swap_close_p[i], sim_swap.lots,
+                                                                    swap_ratio)
             # 更新目标持仓
             sim_spot.set_target_lots(target_lots_spot)
             sim_swap.set_target_lots(target_lots_swap)
 
+    return False
+
+
+@nb.njit(parallel=True, nogil=True)
+def start_simulation_batch(init_capitals, leverages, spot_lot_sizes, swap_lot_sizes, spot_c_rate, swap_c_rate,
+                           spot_min_order_limit, swap_min_order_limit, min_margin_rate,
+                           spot_ratio_indptr, spot_ratio_indices, spot_ratio_data,
+                           swap_ratio_indptr, swap_ratio_indices, swap_ratio_data,
+                           spot_open_p, spot_close_p, spot_vwap1m_p, swap_open_p, swap_close_p, swap_vwap1m_p,
+                           funding_rates, pos_calc, require_rebalance):
+    """
+    批量模拟交易，K 个账户共用同一份行情数据，每个账户一个线程
+    :param init_capitals: 每个账户的初始资金，长度为 K
+    :param leverages: 每个账户的杠杆，(K × 周期数) 的矩阵
+    :param spot_ratio_indptr: spot 的仓位透视表 (K × 周期数+1 的 CSR 行指针，指向拼接后的 indices/data)
+    :param spot_ratio_indices: spot 的仓位透视表 (所有账户拼接后的 CSR 列号)
+    :param spot_ratio_data: spot 的仓位透视表 (所有账户拼接后的 CSR 非零值)
+    :param swap_ratio_indptr: swap 的仓位透视表 (K × 周期数+1 的 CSR 行指针，指向拼接后的 indices/data)
+    :param swap_ratio_indices: swap 的仓位透视表 (所有账户拼接后的 CSR 列号)
+    :param swap_ratio_data: swap 的仓位透视表 (所有账户拼接后的 CSR 非零值)
+    其余参数和 start_simulation 一致
+    :return: 和 start_simulation 一致，每一项都是 (K × 周期数) 的矩阵
+    """
+    n_batch, n_bars = leverages.shape
+
+    equities = np.zeros((n_batch, n_bars), dtype=np.float64)
+    turnovers = np.zeros((n_batch, n_bars), dtype=np.float64)
+    fees = np.zeros((n_batch, n_bars), dtype=np.float64)
+    funding_fees = np.zeros((n_batch, n_bars), dtype=np.float64)
+    margin_rates = np.zeros((n_batch, n_bars), dtype=np.float64)
+    long_pos_values = np.zeros((n_batch, n_bars), dtype=np.float64)
+    short_pos_values = np.zeros((n_batch, n_bars), dtype=np.float64)
+
+    for k in nb.prange(n_batch):
+        res = start_simulation(init_capitals[k], leverages[k], spot_lot_sizes, swap_lot_sizes, spot_c_rate,
+                               swap_c_rate, spot_min_order_limit, swap_min_order_limit, min_margin_rate,
+                               spot_ratio_indptr[k], spot_ratio_indices, spot_ratio_data,
+                               swap_ratio_indptr[k], swap_ratio_indices, swap_ratio_data,
+                               spot_open_p, spot_close_p, spot_vwap1m_p, swap_open_p, swap_close_p, swap_vwap1m_p,
+                               funding_rates, pos_calc, require_rebalance)
+        equities[k] = res[0]
+        turnovers[k] = res[1]
+        fees[k] = res[2]
+        funding_fees[k] = res[3]
+        margin_rates[k] = res[4]
+        long_pos_values[k] = res[5]
+        short_pos_values[k] = res[6]
+
+    return equities, turnovers, fees, funding_fees, margin_rates, long_pos_values, short_pos_values
+
+
+@nb.njit(parallel=True, nogil=True)
+def start_simulation_sweep(init_capital, leverages, spot_lot_sizes, swap_lot_sizes, spot_c_rates, swap_c_rates,
+                           spot_min_order_limits, swap_min_order_limits, min_margin_rates,
+                           spot_ratio_indptr, spot_ratio_indices, spot_ratio_data,
+                           swap_ratio_indptr, swap_ratio_indices, swap_ratio_data,
+                           spot_open_p, spot_close_p, spot_vwap1m_p, swap_open_p, swap_close_p, swap_vwap1m_p,
+                           funding_rates, pos_calc, require_rebalance):
+    """
+    交易参数敏感性分析，同一组目标资金占比和行情数据，K 组交易参数，每组参数一个线程
+    :param leverages: 每组参数的杠杆，(K × 周期数) 的矩阵
+    :param spot_c_rates: 每组参数的现货手续费率，长度为 K
+    :param swap_c_rates: 每组参数的合约手续费率，长度为 K
+    :param spot_min_order_limits: 每组参数的现货最小下单金额，长度为 K
+    :param swap_min_order_limits: 每组参数的合约最小下单金额，长度为 K
+    :param min_margin_rates: 每组参数的维持保证金率，长度为 K
+    其余参数和 start_simulation 一致
+    :return: 和 start_simulation 一致，每一项都是 (K × 周期数) 的矩阵
+    """
+    n_batch, n_bars = leverages.shape
+
+    equities = np.zeros((n_batch, n_bars), dtype=np.float64)
+    turnovers = np.zeros((n_batch, n_bars), dtype=np.float64)
+    fees = np.zeros((n_batch, n_bars), dtype=np.float64)
+    funding_fees = np.zeros((n_batch, n_bars), dtype=np.float64)
+    margin_rates = np.zeros((n_batch, n_bars), dtype=np.float64)
+    long_pos_values = np.zeros((n_batch, n_bars), dtype=np.float64)
+    short_pos_values = np.zeros((n_batch, n_bars), dtype=np.float64)
+
+    for k in nb.prange(n_batch):
+        res = start_simulation(init_capital, leverages[k], spot_lot_sizes, swap_lot_sizes, spot_c_rates[k],
+                               swap_c_rates[k], spot_min_order_limits[k], swap_min_order_limits[k],
+                               min_margin_rates[k], spot_ratio_indptr, spot_ratio_indices, spot_ratio_data,
+                               swap_ratio_indptr, swap_ratio_indices, swap_ratio_data,
+                               spot_open_p, spot_close_p, spot_vwap1m_p, swap_open_p, swap_close_p, swap_vwap1m_p,
+                               funding_rates, pos_calc, require_rebalance)
+        equities[k] = res[0]
+        turnovers[k] = res[1]
+        fees[k] = res[2]
+        funding_fees[k] = res[3]
+        margin_rates[k] = res[4]
+        long_pos_values[k] = res[5]
+        short_pos_values[k] = res[6]
+
     return equities, turnovers, fees, funding_fees, margin_rates, long_pos_values, short_pos_values
@@ -9,11 +9,20 @@
 
 Author: 邢不行
 """
-from typing import Dict
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, List
 
 import numpy as np
+import pandas as pd
+import polars as pl
 
 from core.utils.factor_hub import FactorHub
+from core.utils.factor_store import append_factor_store, load_factor_store
+
+# 因子仓库尾部K线校验，除了预热长度之外，额外校验的K线数量
+CHECK_TAIL_NUM = 24
 
 
 def calc_factor_vals(candle_df, factor_name, factor_param_list, shift=0) -> Dict[str, np.ndarray]:
@@ -49,3 +58,395 @@ def calc_factor_vals(candle_df, factor_name, factor_param_list, shift=0) -> Dict
             legacy_candle_df = factor.signal(legacy_candle_df, param, factor_col_name)
             factor_series_dict[factor_col_name] = legacy_candle_df[factor_col_name].shift(shift).values
     return factor_series_dict
+
+
+def get_factor_lookback(factor, param) -> int | None:
+    """
+    获取因子的回看长度，也就是计算一根K线的因子值，需要往前多少根K线的数据
+    :param factor: 因子
+    :param param: 因子参数
+    :return: 回看长度，None 表示因子没有声明，需要全部历史数据
+    """
+    if not hasattr(factor, 'get_lookback'):
+        return None
+    return max(int(factor.get_lookback(param)), 0)
+
+
+def get_candle_check(candle_df, end, warmup) -> dict:
+    """
+    因子仓库的尾部K线校验：最后 预热长度 + CHECK_TAIL_NUM 根K线的 close、volume 摘要
+    :param candle_df: 一个币种的k线数据
+    :param end: 校验到第几行（不包含），也就是因子仓库中的数据行数
+    :param warmup: 预热长度，None 表示因子依赖全部历史数据，只校验尾部
+    :return: {'start': 开始行号, 'end': 结束行号, 'digest': 摘要}
+    """
+    start = max(end - (warmup or 0) - CHECK_TAIL_NUM, 0)
+    digest = hashlib.md5()
+    for col in ('close', 'volume'):
+        if col in candle_df.columns:
+            digest.update(np.ascontiguousarray(candle_df[col].values[start:end], dtype=np.float64).tobytes())
+    return dict(start=start, end=end, digest=digest.hexdigest())
+
+
+def calc_factor_vals_incremental(candle_df, factor_name, factor_param_list, period_type='H') -> Dict[str, np.ndarray]:
+    """
+    增量计算因子值：已经计算过的部分从因子仓库读取，只计算新增的尾部数据，并追加写入因子仓库
+    :param candle_df:   一个币种的k线数据 dataframe（只读，不会修改的哦）
+    :param factor_name: 因子名称
+    :param factor_param_list: 因子参数
+    :param period_type: 周期类型，H：小时，D：日线
+    :return: 因子值，和 candle_df 的行一一对应
+    """
+    stored_dict, start = load_factor_vals_stored(candle_df, factor_name, factor_param_list, period_type)
+
+    # 只计算仓库中缺失的部分
+    calc_dict = {}
+    if start < len(candle_df):
+        calc_df = candle_df if start == 0 else candle_df.iloc[start:].reset_index(drop=True)
+        calc_param_list = [param for param in factor_param_list
+                           if len(stored_dict.get(param, [])) < len(candle_df)]
+        calc_dict = calc_factor_vals(calc_df, factor_name, calc_param_list)
+
+    return merge_factor_vals_stored(candle_df, factor_name, factor_param_list, stored_dict, start, calc_dict,
+                                    period_type)
+
+
+def load_factor_vals_stored(candle_df, factor_name, factor_param_list, period_type='H'):
+    """
+    读取因子仓库中已经计算好、并且和当前K线完全对齐的历史数据，并确定需要从哪一行开始计算
+    :param candle_df:   一个币种的k线数据
+    :param factor_name: 因子名称
+    :param factor_param_list: 因子参数
+    :param period_type: 周期类型，H：小时，D：日线
+    :return: (每个参数已经计算好的因子值, 开始计算的行号)，所有参数都不需要计算时，开始行号等于K线数量
+    """
+    symbol = candle_df['symbol'].iloc[0]
+    is_spot = candle_df['is_spot'].iloc[0]
+    candle_times = candle_df['candle_begin_time'].values
+    first_candle = candle_times[0]
+    factor = FactorHub.get_by_name(factor_name)
+    fingerprint = FactorHub.get_fingerprint(factor_name)
+
+    stored_dict = {}
+    for param in factor_param_list:
+        stored = load_factor_store(f'{factor_name}_{param}', symbol, is_spot, first_candle, fingerprint, period_type)
+        if stored is None:
+            continue
+        stored_times, stored_vals, meta = stored
+        stored_num = min(len(stored_times), len(candle_times))
+        if not np.array_equal(stored_times[:stored_num], candle_times[:stored_num]):
+            continue
+        # K线时间没有变化，但是数据可能被修正过，尾部K线的内容不一致时，整个分区重算
+        check = meta.get('check')
+        if check is None or check['end'] > len(candle_df) or \
+                get_candle_check(candle_df, check['end'], meta.get('warmup')) != check:
+            continue
+        stored_dict[param] = stored_vals[:stored_num]
+
+    calc_param_list = [param for param in factor_param_list if len(stored_dict.get(param, [])) < len(candle_df)]
+    if not calc_param_list:
+        return stored_dict, len(candle_df)
+
+    # 预热长度：计算尾部数据时需要往前多取的K线数量，因子没有声明 get_lookback 的时候，需要从头开始计算
+    warmup_list = [get_factor_lookback(factor, param) for param in calc_param_list]
+    if None in warmup_list:
+        return stored_dict, 0
+    # 只需要截取 预热长度 + 新增数据 进行计算
+    stored_num = min(len(stored_dict.get(param, [])) for param in calc_param_list)
+    return stored_dict, max(stored_num - max(warmup_list), 0)
+
+
+def merge_factor_vals_stored(candle_df, factor_name, factor_param_list, stored_dict, start, calc_dict,
+                             period_type='H', store_list=None) -> Dict[str, np.ndarray]:
+    """
+    拼接仓库中的历史数据和新计算的数据，新数据追加写入因子仓库
+    :param candle_df:   一个币种的k线数据
+    :param factor_name: 因子名称
+    :param factor_param_list: 因子参数
+    :param stored_dict: load_factor_vals_stored 读取的历史数据
+    :param start: calc_dict 中因子值对应的开始行号，不能大于 load_factor_vals_stored 返回的开始行号
+    :param calc_dict: 从 start 行开始计算的因子值
+    :param period_type: 周期类型，H：小时，D：日线
+    :param store_list: 不为空时，先不写入因子仓库，写入操作追加到列表中，由 flush_factor_store 执行
+    :return: 因子值，和 candle_df 的行一一对应
+    """
+    symbol = candle_df['symbol'].iloc[0]
+    is_spot = candle_df['is_spot'].iloc[0]
+    candle_times = candle_df['candle_begin_time'].values
+    first_candle = candle_times[0]
+    factor = FactorHub.get_by_name(factor_name)
+    fingerprint = FactorHub.get_fingerprint(factor_name)
+
+    # 日线数据是小时数据转换的，最后一根日线可能还不完整，不写入仓库
+    sealed_num = len(candle_df) - 1 if period_type == 'D' else len(candle_df)
+
+    factor_series_dict = {}
+    for param in factor_param_list:
+        factor_col_name = f'{factor_name}_{param}'
+        stored_vals = stored_dict.get(param)
+        stored_num = 0 if stored_vals is None else len(stored_vals)
+        if stored_num >= len(candle_df):
+            factor_series_dict[factor_col_name] = stored_vals
+            continue
+
+        if stored_num > 0:
+            factor_vals = np.concatenate([stored_vals, calc_dict[factor_col_name][stored_num - start:]])
+        else:
+            factor_vals = calc_dict[factor_col_name]
+        factor_series_dict[factor_col_name] = factor_vals
+
+        if sealed_num > stored_num:
+            warmup = get_factor_lookback(factor, param)
+            store_func = partial(append_factor_store, factor_col_name, symbol, is_spot,
+                                 candle_times[stored_num:sealed_num], factor_vals[stored_num:sealed_num],
+                                 first_candle, fingerprint, warmup=warmup, period_type=period_type,
+                                 overwrite=stored_num == 0, check=get_candle_check(candle_df, sealed_num, warmup))
+            if store_list is None:
+                store_func()
+            else:
+                store_list.append(store_func)
+    return factor_series_dict
+
+
+def flush_factor_store(store_list):
+    """
+    执行 merge_factor_vals_stored 延后的因子仓库写入
+    :param store_list: 延后的写入操作
+    """
+    for store_func in store_list:
+        store_func()
+    store_list.clear()
+
+
+class CandlePanel:
+    """
+    所有币种的K线面板数据，给因子的 signal_panel 使用
+
+    每一列是一个币种，按照该币种自己的K线顺序从上往下排列（左对齐），数据短的币种尾部用 NaN 填充。
+    这样沿着列方向的 rolling/shift 和单币种计算的结果完全一致，不会受到停牌、缺失K线的影响。
+
+    panel['close']              ->  (最大K线数量 × 币种数量) 的 ndarray，按需生成并缓存
+    panel.symbols               ->  每一列对应的币种
+    panel.lengths               ->  每一列的有效K线数量
+    """
+
+    def __init__(self, candle_df_list: List[pd.DataFrame]):
+        self.candle_df_list = candle_df_list
+        self.symbols = np.array([candle_df['symbol'].iloc[0] for candle_df in candle_df_list])
+        self.lengths = np.array([len(candle_df) for candle_df in candle_df_list], dtype=np.int64)
+        self.row_num = int(self.lengths.max()) if len(self.lengths) else 0
+        self._field_cache = {}
+
+    def __getitem__(self, field) -> np.ndarray:
+        if field not in self._field_cache:
+            # 使用列优先的存储，每一个币种的数据在内存中是连续的
+            mat = np.full((self.row_num, len(self.candle_df_list)), np.nan, order='F')
+            for col_idx, candle_df in enumerate(self.candle_df_list):
+                mat[:self.lengths[col_idx], col_idx] = candle_df[field].values
+            self._field_cache[field] = mat
+        return self._field_cache[field]
+
+    def __contains__(self, field):
+        return len(self.candle_df_list) > 0 and field in self.candle_df_list[0].columns
+
+    def __len__(self):
+        return len(self.candle_df_list)
+
+
+def has_signal_panel(factor) -> bool:
+    """
+    是否可以使用面板计算：需要实现 signal_panel，并且不依赖外部数据
+    """
+    return hasattr(factor, 'signal_panel') and not factor.is_cross and not getattr(factor, 'extra_data_dict', None)
+
+
+def calc_panel_factors(panel: CandlePanel, factor_params_dict, factor_col_name_list,
+                       panel_factor_list=None) -> List[Dict[str, np.ndarray]]:
+    """
+    使用因子的 signal_panel 一次性计算所有币种的因子值
+    :param panel: K线面板数据
+    :param factor_params_dict: 因子及参数
+    :param factor_col_name_list: 需要计算的因子列
+    :param panel_factor_list: 其他方式已经计算好的因子值，已经存在的因子列不再重复计算
+    :return: 和 panel 的列一一对应的列表，每个元素是 {'candle_begin_time': 时间, 因子列名: 因子值}
+    """
+    if panel_factor_list is None:
+        panel_factor_list = [{'candle_begin_time': candle_df['candle_begin_time'].values}
+                             for candle_df in panel.candle_df_list]
+    for factor_name, param_list in factor_params_dict.items():
+        factor = FactorHub.get_by_name(factor_name)
+        if not has_signal_panel(factor):
+            continue
+
+        factor_param_list = [param for param in param_list if f'{factor_name}_{param}' in factor_col_name_list and
+                             f'{factor_name}_{param}' not in panel_factor_list[0]]
+        if len(factor_param_list) == 0:
+            continue
+
+        result_dict = factor.signal_panel(panel, factor_param_list)
+        for param, factor_mat in result_dict.items():
+            factor_mat = np.asfortranarray(factor_mat, dtype=np.float64)
+            for col_idx, panel_factor_dict in enumerate(panel_factor_list):
+                # 拷贝一份，释放面板结果的内存
+                panel_factor_dict[f'{factor_name}_{param}'] = factor_mat[:panel.lengths[col_idx], col_idx].copy()
+    return panel_factor_list
+
+
+def calc_factors_incremental(candle_df_list: List[pd.DataFrame], factor_params_dict, calc_func,
+                             panel_factor_list=None, period_type='H', job_num=1,
+                             store_list=None) -> List[Dict[str, np.ndarray]]:
+    """
+    所有币种一起计算因子时的增量计算：和 calc_factor_vals_incremental 一样，已经计算过的部分从因子仓库读取，
+    每个币种只计算 预热长度 + 新增数据，计算结果追加写入因子仓库
+    :param candle_df_list: 所有币种的K线数据
+    :param factor_params_dict: 需要计算的因子及参数
+    :param calc_func: 计算函数 calc_func(calc_idx_list, start_list, calc_dict_list)，
+                      计算 candle_df_list[idx] 从 start_list[idx] 行开始的因子值，写入 calc_dict_list[idx]
+    :param panel_factor_list: 其他方式已经计算好的因子值，计算结果会更新到里面
+    :param period_type: 周期类型，H：小时，D：日线
+    :param job_num: 读写因子仓库的线程数
+    :param store_list: 和 candle_df_list 一一对应的列表，不为空时因子仓库的写入延后到各自的列表中，
+                       由调用方确认因子值被使用之后再用 flush_factor_store 写入
+    :return: 和 candle_df_list 一一对应的列表，每个元素是 {'candle_begin_time': 时间, 因子列名: 因子值}
+    """
+    if panel_factor_list is None:
+        panel_factor_list = [{'candle_begin_time': candle_df['candle_begin_time'].values}
+                             for candle_df in candle_df_list]
+    if not factor_params_dict:
+        return panel_factor_list
+
+    # 1. 读取因子仓库，每个币种从所有因子中最早需要计算的位置开始截取
+    def _load_stored(candle_df):
+        return {factor_name: load_factor_vals_stored(candle_df, factor_name, param_list, period_type)
+                for factor_name, param_list in factor_params_dict.items()}
+
+    with ThreadPoolExecutor(max_workers=job_num) as executor:
+        stored_list = list(executor.map(_load_stored, candle_df_list))
+    start_list = [min(start for _, start in stored.values()) for stored in stored_list]
+
+    # 2. 只计算有新增数据的币种
+    calc_idx_list = [idx for idx, candle_df in enumerate(candle_df_list) if start_list[idx] < len(candle_df)]
+    calc_dict_list = [{} for _ in candle_df_list]
+    if calc_idx_list:
+        calc_func(calc_idx_list, start_list, calc_dict_list)
+
+    # 3. 拼接历史数据和新数据，新数据追加写入因子仓库
+    def _merge_stored(idx):
+        for factor_name, param_list in factor_params_dict.items():
+            stored_dict, _ = stored_list[idx][factor_name]
+            panel_factor_list[idx].update(merge_factor_vals_stored(
+                candle_df_list[idx], factor_name, param_list, stored_dict, start_list[idx], calc_dict_list[idx],
+                period_type, None if store_list is None else store_list[idx]))
+
+    with ThreadPoolExecutor(max_workers=job_num) as executor:
+        list(executor.map(_merge_stored, range(len(candle_df_list))))
+    return panel_factor_list
+
+
+def calc_panel_factors_incremental(candle_df_list: List[pd.DataFrame], factor_params_dict, factor_col_name_list,
+                                   panel_factor_list=None, period_type='H', job_num=1,
+                                   store_list=None) -> List[Dict[str, np.ndarray]]:
+    """
+    面板因子的增量计算，面板只包含每个币种的 预热长度 + 新增数据
+    :param candle_df_list: 所有币种的K线数据
+    :param factor_params_dict: 因子及参数
+    :param factor_col_name_list: 需要计算的因子列
+    :param panel_factor_list: 其他方式已经计算好的因子值，已经存在的因子列不再重复计算
+    :param period_type: 周期类型，H：小时，D：日线
+    :param job_num: 读写因子仓库的线程数
+    :param store_list: 延后的因子仓库写入，参考 calc_factors_incremental
+    :return: 和 candle_df_list 一一对应的列表，每个元素是 {'candle_begin_time': 时间, 因子列名: 因子值}
+    """
+    computed_cols = panel_factor_list[0].keys() if panel_factor_list else ()
+    panel_params_dict = {}
+    for factor_name, param_list in factor_params_dict.items():
+        if not has_signal_panel(FactorHub.get_by_name(factor_name)):
+            continue
+        factor_param_list = [param for param in param_list if f'{factor_name}_{param}' in factor_col_name_list and
+                             f'{factor_name}_{param}' not in computed_cols]
+        if factor_param_list:
+            panel_params_dict[factor_name] = factor_param_list
+
+    def _calc_panel(calc_idx_list, start_list, calc_dict_list):
+        panel = CandlePanel([candle_df_list[idx].iloc[start_list[idx]:].reset_index(drop=True)
+                             for idx in calc_idx_list])
+        calc_panel_factors(panel, panel_params_dict, factor_col_name_list, [calc_dict_list[idx] for idx in calc_idx_list])
+
+    return calc_factors_incremental(candle_df_list, panel_params_dict, _calc_panel, panel_factor_list, period_type,
+                                    job_num, store_list)
+
+
+def has_signal_expr(factor) -> bool:
+    """
+    是否可以使用 polars 表达式计算：需要实现 signal_expr，并且不依赖外部数据
+    """
+    return hasattr(factor, 'signal_expr') and not factor.is_cross and not getattr(factor, 'extra_data_dict', None)
+
+
+def calc_expr_factors(candle_pq_path, factor_params_dict, factor_col_name_list,
+                      start_dict=None) -> Dict[str, Dict[str, np.ndarray]]:
+    """
+    收集所有因子的 polars 表达式，在一个 lazy 查询中按币种分组计算，由 polars 多线程执行
+    :param candle_pq_path: 全量K线数据 all_candle_data.parquet
+    :param factor_params_dict: 因子及参数
+    :param factor_col_name_list: 需要计算的因子列
+    :param start_dict: 每个币种开始计算的行号，只计算其中的币种，为空则从头计算所有币种
+    :return: 币种 -> {'candle_begin_time': 时间, 因子列名: 因子值}，因子值从开始计算的行号开始
+    """
+    expr_list = []
+    for factor_name, param_list in factor_params_dict.items():
+        factor = FactorHub.get_by_name(factor_name)
+        if not has_signal_expr(factor):
+            continue
+        for param in param_list:
+            factor_col_name = f'{factor_name}_{param}'
+            if factor_col_name in factor_col_name_list:
+                expr_list.append(factor.signal_expr(param).cast(pl.Float64).over('symbol').alias(factor_col_name))
+
+    lf = pl.scan_parquet(candle_pq_path)
+    if start_dict is not None:
+        # 按照每个币种自己的行号截取，K线顺序和 partition_by("symbol") 的分组一致
+        start_df = pl.LazyFrame({'symbol': list(start_dict.keys()), '_start': list(start_dict.values())},
+                                schema_overrides={'_start': pl.Int64})
+        lf = lf.with_columns(pl.int_range(pl.len(), dtype=pl.Int64).over('symbol').alias('_row')).join(
+            start_df.with_columns(pl.col('symbol').cast(lf.collect_schema()['symbol'])), on='symbol',
+            maintain_order='left').filter(pl.col('_row') >= pl.col('_start'))
+    factor_df = lf.select('symbol', 'candle_begin_time', *expr_list).collect()
+
+    expr_factor_dict = {}
+    for (symbol,), group in factor_df.partition_by('symbol', maintain_order=True, as_dict=True).items():
+        expr_factor_dict[symbol] = {col: group[col].to_numpy() for col in group.columns if col != 'symbol'}
+    return expr_factor_dict
+
+
+def calc_expr_factors_incremental(candle_df_list: List[pd.DataFrame], candle_pq_path, factor_params_dict,
+                                  factor_col_name_list, period_type='H', job_num=1,
+                                  store_list=None) -> List[Dict[str, np.ndarray]]:
+    """
+    polars 表达式因子的增量计算，每个币种只截取 预热长度 + 新增数据 进行计算
+    :param candle_df_list: 所有币种的K线数据，和 candle_pq_path 中的数据一致
+    :param candle_pq_path: 全量K线数据 all_candle_data.parquet
+    :param factor_params_dict: 因子及参数
+    :param factor_col_name_list: 需要计算的因子列
+    :param period_type: 周期类型，H：小时，D：日线
+    :param job_num: 读写因子仓库的线程数
+    :param store_list: 延后的因子仓库写入，参考 calc_factors_incremental
+    :return: 和 candle_df_list 一一对应的列表，每个元素是 {'candle_begin_time': 时间, 因子列名: 因子值}
+    """
+    expr_params_dict = {}
+    for factor_name, param_list in factor_params_dict.items():
+        if not has_signal_expr(FactorHub.get_by_name(factor_name)):
+            continue
+        factor_param_list = [param for param in param_list if f'{factor_name}_{param}' in factor_col_name_list]
+        if factor_param_list:
+            expr_params_dict[factor_name] = factor_param_list
+
+    def _calc_expr(calc_idx_list, start_list, calc_dict_list):
+        symbol_list = [candle_df_list[idx]['symbol'].iloc[0] for idx in calc_idx_list]
+        expr_factor_dict = calc_expr_factors(candle_pq_path, expr_params_dict, factor_col_name_list,
+                                             {symbol: start_list[idx] for symbol, idx in zip(symbol_list, calc_idx_list)})
+        for symbol, idx in zip(symbol_list, calc_idx_list):
+            calc_dict_list[idx].update(expr_factor_dict[symbol])
+
+    return calc_factors_incremental(candle_df_list, expr_params_dict, _calc_expr, None, period_type, job_num,
+                                    store_list)
@@ -0,0 +1,16 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+from core.kernels.offsets import expand_hold_windows
+from core.kernels.rolling import (ewm_mean, rolling_max, rolling_mean, rolling_min, rolling_rank, rolling_std,
+                                  rolling_sum, rolling_var, rolling_zscore)
+from core.kernels.smooth import smooth_ratio_matrix, smooth_single_ratio_array
+from core.kernels.topk import group_starts_by_time, topk_rank_min
@@ -0,0 +1,108 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import numba as nb
+import numpy as np
+
+"""
+# 多 offset 持仓聚合（事件方式）
+每一次选币相当于一个事件：在 t 时刻 +w，在 t + 持仓周期 时刻 -w，持仓就是事件的累加。
+原来的做法是构建 (全部小时 × 全部币种) 的完整网格，再按币种做 rolling_sum，24H 持仓 24 个 offset 的时候，
+绝大部分都是 0，却要排序、滚动几千万行。
+
+这里只在变化点（选币时刻、选币到期时刻）重新计算持仓，两个变化点之间持仓不变，直接展开：
+- 计算量和内存只和选币次数、实际持仓的 币种×小时 有关，和 小时×币种 的网格无关
+- 每个变化点都按窗口内的选币重新求和（从 0 开始，按时间顺序累加），不会因为 +w/-w 的累加产生误差，
+  窗口为空的时候持仓严格为 0
+"""
+
+
+@nb.njit(cache=True, nogil=True)
+def _window_sum(weights, lo, hi):
+    total = 0.
+    for k in range(lo, hi):
+        total += weights[k]
+    return total
+
+
+@nb.njit(cache=True, nogil=True)
+def expand_hold_windows(sym_ids, hours, weights, hold_period, max_hour):
+    """
+    把选币事件展开成每个小时的持仓
+    :param sym_ids: 币种编号，需要按照 (币种, 小时) 排序，并且 (币种, 小时) 不重复
+    :param hours: 选币时刻，距离起始时间的小时数
+    :param weights: 选币权重
+    :param hold_period: 持仓周期（小时）
+    :param max_hour: 最后一个小时，超过的持仓截断
+    :return: (币种编号, 小时, 持仓) 三个数组，只包含有持仓的小时
+    """
+    n = len(sym_ids)
+    # 先计算输出的长度：每个币种持仓区间并集的长度
+    n_out = 0
+    i = 0
+    while i < n:
+        j = i
+        cover_end = -1  # 已经覆盖到的小时（不含）
+        while j < n and sym_ids[j] == sym_ids[i]:
+            start = max(hours[j], cover_end)
+            end = min(hours[j] + hold_period, max_hour + 1)
+            if end > start:
+                n_out += end - start
+                cover_end = end
+            j += 1
+        i = j
+
+    out_sym = np.empty(n_out, dtype=np.int64)
+    out_hour = np.empty(n_out, dtype=np.int64)
+    out_val = np.empty(n_out, dtype=np.float64)
+
+    pos = 0
+    i = 0
+    while i < n:
+        # 当前币种的选币区间 [i, j)
+        j = i
+        while j < n and sym_ids[j] == sym_ids[i]:
+            j += 1
+
+        lo, hi = i, i  # 当前持仓窗口内的选币 [lo, hi)
+        hour = hours[i]
+        while True:
+            # 移除已经到期的选币
+            while lo < hi and hours[lo] + hold_period <= hour:
+                lo += 1
+            # 窗口为空时，直接跳到下一次选币
+            if lo == hi:
+                if hi == j:
+                    break
+                hour = hours[hi]
+            if hour > max_hour:
+                break
+            # 加入已经开始的选币
+            while hi < j and hours[hi] <= hour:
+                hi += 1
+            value = _window_sum(weights, lo, hi)
+
+            # 下一个变化点
+            next_change = max_hour + 1
+            if hi < j and hours[hi] < next_change:
+                next_change = hours[hi]
+            if lo < hi and hours[lo] + hold_period < next_change:
+                next_change = hours[lo] + hold_period
+
+            for h in range(hour, next_change):
+                out_sym[pos] = sym_ids[i]
+                out_hour[pos] = h
+                out_val[pos] = value
+                pos += 1
+            hour = next_change
+        i = j
+
+    return out_sym[:pos], out_hour[:pos], out_val[:pos]
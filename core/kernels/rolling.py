@@ -0,0 +1,367 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import numba as nb
+import numpy as np
+
+"""
+# 多窗口滚动计算
+每个函数同时计算多个窗口长度，返回 (窗口数量 × 数据长度) 的矩阵，第 k 行对应 windows[k]。
+其中 mean/sum/var/std 只遍历一次数据，所有窗口的状态一起更新；
+rank 对每一行往前扫描到最大窗口，复杂度是 O(数据长度 × 最大窗口)，多个窗口共用同一次扫描。
+计算口径和 pandas 的 rolling(n, min_periods=min_periods) 保持一致：
+- NaN 不参与计算，窗口内有效数据不足 min_periods 时结果为 NaN
+- mean/sum 使用和 pandas 相同的 Kahan 补偿求和，结果和 pandas 逐位一致；var/std 的差异在浮点误差范围内（1e-12 量级）
+
+用法示例：
+>>> windows = np.array([24, 48, 360], dtype=np.int64)
+>>> ma = rolling_mean(df['close'].values, windows)
+>>> ma[2]  # 等价于 df['close'].rolling(360, min_periods=1).mean().values
+"""
+
+
+@nb.njit(cache=True)
+def _add_sum(val, state, k):
+    # state[k]: [有效数量, 和, 负数数量, 加入时的补偿, 移除时的补偿, 连续相同值数量, 上一个值]
+    if val == val:
+        state[k, 0] += 1
+        y = val - state[k, 3]
+        t = state[k, 1] + y
+        state[k, 3] = t - state[k, 1] - y
+        state[k, 1] = t
+        if np.signbit(val):
+            state[k, 2] += 1
+        if val == state[k, 6]:
+            state[k, 5] += 1
+        else:
+            state[k, 5] = 1
+        state[k, 6] = val
+
+
+@nb.njit(cache=True)
+def _remove_sum(val, state, k):
+    if val == val:
+        state[k, 0] -= 1
+        y = -val - state[k, 4]
+        t = state[k, 1] + y
+        state[k, 4] = t - state[k, 1] - y
+        state[k, 1] = t
+        if np.signbit(val):
+            state[k, 2] -= 1
+
+
+@nb.njit(cache=True)
+def _rolling_sum_state(x, windows, min_periods, is_mean):
+    n = len(x)
+    out = np.full((len(windows), n), np.nan)
+    state = np.zeros((len(windows), 7))
+    for i in range(n):
+        for k in range(len(windows)):
+            s = max(i + 1 - windows[k], 0)
+            if i == 0 or s >= i:
+                # 第一个窗口（或者窗口长度为1）重新开始累计
+                state[k, :6] = 0.
+                state[k, 6] = x[s]
+                for j in range(s, i + 1):
+                    _add_sum(x[j], state, k)
+            else:
+                if s > 0:
+                    _remove_sum(x[s - 1], state, k)
+                _add_sum(x[i], state, k)
+
+            nobs = state[k, 0]
+            if is_mean:
+                if nobs >= min_periods and nobs > 0:
+                    result = state[k, 1] / nobs
+                    if state[k, 5] >= nobs:
+                        # 窗口内全是同一个值，避免浮点误差
+                        result = state[k, 6]
+                    elif state[k, 2] == 0 and result < 0:
+                        result = 0.
+                    elif state[k, 2] == nobs and result > 0:
+                        result = 0.
+                    out[k, i] = result
+            else:
+                if nobs == 0 and min_periods == 0:
+                    out[k, i] = 0.
+                elif nobs >= min_periods:
+                    out[k, i] = state[k, 6] * nobs if state[k, 5] >= nobs else state[k, 1]
+    return out
+
+
+@nb.njit(cache=True)
+def rolling_mean(x, windows, min_periods=1):
+    """
+    多窗口滚动均值，等价于 rolling(n, min_periods).mean()
+    :param x: 一维数据
+    :param windows: 窗口长度数组
+    :param min_periods: 最少有效数据数量
+    :return: (窗口数量 × 数据长度) 的矩阵
+    """
+    return _rolling_sum_state(x, windows, min_periods, True)
+
+
+@nb.njit(cache=True)
+def rolling_sum(x, windows, min_periods=1):
+    """
+    多窗口滚动求和，等价于 rolling(n, min_periods).sum()
+    :param x: 一维数据
+    :param windows: 窗口长度数组
+    :param min_periods: 最少有效数据数量
+    :return: (窗口数量 × 数据长度) 的矩阵
+    """
+    return _rolling_sum_state(x, windows, min_periods, False)
+
+
+@nb.njit(cache=True)
+def _add_var(val, state, k):
+    # state[k]: [有效数量, 均值, 离差平方和, 加入时的补偿, 移除时的补偿, 连续相同值数量, 上一个值]
+    if val != val:
+        return
+    state[k, 0] += 1
+    if val == state[k, 6]:
+        state[k, 5] += 1
+    else:
+        state[k, 5] = 1
+    state[k, 6] = val
+    # Welford 算法 + Kahan 补偿
+    prev_mean = state[k, 1] - state[k, 3]
+    y = val - state[k, 3]
+    t = y - state[k, 1]
+    state[k, 3] = t + state[k, 1] - y
+    state[k, 1] = state[k, 1] + t / state[k, 0]
+    state[k, 2] = state[k, 2] + (val - prev_mean) * (val - state[k, 1])
+
+
+@nb.njit(cache=True)
+def _remove_var(val, state, k):
+    if val == val:
+        state[k, 0] -= 1
+        if state[k, 0]:
+            prev_mean = state[k, 1] - state[k, 4]
+            y = val - state[k, 4]
+            t = y - state[k, 1]
+            state[k, 4] = t + state[k, 1] - y
+            state[k, 1] = state[k, 1] - t / state[k, 0]
+            state[k, 2] = state[k, 2] - (val - prev_mean) * (val - state[k, 1])
+        else:
+            state[k, 1] = 0.
+            state[k, 2] = 0.
+
+
+@nb.njit(cache=True)
+def rolling_var(x, windows, min_periods=1, ddof=1):
+    """
+    多窗口滚动方差，等价于 rolling(n, min_periods).var(ddof)
+    :param x: 一维数据
+    :param windows: 窗口长度数组
+    :param min_periods: 最少有效数据数量
+    :param ddof: 自由度
+    :return: (窗口数量 × 数据长度) 的矩阵
+    """
+    n = len(x)
+    out = np.full((len(windows), n), np.nan)
+    state = np.zeros((len(windows), 7))
+    for i in range(n):
+        for k in range(len(windows)):
+            s = max(i + 1 - windows[k], 0)
+            if i == 0 or s >= i:
+                state[k, :6] = 0.
+                state[k, 6] = x[s]
+                for j in range(s, i + 1):
+                    _add_var(x[j], state, k)
+            else:
+                if s > 0:
+                    _remove_var(x[s - 1], state, k)
+                _add_var(x[i], state, k)
+
+            nobs = state[k, 0]
+            if nobs >= min_periods and nobs > ddof:
+                if nobs == 1 or state[k, 5] >= nobs:
+                    out[k, i] = 0.
+                else:
+                    out[k, i] = state[k, 2] / (nobs - ddof)
+    return out
+
+
+@nb.njit(cache=True)
+def rolling_std(x, windows, min_periods=1, ddof=1):
+    """
+    多窗口滚动标准差，等价于 rolling(n, min_periods).std(ddof)
+    """
+    var = rolling_var(x, windows, min_periods, ddof)
+    out = np.full(var.shape, np.nan)
+    for k in range(var.shape[0]):
+        for i in range(var.shape[1]):
+            v = var[k, i]
+            if v == v:
+                out[k, i] = np.sqrt(v) if v > 0 else 0.
+    return out
+
+
+@nb.njit(cache=True)
+def rolling_zscore(x, windows, min_periods=1, ddof=1):
+    """
+    多窗口滚动 z-score：(x - 滚动均值) / 滚动标准差，标准差为 0 时结果为 NaN
+    """
+    mean = rolling_mean(x, windows, min_periods)
+    std = rolling_std(x, windows, min_periods, ddof)
+    out = np.full(mean.shape, np.nan)
+    for k in range(mean.shape[0]):
+        for i in range(mean.shape[1]):
+            if std[k, i] > 0:
+                out[k, i] = (x[i] - mean[k, i]) / std[k, i]
+    return out
+
+
+@nb.njit(cache=True)
+def _rolling_extreme(x, windows, min_periods, is_max):
+    # 单调队列，队列中保存下标，队首是当前窗口的极值
+    n = len(x)
+    out = np.full((len(windows), n), np.nan)
+    queue = np.empty(n, dtype=np.int64)
+    for k in range(len(windows)):
+        w = windows[k]
+        head, tail, nobs = 0, 0, 0
+        for i in range(n):
+            val = x[i]
+            if val == val:
+                nobs += 1
+                while tail > head and ((x[queue[tail - 1]] <= val) if is_max else (x[queue[tail - 1]] >= val)):
+                    tail -= 1
+                queue[tail] = i
+                tail += 1
+            s = i + 1 - w
+            if s > 0 and x[s - 1] == x[s - 1]:
+                nobs -= 1
+            while tail > head and queue[head] < s:
+                head += 1
+            if nobs >= min_periods and tail > head:
+                out[k, i] = x[queue[head]]
+    return out
+
+
+@nb.njit(cache=True)
+def rolling_max(x, windows, min_periods=1):
+    """
+    多窗口滚动最大值，等价于 rolling(n, min_periods).max()
+    """
+    return _rolling_extreme(x, windows, min_periods, True)
+
+
+@nb.njit(cache=True)
+def rolling_min(x, windows, min_periods=1):
+    """
+    多窗口滚动最小值，等价于 rolling(n, min_periods).min()
+    """
+    return _rolling_extreme(x, windows, min_periods, False)
+
+
+@nb.njit(cache=True)
+def rolling_rank(x, windows, min_periods=1, method=0, pct=False):
+    """
+    多窗口滚动排名：当前值在窗口内的排名，等价于 rolling(n, min_periods).rank(method, pct=pct)
+    一次往前扫描到最大窗口，经过每个窗口的边界时记录结果，所以多个窗口只需要扫描一遍
+    :param x: 一维数据
+    :param windows: 窗口长度数组，不需要排序
+    :param min_periods: 最少有效数据数量
+    :param method: 0: average，1: min，2: max
+    :param pct: 是否返回百分比排名
+    :return: (窗口数量 × 数据长度) 的矩阵
+    """
+    n = len(x)
+    out = np.full((len(windows), n), np.nan)
+    if len(windows) == 0:
+        return out
+    if windows.min() < 1:
+        raise ValueError('rolling_rank: 窗口长度必须大于 0')
+    # 按照窗口从小到大扫描，结果写回 windows 原来的顺序
+    order = np.argsort(windows, kind='mergesort')
+    sorted_windows = windows[order]
+    max_window = sorted_windows[-1]
+    for i in range(n):
+        val = x[i]
+        less, equal, nobs, k = 0, 0, 0, 0
+        for j in range(i, max(i - max_window, -1), -1):
+            other = x[j]
+            if other == other:
+                nobs += 1
+                if other < val:
+                    less += 1
+                elif other == val:
+                    equal += 1
+            # 经过窗口边界，记录排名
+            while k < len(windows) and i - j + 1 == sorted_windows[k]:
+                if val == val and nobs >= min_periods:
+                    if method == 1:
+                        rank = less + 1.
+                    elif method == 2:
+                        rank = less + equal + 0.
+                    else:
+                        rank = less + (equal + 1) / 2.
+                    out[order[k], i] = rank / nobs if pct else rank
+                k += 1
+        # 数据长度不足的窗口，用全部数据的结果
+        while k < len(windows):
+            if val == val and nobs >= min_periods:
+                if method == 1:
+                    rank = less + 1.
+                elif method == 2:
+                    rank = less + equal + 0.
+                else:
+                    rank = less + (equal + 1) / 2.
+                out[order[k], i] = rank / nobs if pct else rank
+            k += 1
+    return out
+
+
+@nb.njit(cache=True)
+def ewm_mean(x, spans, min_periods=1, adjust=True):
+    """
+    多参数指数加权均值，等价于 ewm(span=n, min_periods, adjust).mean()
+    :param x: 一维数据
+    :param spans: span 参数数组
+    :param min_periods: 最少有效数据数量
+    :param adjust: 和 pandas 的 adjust 参数一致
+    :return: (参数数量 × 数据长度) 的矩阵
+    """
+    n = len(x)
+    out = np.full((len(spans), n), np.nan)
+    if n == 0:
+        return out
+    for k in range(len(spans)):
+        alpha = 2. / (spans[k] + 1.)
+        old_wt_factor = 1. - alpha
+        new_wt = 1. if adjust else alpha
+        weighted = x[0]
+        nobs = 1 if weighted == weighted else 0
+        old_wt = 1.
+        if nobs >= min_periods:
+            out[k, 0] = weighted
+        for i in range(1, n):
+            cur = x[i]
+            is_observation = cur == cur
+            nobs += is_observation
+            if weighted == weighted:
+                old_wt *= old_wt_factor
+                if is_observation:
+                    if weighted != cur:
+                        weighted = old_wt * weighted + new_wt * cur
+                        weighted /= (old_wt + new_wt)
+                    if adjust:
+                        old_wt += new_wt
+                    else:
+                        old_wt = 1.
+            elif is_observation:
+                weighted = cur
+            if nobs >= min_periods:
+                out[k, i] = weighted
+    return out
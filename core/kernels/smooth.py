@@ -0,0 +1,137 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import numba as nb
+import numpy as np
+
+"""
+# 分步换仓（rebalance_cap_step）
+每个周期的仓位调整幅度不超过 rebalance_cap_step，逐行依赖上一行的结果，只能顺序计算。
+原来使用 pandas 逐行 .iloc 计算，每一行都要生成好几个 Series，这里直接在 numpy 矩阵上计算，
+计算口径和 MultiEquityBacktestConfig 中原来的 pandas 实现一致（包括求和顺序），结果逐位一致。
+"""
+
+
+@nb.njit(cache=True)
+def _pairwise_sum(a, n):
+    # 和 numpy 的 pairwise 求和保持相同的顺序，保证和 pandas 的 sum 逐位一致
+    if n < 8:
+        res = 0.
+        for i in range(n):
+            res += a[i]
+        return res
+    elif n <= 128:
+        r0, r1, r2, r3, r4, r5, r6, r7 = a[0], a[1], a[2], a[3], a[4], a[5], a[6], a[7]
+        i = 8
+        while i < n - (n % 8):
+            r0 += a[i]
+            r1 += a[i + 1]
+            r2 += a[i + 2]
+            r3 += a[i + 3]
+            r4 += a[i + 4]
+            r5 += a[i + 5]
+            r6 += a[i + 6]
+            r7 += a[i + 7]
+            i += 8
+        res = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+        while i < n:
+            res += a[i]
+            i += 1
+        return res
+    n2 = n // 2
+    n2 -= n2 % 8
+    return _pairwise_sum(a[:n2], n2) + _pairwise_sum(a[n2:], n - n2)
+
+
+@nb.njit(cache=True)
+def smooth_ratio_matrix(ratios, rebalance_cap_step):
+    """
+    多个子策略的分步换仓：每个周期增加的仓位之和、减少的仓位之和都不超过 rebalance_cap_step，
+    按照各自的调整量等比例缩放；目标仓位非负的子策略，调整之后也不会变成负数
+    :param ratios: (周期 × 子策略) 的目标仓位矩阵
+    :param rebalance_cap_step: 每个周期最大的调整比例
+    :return: 平滑之后的仓位矩阵（未做精度处理）
+    """
+    n_rows, n_cols = ratios.shape
+    res = np.empty((n_rows, n_cols), dtype=np.float64)
+    if n_rows == 0:
+        return res
+
+    diff = np.empty(n_cols, dtype=np.float64)
+    buf = np.empty(n_cols, dtype=np.float64)
+    for j in range(n_cols):
+        res[0, j] = ratios[0, j]
+
+    for i in range(1, n_rows):
+        # 目标仓位和上一周期仓位的差值
+        for j in range(n_cols):
+            diff[j] = ratios[i, j] - res[i - 1, j]
+
+        # 增加的总量、减少的总量，各自不超过 rebalance_cap_step
+        n_inc = 0
+        for j in range(n_cols):
+            if diff[j] > 0:
+                buf[n_inc] = diff[j]
+                n_inc += 1
+        inc_sum = _pairwise_sum(buf, n_inc)
+
+        n_dec = 0
+        for j in range(n_cols):
+            if diff[j] < 0:
+                buf[n_dec] = diff[j]
+                n_dec += 1
+        dec_sum = _pairwise_sum(buf, n_dec)
+
+        total_increase = min(inc_sum, rebalance_cap_step)
+        total_decrease = min(-dec_sum, rebalance_cap_step)
+
+        for j in range(n_cols):
+            prev = res[i - 1, j]
+            adjustment = 0.
+            if diff[j] > 0:
+                if total_increase > 0:
+                    adjustment = diff[j] * (total_increase / inc_sum)
+            elif diff[j] < 0:
+                if total_decrease > 0:
+                    adjustment = diff[j] * (total_decrease / -dec_sum)
+                # 非负约束：目标仓位非负时，最多减到 0
+                if ratios[i, j] >= 0:
+                    allowable_decrease = prev if prev > 0 else 0.
+                    if adjustment < -allowable_decrease:
+                        adjustment = -allowable_decrease
+            res[i, j] = prev + adjustment
+
+    return res
+
+
+@nb.njit(cache=True)
+def smooth_single_ratio_array(ratios, rebalance_cap_step):
+    """
+    单个子策略的分步换仓：每个周期的调整量限制在 [-rebalance_cap_step, rebalance_cap_step]
+    :param ratios: 目标仓位序列
+    :param rebalance_cap_step: 每个周期最大的调整比例
+    :return: 平滑之后的仓位序列（未做精度处理）
+    """
+    n = len(ratios)
+    res = np.empty(n, dtype=np.float64)
+    if n == 0:
+        return res
+
+    res[0] = ratios[0]
+    for i in range(1, n):
+        adjustment = ratios[i] - res[i - 1]
+        # 和 max(min(difference, cap), -cap) 一致，NaN 保持 NaN
+        if rebalance_cap_step < adjustment:
+            adjustment = rebalance_cap_step
+        if -rebalance_cap_step > adjustment:
+            adjustment = -rebalance_cap_step
+        res[i] = res[i - 1] + adjustment
+    return res
@@ -0,0 +1,74 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import numba as nb
+import numpy as np
+
+"""
+# 截面 Top-K 排名
+选币的时候只需要每个周期排名靠前的 N 个币，但是完整的截面排名要对每个周期的所有币种排序。
+这里先用 np.partition 找到第 N 名的因子值（O(n)），只对不差于它的候选币排序，计算 method='min' 的排名：
+- 比候选币更好的币，一定也是候选币，所以候选币内部的排名就是在整个截面中的排名
+- 并列的币种排名相同（method='min'），并列第 N 名的币种全部保留
+- 和 pandas 一样，NaN 不参与排名，也不占用名次
+
+选币时多个子策略在线程池中并行，这里单线程计算并释放 GIL，不再嵌套 numba 的并行线程池
+"""
+
+
+@nb.njit(cache=True)
+def _assign_rank_min(vals, cand, ranks, offset):
+    # 候选币按照因子值排序，相同的值使用相同的（最小的）排名
+    order = cand[np.argsort(vals[cand], kind='mergesort')]
+    prev_rank = 0
+    for i in range(len(order)):
+        if i == 0 or vals[order[i]] != vals[order[i - 1]]:
+            prev_rank = i + 1
+        ranks[offset + order[i]] = prev_rank
+
+
+@nb.njit(cache=True, nogil=True)
+def topk_rank_min(values, group_starts, top_nums, ascending):
+    """
+    分组计算前 top_nums 名的排名（method='min'），其他位置为 0
+    :param values: 因子值，按照分组连续存放（比如按照 candle_begin_time 排好序）
+    :param group_starts: 每个分组的起始位置，最后一个元素为总长度
+    :param top_nums: 每个分组需要的名次，排名 <= top_nums 的币种会计算排名
+    :param ascending: True：从小到大排名；False：从大到小排名
+    :return: 排名，int64，不在前 top_nums 名的、以及因子值为 NaN 的为 0
+    """
+    ranks = np.zeros(len(values), dtype=np.int64)
+    for g in range(len(group_starts) - 1):
+        start, end = group_starts[g], group_starts[g + 1]
+        top_num = top_nums[g]
+        if top_num > 0 and end > start:
+            vals = values[start:end].copy() if ascending else -values[start:end]
+            valid = np.flatnonzero(vals == vals)
+            if top_num >= len(valid):
+                cand = valid
+            else:
+                # 第 top_num 名的因子值，不差于它的都是候选币
+                valid_vals = vals[valid]
+                threshold = np.partition(valid_vals, top_num - 1)[top_num - 1]
+                cand = valid[valid_vals <= threshold]
+            if len(cand):
+                _assign_rank_min(vals, cand, ranks, start)
+    return ranks
+
+
+def group_starts_by_time(times) -> np.ndarray:
+    """
+    按时间连续存放的数据，每个时间分组的起始位置，最后一个元素为总长度
+    :param times: 已经排好序的时间
+    """
+    times = np.asarray(times)
+    starts = np.flatnonzero(times[1:] != times[:-1]) + 1
+    return np.concatenate(([0], starts, [len(times)])).astype(np.int64)
@@ -15,10 +15,12 @@ from itertools import product
 from pathlib import Path
 from typing import List, Dict, Optional, Set
 
+import numpy as np
 import pandas as pd
 
 from config import backtest_path, backtest_iter_path, backtest_name
 from core.factor import calc_factor_vals
+from core.kernels import smooth_ratio_matrix, smooth_single_ratio_array
 from core.model.account_type import AccountType
 from core.model.rebalance_mode import RebalanceMode
 from core.model.strategy_config import StrategyConfig, PosStrategyConfig
@@ -26,6 +28,7 @@ from core.model.timing_signal import TimingSignal
 from core.utils.factor_hub import FactorHub
 from core.utils.log_kit import logger
 from core.utils.path_kit import get_folder_path, get_file_path
+from core.utils.sparse_ratio import SparseRatio, to_dense_ratio
 from core.utils.strategy_hub import StrategyHub
 
 
@@ -529,7 +532,7 @@ class MultiEquityBacktestConfig:
             # ====处理选币仓位结果
             spot_path = conf.get_result_folder() / 'df_spot_ratio.pkl'
             swap_path = conf.get_result_folder() / 'df_swap_ratio.pkl'
-            ratio_dfs.append((pd.read_pickle(spot_path), pd.read_pickle(swap_path)))
+            ratio_dfs.append((SparseRatio.read_pickle(spot_path), SparseRatio.read_pickle(swap_path)))
 
             # 保存到本地
             equity_df.to_pickle(get_file_path(self.factory.result_folder, conf.name, 'equity_df.pkl'))
@@ -557,20 +560,9 @@ class MultiEquityBacktestConfig:
         if rebalance_cap_step > 0.9999:
             return df_ratio
 
-        rebalance_df = df_ratio.astype(float)  # Copy the original DataFrame
-        rebalance_df.iloc[0] = df_ratio.iloc[0]  # Initialize with the first row
-
-        for i in range(1, len(df_ratio)):
-            prev_signal = rebalance_df.iloc[i - 1, 0].astype(float)  # Previous adjusted signal
-            target_signal = df_ratio.iloc[i, 0].astype(float)  # Target signal for the current row
-
-            # Compute the adjustment needed
-            difference = target_signal - prev_signal
-            adjustment = max(min(difference, rebalance_cap_step), -rebalance_cap_step)
-
-            # Apply the adjustment
-            rebalance_df.iloc[i, 0] = prev_signal + adjustment
-
+        # 逐行依赖上一行的结果，使用 numba 在 numpy 数组上计算
+        values = smooth_single_ratio_array(df_ratio.iloc[:, 0].to_numpy(dtype=np.float64), float(rebalance_cap_step))
+        rebalance_df = pd.DataFrame({df_ratio.columns[0]: values}, index=df_ratio.index)
         return rebalance_df.round(self.pos_ratio_precision)
 
     def smooth_ratios(self, df_ratio):
@@ -589,57 +581,9 @@ class MultiEquityBacktestConfig:
         if rebalance_cap_step > 0.9999:
             return df_ratio
 
-        rebalance_df = df_ratio.astype(float)  # Copy the original DataFrame
-        rebalance_df.iloc[0] = df_ratio.iloc[0]  # First row matches the initial signal
-
-        for i in range(1, len(df_ratio)):
-            prev_signal = rebalance_df.iloc[i - 1]  # Previous adjusted signal
-            target_signal = df_ratio.iloc[i]  # Target signal for the current row
-
-            # Difference between target and current signal
-            difference = target_signal - prev_signal
-
-            # Allowable increase/decrease ranges
-            increase_indices = (difference > 0)
-            decrease_indices = (difference < 0)
-
-            # Non-negative constraint: For columns where target_signal >= 0, ensure result >= 0
-            non_negative_indices = (target_signal >= 0)
-            allowable_decrease = prev_signal[non_negative_indices].clip(lower=0)
-
-            # Calculate total increase and decrease
-            total_increase = min(difference[increase_indices].sum(), rebalance_cap_step)
-            total_decrease = min(-difference[decrease_indices].sum(), rebalance_cap_step)
-
-            # Scale increases and decreases to meet rebalance_cap_step
-            if total_increase > 0:
-                scaled_increase = difference[increase_indices] * (total_increase / difference[increase_indices].sum())
-                pass
-            else:
-                scaled_increase = pd.Series(0, index=difference.index)
-
-            if total_decrease > 0:
-                scaled_decrease = difference[decrease_indices] * (total_decrease / -difference[decrease_indices].sum())
-            else:
-                scaled_decrease = pd.Series(0, index=difference.index)
-
-            # Apply non-negative constraints
-            if non_negative_indices.any():
-                scaled_decrease[non_negative_indices] = scaled_decrease[non_negative_indices].clip(
-                    lower=-allowable_decrease
-                )
-
-            # Apply adjustments
-            adjustment = pd.Series(0, index=prev_signal.index)
-            adjustment[increase_indices] = scaled_increase
-            adjustment[decrease_indices] = scaled_decrease
-
-            # Update rebalance signal
-            rebalance_df.iloc[i] = prev_signal + adjustment
-
-            # Normalize to ensure the row sums to 1
-            # rebalance_df.iloc[i] = rebalance_df.iloc[i] / rebalance_df.iloc[i].sum()
-
+        # 逐行依赖上一行的结果，使用 numba 在 numpy 矩阵上计算，口径见 core/kernels/smooth.py
+        values = smooth_ratio_matrix(df_ratio.to_numpy(dtype=np.float64), float(rebalance_cap_step))
+        rebalance_df = pd.DataFrame(values, index=df_ratio.index, columns=df_ratio.columns)
         return rebalance_df.round(self.pos_ratio_precision)
 
     def calc_ratios(self):
@@ -704,20 +648,25 @@ class MultiEquityBacktestConfig:
         df_ratio.to_csv(self.factory.result_folder / '仓位比例.csv')
         return df_ratio
 
-    def agg_pos_ratio(self, pos_ratio) -> (pd.DataFrame, pd.DataFrame):
-        df_spot_ratio_sum = pd.DataFrame()
-        df_swap_ratio_sum = pd.DataFrame()
+    def agg_pos_ratio(self, pos_ratio) -> (SparseRatio, SparseRatio):
+        """
+        根据仓位管理的资金比例，把子策略的目标资金占比加权累加
+        :param pos_ratio: 仓位管理策略计算得到的每个子策略的资金比例
+        :return: 稀疏格式的现货、合约目标资金占比
+        """
+        spot_ratio_list = []
+        swap_ratio_list = []
         for idx, (df_spot_ratio, df_swap_ratio) in enumerate(self.ratio_dfs):
             # 获取仓位管理ratio
-            group_ratio = pos_ratio[idx]
-            # 裁切对应的资金权重
-            spot_ratio = df_spot_ratio.loc[pos_ratio.index, :].mul(group_ratio, axis=0)
-            swap_ratio = df_swap_ratio.loc[pos_ratio.index, :].mul(group_ratio, axis=0)
-            # 累加
-            df_spot_ratio_sum = df_spot_ratio_sum.add(spot_ratio, fill_value=0)
-            df_swap_ratio_sum = df_swap_ratio_sum.add(swap_ratio, fill_value=0)
+            group_ratio = pos_ratio[idx].to_numpy(dtype=float)
+            # 裁切对应的资金权重，只对非零的位置做乘法
+            spot_ratio = SparseRatio.from_dense(df_spot_ratio).select_rows(pos_ratio.index)
+            swap_ratio = SparseRatio.from_dense(df_swap_ratio).select_rows(pos_ratio.index)
+            spot_ratio_list.append(spot_ratio.mul_rows(group_ratio))
+            swap_ratio_list.append(swap_ratio.mul_rows(group_ratio))
 
-        return df_spot_ratio_sum, df_swap_ratio_sum
+        # 累加
+        return SparseRatio.sum(spot_ratio_list), SparseRatio.sum(swap_ratio_list)
 
     def backtest_strategies(self):
         from core.backtest import run_backtest_multi
@@ -741,9 +690,9 @@ class MultiEquityBacktestConfig:
                 df_fill_spot = pd.DataFrame()
                 df_fill_swap = pd.DataFrame()
                 if spot_path.exists():
-                    df_fill_spot = pd.read_pickle(spot_path)
+                    df_fill_spot = to_dense_ratio(pd.read_pickle(spot_path))
                 if swap_path.exists():
-                    df_fill_swap = pd.read_pickle(swap_path)
+                    df_fill_swap = to_dense_ratio(pd.read_pickle(swap_path))
 
                 return df_fill_spot, df_fill_swap
 
@@ -759,6 +708,9 @@ class MultiEquityBacktestConfig:
             logger.info("未配置pos_limit，跳过仓位限制处理")
             return df_spot_ratio, df_swap_ratio
 
+        # 仓位限制需要按行、按币种处理，转换成稠密格式
+        df_spot_ratio, df_swap_ratio = to_dense_ratio(df_spot_ratio), to_dense_ratio(df_swap_ratio)
+
         logger.info("开始应用仓位限制...")
 
         # 处理多头超限
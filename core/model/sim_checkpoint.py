@@ -0,0 +1,107 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import pickle
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from core.simulator import Simulator, TradeLedger
+
+"""
+# 模拟交易检查点
+记录模拟交易在某一根 K 线收盘、计算完目标持仓之后的全部状态，下一根 K 线从这里继续模拟，
+结果和从头模拟到底逐位一致。每天更新数据之后，只需要模拟新增的 K 线，不用把几年的数据重新跑一遍。
+
+现货和合约各自保存：账户权益、当前持仓手数、目标持仓手数、最新价格，数组的顺序和 symbols 一致。
+记录成交明细时，检查点同时保存到这根 K 线为止的成交，继续模拟时接着追加。
+"""
+
+
+@dataclass
+class MarketState:
+    symbols: List[str]  # 币种，数组的顺序和币种一致
+    equity: float  # 账户权益（现货账户包含初始资金，合约账户从 0 开始累计盈亏）
+    lots: np.ndarray  # 当前持仓手数
+    target_lots: np.ndarray  # 目标持仓手数
+    last_prices: np.ndarray  # 最新价格
+
+    @classmethod
+    def from_simulator(cls, sim: Simulator, symbols) -> 'MarketState':
+        return cls(symbols=list(symbols), equity=sim.equity, lots=sim.lots.copy(), target_lots=sim.target_lots.copy(),
+                   last_prices=sim.last_prices.copy())
+
+    @property
+    def active_symbols(self) -> List[str]:
+        """
+        持仓或者目标持仓不为 0 的币种
+        """
+        return [self.symbols[j] for j in np.flatnonzero((self.lots != 0) | (self.target_lots != 0))]
+
+    def reindex(self, symbols) -> 'MarketState':
+        """
+        按照新的币种列表重新排列，新列表中没有的币种持仓为 0
+        """
+        symbols = list(symbols)
+        if symbols == self.symbols:
+            return self
+
+        missing = set(self.active_symbols) - set(symbols)
+        if missing:
+            raise ValueError(f'检查点中有持仓的币种不在新的币种列表中：{sorted(missing)}')
+
+        pos = pd.Index(self.symbols).get_indexer(symbols)
+        found = pos >= 0
+
+        def _take(values, fill_value):
+            res = np.full(len(symbols), fill_value, dtype=values.dtype)
+            res[found] = values[pos[found]]
+            return res
+
+        return MarketState(symbols=symbols, equity=self.equity, lots=_take(self.lots, 0),
+                           target_lots=_take(self.target_lots, 0), last_prices=_take(self.last_prices, 0.))
+
+    def create_simulator(self, lot_sizes, fee_rate, min_order_limit, has_last_prices, ledger: TradeLedger,
+                         market) -> Simulator:
+        sim = Simulator(self.equity, lot_sizes, fee_rate, self.lots, min_order_limit, ledger, market)
+        sim.restore(self.target_lots, self.last_prices, has_last_prices)
+        return sim
+
+
+@dataclass
+class SimCheckpoint:
+    candle_begin_time: pd.Timestamp  # 检查点对应的 K 线，下一次从这根 K 线之后开始模拟
+    spot: MarketState  # 现货状态
+    swap: MarketState  # 合约状态
+    has_last_prices: bool  # 是否有最新价
+    is_liquidated: bool  # 是否已经爆仓，爆仓之后不再模拟
+    trades: pl.DataFrame | None = None  # 到检查点为止的成交明细，没有记录成交时为 None
+
+    @property
+    def equity(self) -> float:
+        return self.spot.equity + self.swap.equity
+
+    def to_pickle(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def read_pickle(cls, path) -> 'SimCheckpoint':
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def __repr__(self):
+        return (f'SimCheckpoint({self.candle_begin_time}, 权益: {self.equity:,.2f}, '
+                f'现货持仓: {len(self.spot.active_symbols)}个, 合约持仓: {len(self.swap.active_symbols)}个, '
+                f'爆仓: {self.is_liquidated})')
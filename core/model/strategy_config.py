@@ -17,9 +17,11 @@ from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
+import polars as pl
 
 from core.utils.factor_hub import FactorHub
 from core.utils.log_kit import logger
+from core.utils.selection_master import rank_column_name
 from core.utils.strategy_hub import DummyStrategy, PositionStrategyHub
 
 
@@ -223,6 +225,55 @@ def filter_common(df, filter_list):
     return condition
 
 
+def calc_factor_common_expr(factor_list: List[FactorConfig], cached_cols=()) -> pl.Expr:
+    """
+    calc_factor_common 的 Polars 版本：复合因子 = 各因子截面排名 (method='min') × 权重 之和，累加顺序和 pandas 版本一致
+    :param factor_list: 因子列表
+    :param cached_cols: 选币数据中已经缓存好的排名列，见 `core.utils.selection_master.rank_column_name`
+    """
+    factor_val = pl.lit(0.)
+    for factor_config in factor_list:
+        # 权重为 0，跳过计算
+        if factor_config.weight == 0:
+            continue
+        rank_col = rank_column_name(factor_config.col_name, factor_config.is_sort_asc, 'min', False)
+        if rank_col in cached_cols:
+            _rank = pl.col(rank_col)
+        else:
+            _rank = pl.col(factor_config.col_name).rank(method='min', descending=not factor_config.is_sort_asc).over(
+                'candle_begin_time').cast(pl.Float64)
+        factor_val = factor_val + _rank * factor_config.weight
+    return factor_val
+
+
+def filter_common_expr(filter_list: List[FilterFactorConfig], cached_cols=()) -> pl.Expr:
+    """
+    filter_common 的 Polars 版本，排名使用 method='average'，和 pandas 的 rank 默认值一致
+    :param filter_list: 过滤因子列表
+    :param cached_cols: 选币数据中已经缓存好的排名列，见 `core.utils.selection_master.rank_column_name`
+    """
+    condition = pl.lit(True)
+
+    for filter_config in filter_list:
+        col = pl.col(filter_config.col_name)
+        how = filter_config.method.how
+        if how in ('rank', 'pct'):
+            rank_col = rank_column_name(filter_config.col_name, filter_config.is_sort_asc, 'average', how == 'pct')
+            if rank_col in cached_cols:
+                rank = pl.col(rank_col)
+            else:
+                rank = col.rank(method='average', descending=not filter_config.is_sort_asc).over('candle_begin_time')
+                if how == 'pct':
+                    rank = rank / col.count().over('candle_begin_time')
+            condition = condition & filter_series_by_range(rank, filter_config.method.range)
+        elif how == 'val':
+            condition = condition & filter_series_by_range(col, filter_config.method.range)
+        else:
+            raise ValueError(f'不支持的过滤方式：{how}')
+
+    return condition
+
+
 @dataclass
 class StrategyConfig:
     name: str = 'Strategy'
@@ -349,6 +400,11 @@ class StrategyConfig:
                 set(self.long_filter_list + self.short_filter_list) |
                 set(self.long_filter_list_post + self.short_filter_list_post))
 
+    @property
+    def has_after_merge_index(self) -> bool:
+        # 策略文件实现的 after_merge_index 会在 init 中赋值到实例上，覆盖默认的空实现
+        return 'after_merge_index' in vars(self)
+
     @classmethod
     def init(cls, index: int, file: DummyStrategy = None, **config):
         # 自动补充因子列表
@@ -615,6 +671,62 @@ class StrategyConfig:
 
         return df[left_condition & right_condition].copy(False)
 
+    def select_top_nums(self, total_nums: np.ndarray, coin_num, max_limit=None, min_limit=None) -> np.ndarray:
+        """
+        每个周期最多需要排到第几名，和 select_by_coin_num 的选币数量口径一致，用于 Top-K 排名
+        :param total_nums: 每个周期的总币数
+        :return: 每个周期需要的名次
+        """
+        select_num = (coin_num if isinstance(coin_num, (tuple, list)) else (None, coin_num))[1]
+        if select_num is None:
+            return total_nums.astype(np.int64)  # 没有上限，需要完整排名
+        if int(select_num) == 0:
+            select_num = total_nums * select_num
+            if max_limit:
+                select_num = np.minimum(select_num, max_limit)
+            if min_limit:
+                select_num = np.maximum(select_num, min_limit)
+        else:
+            if max_limit:
+                select_num = min(select_num, max_limit)
+            if min_limit:
+                select_num = max(select_num, min_limit)
+        top_nums = np.floor(np.broadcast_to(np.asarray(select_num, dtype=np.float64), total_nums.shape))
+        return np.clip(top_nums, 0, total_nums).astype(np.int64)
+
+    def select_by_coin_num_expr(self, coin_num, max_limit=None, min_limit=None) -> pl.Expr:
+        """
+        select_by_coin_num 的 Polars 版本，返回选币条件，需要 `rank` 和 `总币数` 两列
+        """
+        select_range = coin_num if isinstance(coin_num, (tuple, list)) else (None, coin_num)
+        select_inclusive = self.select_inclusive if isinstance(self.select_inclusive, (tuple, list)) else (
+            self.select_inclusive, self.select_inclusive)
+
+        def get_select_condition(side_select_num, inclusive, is_left):
+            if side_select_num is None:
+                return pl.lit(True)
+            if int(side_select_num) == 0:
+                select_num = pl.col('总币数') * side_select_num
+                if max_limit:
+                    select_num = select_num.clip(upper_bound=max_limit)
+                if min_limit:
+                    select_num = select_num.clip(lower_bound=min_limit)
+            else:
+                select_num = side_select_num
+                if max_limit:
+                    select_num = min(select_num, max_limit)
+                if min_limit:
+                    select_num = max(select_num, min_limit)
+                select_num = pl.lit(select_num)
+            if is_left:
+                return (pl.col('rank') >= select_num) if inclusive != 'right' else (pl.col('rank') > select_num)
+            return (pl.col('rank') <= select_num) if inclusive != 'left' else (pl.col('rank') < select_num)
+
+        left_condition = get_select_condition(select_range[0], select_inclusive[0], is_left=True)
+        right_condition = get_select_condition(select_range[1], select_inclusive[1], is_left=False)
+
+        return left_condition & right_condition
+
 
 @dataclass
 class PosStrategyConfig:
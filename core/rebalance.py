@@ -21,33 +21,33 @@ LONG_ONLY_EQUITY_RATIO = 0.97
 def calc_target_lots_by_ratio(equity, prices, ratios, lot_sizes):
     """
     根据目标持仓比例，计算目标持仓手数
+    逐个币种计算，只分配返回的目标持仓手数，不产生中间数组
     """
     # 初始化目标持仓手数
     target_lots = np.zeros(len(lot_sizes), dtype=np.int64)
 
-    # 每个币分配目标持仓资金(带方向)
-    target_equity = equity * ratios
-
-    # 同时要求 价格 和 每手币数 都不为 0，如果数据为 0，后面计算出现 除0 操作，造成数据位数溢出
-    mask = np.logical_and(np.abs(target_equity) > 0.01, np.logical_and(prices != 0, lot_sizes != 0))
-
-    # 为有效持仓分配目标持仓手数, 手数 = 目标持仓资金 / 币价 / 每手币数
-    target_lots[mask] = (target_equity[mask] / prices[mask] / lot_sizes[mask]).astype(np.int64)
-
-    # =================================
-    # 最终容错处理：检查并修正极值
-    # =================================
     int64_max = np.iinfo(np.int64).max  # 9223372036854775807
     int64_min = np.iinfo(np.int64).min  # -9223372036854775808
+    n_extreme = 0
+
+    for j in range(len(lot_sizes)):
+        # 每个币分配目标持仓资金(带方向)
+        target_equity = equity * ratios[j]
+
+        # 同时要求 价格 和 每手币数 都不为 0，如果数据为 0，后面计算出现 除0 操作，造成数据位数溢出
+        if abs(target_equity) > 0.01 and prices[j] != 0 and lot_sizes[j] != 0:
+            # 为有效持仓分配目标持仓手数, 手数 = 目标持仓资金 / 币价 / 每手币数
+            target_lots[j] = np.int64(target_equity / prices[j] / lot_sizes[j])
 
-    # 找出存在极值的位置
-    extreme_value_mask = (target_lots == int64_max) | (target_lots == int64_min)
+        # =================================
+        # 最终容错处理：检查并修正极值，如果发现极值，强制设置为0
+        # =================================
+        if target_lots[j] == int64_max or target_lots[j] == int64_min:
+            target_lots[j] = 0
+            n_extreme += 1
 
-    # 如果发现极值，强制设置为0
-    if np.any(extreme_value_mask):
-        extreme_indices = np.where(extreme_value_mask)[0]
-        print(f"警告：发现 {len(extreme_indices)} 个int64极值，已强制设置为0")
-        target_lots[extreme_value_mask] = 0
+    if n_extreme > 0:
+        print(f"警告：发现 {n_extreme} 个int64极值，已强制设置为0")
 
     return target_lots
 
@@ -65,12 +65,24 @@ def calc_delta_lots_amount(target_lots, current_lots, prices, lot_sizes):
 
     # 对需要调仓的 symbol 计算调仓金额(绝对值)
     # 调仓金额 = abs(调仓手数) * 每手币数 * 币价
-    mask = (delta_lots != 0)
-    delta_amount[mask] = np.abs(delta_lots[mask]) * lot_sizes[mask] * prices[mask]
+    for j in range(len(lot_sizes)):
+        if delta_lots[j] != 0:
+            delta_amount[j] = abs(delta_lots[j]) * lot_sizes[j] * prices[j]
 
     return delta_lots, delta_amount
 
 
+@nb.njit
+def abs_sum(values):
+    """
+    绝对值之和，和 np.sum(np.abs(values)) 一致，不产生中间数组
+    """
+    total = 0.
+    for j in range(len(values)):
+        total += abs(values[j])
+    return total
+
+
 @nb.njit
 def filter_deltas(target_lots, current_lots, delta_lots, delta_amount, min_order_limit):
     # (当前持仓手数 == 0) 且 (目标持仓手数 != 0), 是建仓
@@ -124,7 +136,7 @@ class RebAlways:
         is_spot_only = False
 
         # 合约总权重小于极小值，认为是纯多(纯现货)模式
-        if np.sum(np.abs(swap_ratios)) < 1e-6:
+        if abs_sum(swap_ratios) < 1e-6:
             is_spot_only = True
             equity *= LONG_ONLY_EQUITY_RATIO  # 留一部分的资金作为缓冲
 
@@ -196,7 +208,7 @@ class RebByEquityRatio:
         is_spot_only = False
 
         # 合约总权重小于极小值，认为是纯多(纯现货)模式
-        if np.sum(np.abs(swap_ratios)) < 1e-6:
+        if abs_sum(swap_ratios) < 1e-6:
             is_spot_only = True
             equity *= LONG_ONLY_EQUITY_RATIO  # 留一部分的资金作为缓冲
 
@@ -272,7 +284,7 @@ class RebByPositionRatio:
         is_spot_only = False
 
         # 合约总权重小于极小值，认为是纯多(纯现货)模式
-        if np.sum(np.abs(swap_ratios)) < 1e-6:
+        if abs_sum(swap_ratios) < 1e-6:
             is_spot_only = True
             equity *= LONG_ONLY_EQUITY_RATIO  # 留一部分的资金作为缓冲
 
@@ -11,9 +11,10 @@ Author: 邢不行
 """
 import gc
 import os
+import threading
 import time
 import warnings
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import List
 
@@ -22,12 +23,26 @@ import pandas as pd
 import polars as pl
 from tqdm import tqdm
 
+import config
 from config import job_num, factor_col_limit
-from core.factor import calc_factor_vals
+from core.factor import calc_expr_factors_incremental, calc_factor_vals_incremental, \
+    calc_panel_factors_incremental, flush_factor_store, has_signal_expr, has_signal_panel
+from core.kernels.offsets import expand_hold_windows
+from core.kernels.topk import group_starts_by_time, topk_rank_min
 from core.model.backtest_config import BacktestConfig, StrategyConfig
+from core.model.strategy_config import calc_factor_common_expr, filter_common_expr
 from core.utils.factor_hub import FactorHub
 from core.utils.log_kit import logger
 from core.utils.path_kit import get_file_path
+from core.utils.selection_master import SelectionMaster
+from core.utils.shared_candle import SharedCandleStore
+from core.utils.swap_index import SWAP_INDEX_FILE, SwapIndex, load_swap_index
+from core.utils.sparse_ratio import RatioCoords
+
+# 时序因子计算的并行方式，老的 config 中没有该配置时，默认使用多线程
+factor_job_mode = getattr(config, 'factor_job_mode', 'thread')
+# 选币排名方式，老的 config 中没有该配置时，默认只计算需要选中的前 N 名
+select_rank_mode = getattr(config, 'select_rank_mode', 'topk')
 
 warnings.filterwarnings('ignore')
 # pandas相关的显示设置，基础课程都有介绍
@@ -43,6 +58,8 @@ SELECT_RES_COLS = [*KLINE_COLS, 'strategy', 'cap_weight', '方向', 'offset', 't
 # 完整kline数据保存的路径
 ALL_KLINE_PATH_TUPLE = ('data', 'cache', 'all_factors_kline.pkl')
 ALL_KLINE_FULL_PATH_TUPLE = ('data', 'cache', 'all_factors_kline_full.pkl')
+# 现货 -> 合约行索引保存的路径
+SWAP_INDEX_PATH_TUPLE = ('data', 'cache', SWAP_INDEX_FILE)
 
 
 # ======================================================================================
@@ -89,22 +106,49 @@ def trans_period_for_day(df, date_col='candle_begin_time', factor_dict=None):
     return df
 
 
-from core.utils.factor_cache import load_factor_cache, save_factor_cache
-
 # region 因子计算相关函数
-def calc_factors_by_candle(candle_df, conf: BacktestConfig, factor_col_name_list) -> pd.DataFrame:
+def build_kline_with_factor_df(candle_df, factor_series_dict, rows=None) -> pd.DataFrame:
+    """
+    合并K线字段和因子值
+    :param candle_df: 一个币种的k线数据 dataframe
+    :param factor_series_dict: 因子值
+    :param rows: 只保留的行号，为空时保留全部的行。不为空时，因子值需要已经是这些行的数据
+    :return: 包含K线字段和因子的 dataframe，index 是 candle_df 中的行号
+    """
+    kline_dict = {
+        'candle_begin_time': candle_df['candle_begin_time'].values,
+        'symbol': candle_df['symbol'].values,
+        'is_spot': candle_df['is_spot'].values,
+        'close': candle_df['close'].values,
+        # 'has_swap': candle_df['has_swap'],
+        # 'next_avg_price': candle_df['next_avg_price'].values,
+        'next_close': candle_df['close'].shift(-1).values,  # 后面周期排除需要用
+        # 'next_funding_fee': candle_df['funding_fee'].shift(-1).values,
+        'symbol_spot': candle_df['symbol_spot'].astype(str).values,
+        'symbol_swap': candle_df['symbol_swap'].astype(str).values,
+    }
+    trade_vals = candle_df['是否交易'].values
+    if rows is not None:
+        kline_dict = {col: vals[rows] for col, vals in kline_dict.items()}
+        trade_vals = trade_vals[rows]
+
+    return pd.DataFrame({**kline_dict, **factor_series_dict, '是否交易': trade_vals}, index=rows, copy=False)
+
+
+def calc_factors_by_candle(candle_df, conf: BacktestConfig, factor_col_name_list,
+                           panel_factor_dict=None) -> pd.DataFrame:
     """
     针对单一比对，计算所有因子的数值
     :param candle_df: 一个币种的k线数据 dataframe
     :param conf: 回测配置
     :param factor_col_name_list: 需要计算的因子列
+    :param panel_factor_dict: 面板计算好的因子值，需要和 candle_df 的K线时间完全对齐
     :return: 包含所有因子的 dataframe(目前是包含k线数据的）
     """
     # 遍历每个因子，计算每个因子的数据
     factor_series_dict = {}
-    symbol = candle_df['symbol'].iloc[0]
-    first_candle = candle_df['candle_begin_time'].iloc[0]
-    last_candle = candle_df['candle_begin_time'].iloc[-1]
+    if panel_factor_dict:
+        factor_series_dict = {col: vals for col, vals in panel_factor_dict.items() if col in factor_col_name_list}
 
     for factor_name, param_list in conf.factor_params_dict.items():
         factor = FactorHub.get_by_name(factor_name)  # 获取因子信息
@@ -115,43 +159,17 @@ def calc_factors_by_candle(candle_df, conf: BacktestConfig, factor_col_name_list
         factor_param_list = []
         for param in param_list:
             factor_col_name = f'{factor_name}_{param}'
-            if factor_col_name in factor_col_name_list:
+            if factor_col_name in factor_col_name_list and factor_col_name not in factor_series_dict:
                 factor_param_list.append(param)
         if len(factor_param_list) == 0:
             continue  # 当该因子不需要计算的时候直接返回
 
-        # ==========================
-        # 尝试从缓存读取 (L1 优化)
-        # ==========================
-        cached_df = load_factor_cache(symbol, factor_name, factor_param_list, first_candle, last_candle)
-        if cached_df is not None:
-            # 转换为 dict of series
-            for col in cached_df.columns:
-                factor_series_dict[col] = cached_df[col].values
-        else:
-            # 缓存未命中，执行计算
-            res_dict = calc_factor_vals(candle_df, factor_name, factor_param_list)
-            factor_series_dict.update(res_dict)
-            # 保存到缓存
-            save_factor_cache(pd.DataFrame(res_dict), symbol, factor_name, factor_param_list, first_candle, last_candle)
+        # 已经计算过的部分从因子仓库读取，只计算新增的数据
+        res_dict = calc_factor_vals_incremental(candle_df, factor_name, factor_param_list, conf.hold_period_type)
+        factor_series_dict.update(res_dict)
 
     # 将结果 DataFrame 与原始 DataFrame 合并
-    kline_with_factor_dict = {
-        'candle_begin_time': candle_df['candle_begin_time'].values,
-        'symbol': candle_df['symbol'].values,
-        'is_spot': candle_df['is_spot'].values,
-        'close': candle_df['close'].values,
-        # 'has_swap': candle_df['has_swap'],
-        # 'next_avg_price': candle_df['next_avg_price'].values,
-        'next_close': candle_df['close'].shift(-1).values,  # 后面周期排除需要用
-        # 'next_funding_fee': candle_df['funding_fee'].shift(-1).values,
-        'symbol_spot': candle_df['symbol_spot'].astype(str).values,
-        'symbol_swap': candle_df['symbol_swap'].astype(str).values,
-        **factor_series_dict,
-        '是否交易': candle_df['是否交易'].values,
-    }
-
-    kline_with_factor_df = pd.DataFrame(kline_with_factor_dict, copy=False)
+    kline_with_factor_df = build_kline_with_factor_df(candle_df, factor_series_dict)
     kline_with_factor_df.sort_values(by='candle_begin_time', inplace=True)
 
     # 抛弃一开始的一段k线，保留后面的数据
@@ -193,7 +211,8 @@ def calc_factors_by_candle(candle_df, conf: BacktestConfig, factor_col_name_list
     return kline_with_factor_df
 
 
-def process_candle_df(candle_df: pd.DataFrame, conf: BacktestConfig, factor_col_name_list: List[str], idx: int):
+def process_candle_df(candle_df: pd.DataFrame, conf: BacktestConfig, factor_col_name_list: List[str], idx: int,
+                      panel_factor_dict=None):
     """
     # 针对每一个币种的k线数据，按照策略循环计算因子信息
     :param candle_df: 单个币种的数据
@@ -201,7 +220,29 @@ def process_candle_df(candle_df: pd.DataFrame, conf: BacktestConfig, factor_col_
     :param factor_col_name_list:    因子列表，可以用于动态判断当前需要计算的因子列。
                                     当 factor_col_name_list ≠ conf.factor_col_name_list 时，说明需要节省一点内存
     :param idx: 索引
-    :return: 带有因子数值的数据
+    :param panel_factor_dict: 面板计算好的因子值
+    :return: (索引, 带有因子数值的数据, 是否使用了面板计算好的因子值)
+    """
+    candle_df = prepare_candle_df(candle_df, conf)
+
+    # 面板基于原始K线计算，K线时间完全对齐时才能使用，否则逐个币种重新计算
+    panel_accepted = panel_factor_dict is not None and np.array_equal(
+        panel_factor_dict['candle_begin_time'], candle_df['candle_begin_time'].values)
+
+    # 针对单个币种的K线数据计算
+    # 返回带有因子数值的K线数据
+    factor_df = calc_factors_by_candle(candle_df, conf, factor_col_name_list,
+                                       panel_factor_dict if panel_accepted else None)
+
+    return idx, factor_df, panel_accepted
+
+
+def prepare_candle_df(candle_df: pd.DataFrame, conf: BacktestConfig) -> pd.DataFrame:
+    """
+    计算因子之前的K线预处理：策略的 after_merge_index、平均开盘价格、日线转换
+    :param candle_df: 单个币种的数据
+    :param conf: backtest config
+    :return: 预处理之后的K线数据
     """
     # ==== 数据预处理 ====
     factor_dict = {'first_candle_time': 'first', 'last_candle_time': 'last'}
@@ -221,11 +262,83 @@ def process_candle_df(candle_df: pd.DataFrame, conf: BacktestConfig, factor_col_
     # 清理掉头部参与日线转换的填充数据
     candle_df.dropna(subset=['symbol'], inplace=True)
     candle_df.reset_index(drop=True, inplace=True)
-    # 针对单个币种的K线数据计算
-    # 返回带有因子数值的K线数据
-    factor_df = calc_factors_by_candle(candle_df, conf, factor_col_name_list)
+    return candle_df
+
+
+# 子进程中挂载的共享内存K线数据和回测配置，由 init_factor_worker 初始化
+_worker_shared_candle: SharedCandleStore | None = None
+_worker_conf: BacktestConfig | None = None
+
+
+def init_factor_worker(spec, conf: BacktestConfig):
+    """
+    多进程因子计算的子进程初始化：挂载共享内存中的K线数据
+    :param spec: 共享内存K线数据的描述
+    :param conf: 回测配置
+    """
+    global _worker_shared_candle, _worker_conf
+    _worker_shared_candle = SharedCandleStore.attach(spec)
+    _worker_conf = conf
+
+
+def process_shared_candle_df(factor_col_name_list: List[str], idx: int, panel_col_name_list=()):
+    """
+    多进程模式下，子进程计算单个币种的因子
+
+    预处理之后的K线和原始K线完全一致时（小时线，并且没有策略实现 after_merge_index），
+    面板因子和K线字段都由主进程使用 merge_shared_factor_df 合并，子进程只计算并返回其余的因子列，
+    index 是原始K线中的行号，避免在进程之间来回序列化面板因子和K线数据。
+    :param factor_col_name_list: 因子列表
+    :param idx: 币种序号
+    :param panel_col_name_list: 主进程中面板计算好的因子列
+    :return: (索引, 因子数据, 是否只包含因子列)
+    """
+    candle_df = _worker_shared_candle.get_candle_df(idx)
+    candle_times = candle_df['candle_begin_time'].values
+    candle_df = prepare_candle_df(candle_df, _worker_conf)
+
+    aligned = not any(strategy.has_after_merge_index for strategy in _worker_conf.strategy_list) and \
+        np.array_equal(candle_times, candle_df['candle_begin_time'].values)
+    if not aligned:
+        # K线被修改过，面板因子不能使用，全部因子在子进程中计算
+        return idx, calc_factors_by_candle(candle_df, _worker_conf, factor_col_name_list), False
+
+    calc_col_list = [col for col in factor_col_name_list if col not in panel_col_name_list]
+    factor_df = calc_factors_by_candle(candle_df, _worker_conf, calc_col_list)
+    return idx, factor_df[calc_col_list], True
+
+
+def merge_shared_factor_df(candle_df: pd.DataFrame, factor_df: pd.DataFrame, panel_factor_dict=None) -> pd.DataFrame:
+    """
+    主进程中合并子进程返回的因子列、面板因子和K线字段，参考 process_shared_candle_df
+    :param candle_df: 单个币种的原始K线数据
+    :param factor_df: 子进程返回的因子列，index 是原始K线中的行号
+    :param panel_factor_dict: 面板计算好的因子值
+    :return: 带有因子数值的数据，和 process_candle_df 的结果一致
+    """
+    rows = factor_df.index.values
+    factor_series_dict = {col: vals[rows] for col, vals in (panel_factor_dict or {}).items()
+                          if col != 'candle_begin_time'}
+    factor_series_dict.update({col: factor_df[col].values for col in factor_df.columns})
+    return build_kline_with_factor_df(candle_df, factor_series_dict, rows)
+
 
-    return idx, factor_df
+def create_factor_executor(candle_df_list: List[pd.DataFrame], conf: BacktestConfig):
+    """
+    创建多进程因子计算的进程池，K线数据放到共享内存中
+    :param candle_df_list: 所有币种的K线数据
+    :param conf: 回测配置
+    :return: (进程池, 共享内存K线数据)，使用完之后需要 shutdown 和 unlink
+    """
+    logger.debug('📦 K线数据放入共享内存，使用多进程计算因子...')
+    shared_candle = SharedCandleStore.create(candle_df_list)
+    try:
+        executor = ProcessPoolExecutor(max_workers=job_num, initializer=init_factor_worker,
+                                       initargs=(shared_candle.spec, conf))
+    except BaseException:
+        shared_candle.unlink()
+        raise
+    return executor, shared_candle
 
 
 def calc_factors(conf: BacktestConfig):
@@ -271,81 +384,147 @@ def calc_factors(conf: BacktestConfig):
     all_kline_full_pkl = get_file_path(*ALL_KLINE_FULL_PATH_TUPLE, as_path_type=True)
     all_kline_full_pkl.unlink(missing_ok=True)
 
-    for shard_index in shards:
-        logger.info(f'因子分片计算中，进度：{int(shard_index / factor_col_limit) + 1}/{len(shards)}')
-        factor_col_name_list = conf.factor_col_name_list[shard_index:shard_index + factor_col_limit]
-
-        all_factor_df_list = []
+    swap_index_path = get_file_path(*SWAP_INDEX_PATH_TUPLE, as_path_type=True)
+    swap_index_path.unlink(missing_ok=True)
+
+    # 小时线的时候，实现了 signal_expr 的因子在 polars 中一次性计算所有币种，
+    # 实现了 signal_panel 的因子使用面板一次性计算所有币种
+    # 日线需要逐个币种转换周期，仍然使用逐个币种计算
+    # 表达式和面板都基于原始K线计算，策略实现了 after_merge_index 会修改K线，也需要逐个币种计算
+    factor_list = [FactorHub.get_by_name(factor_name) for factor_name in conf.factor_params_dict.keys()]
+    merge_hooked = any(strategy.has_after_merge_index for strategy in conf.strategy_list)
+    use_expr = not conf.is_day_period and not merge_hooked and candle_pq_path.exists() and \
+        any(map(has_signal_expr, factor_list))
+    use_panel = not conf.is_day_period and not merge_hooked and any(map(has_signal_panel, factor_list))
+
+    # 多进程模式：K线数据只放一次到共享内存，子进程零拷贝挂载，避免 DataFrame 的序列化开销
+    factor_executor, shared_candle = None, None
+    if factor_job_mode == 'process':
+        factor_executor, shared_candle = create_factor_executor(candle_df_list, conf)
+
+    try:
+        for shard_index in shards:
+            logger.info(f'因子分片计算中，进度：{int(shard_index / factor_col_limit) + 1}/{len(shards)}')
+            factor_col_name_list = conf.factor_col_name_list[shard_index:shard_index + factor_col_limit]
+
+            all_factor_df_list = []
+
+            # 表达式和面板的计算结果被使用之后，再写入因子仓库
+            panel_factor_list, store_list = None, [[] for _ in candle_df_list]
+            if use_expr:
+                logger.debug('🧮 Polars 表达式因子计算...')
+                panel_factor_list = calc_expr_factors_incremental(
+                    candle_df_list, candle_pq_path, conf.factor_params_dict, factor_col_name_list,
+                    conf.hold_period_type, job_num, store_list)
+            if use_panel:
+                # 和逐个币种计算一样，面板只计算因子仓库中缺失的部分
+                logger.debug('🧮 面板因子计算...')
+                panel_factor_list = calc_panel_factors_incremental(
+                    candle_df_list, conf.factor_params_dict, factor_col_name_list, panel_factor_list,
+                    conf.hold_period_type, job_num, store_list)
+            if panel_factor_list is None:
+                panel_factor_list = [None] * len(candle_df_list)
         
-        # V2 优化：如果缓存命中率高，并行反而更慢 (序列化开销 > 计算开销)
-        # 这里我们使用 ThreadPoolExecutor 替代 ProcessPoolExecutor，因为大部分操作是 I/O (读缓存)
-        # 且避免了 DataFrames 的序列化开销
-        from concurrent.futures import ThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=job_num) as executor:
-            futures = [executor.submit(
-                process_candle_df, candle_df, conf, factor_col_name_list, candle_idx
-            ) for candle_idx, candle_df in enumerate(candle_df_list)]
-
-            for future in tqdm(as_completed(futures), total=len(candle_df_list), desc='🧮 时序因子计算'):
-                idx, factor_df = future.result()
-                all_factor_df_list.append(factor_df)
-
-        # ====================================================================================================
-        # 3. ** 合并因子结果 **
-        # 合并并整理所有K线，到这里因子计算完成
-        # ====================================================================================================
-        all_factors_df = pd.concat(all_factor_df_list, ignore_index=True)
-        all_factors_df['symbol'] = pd.Categorical(all_factors_df['symbol'])
-
-        del all_factor_df_list
-
-        # ====================================================================================================
-        # 4. ** 因子结果分片存储 **
-        # 分片存储计算结果，节省内存占用，提高选币效率
-        # - 将合并好的df，分成2个部分：k线和因子列
-        # - k线数据存储为一个pkl，每一列因子存储为一个pkl，在选币时候按需读入合并成df
-        # ====================================================================================================
-        logger.debug('💾 分片存储因子结果...')
-
-        # 选币需要的k线
-        if not all_kline_pkl.exists():
-            # 存储裁切时间的数据
-            all_kline_df = all_factors_df[KLINE_COLS].sort_values(by=['candle_begin_time', 'symbol', 'is_spot'])
-            all_kline_df = all_kline_df[
-                (all_kline_df['candle_begin_time'] >= pd.to_datetime(conf.start_date)) &
-                (all_kline_df['candle_begin_time'] < pd.to_datetime(conf.end_date))]
-            all_kline_df.to_pickle(all_kline_pkl)
-            # 同时保存 Parquet (V2 优化)
-            all_kline_df.to_parquet(all_kline_pkl.with_suffix('.parquet'), index=False)
-
-        if not all_kline_full_pkl.exists() and conf.has_section_factor:
-            # 存储不裁切的全量数据
-            all_kline_full_df = all_factors_df[KLINE_COLS].sort_values(by=['candle_begin_time', 'symbol', 'is_spot'])
-            all_kline_full_df.to_pickle(all_kline_full_pkl)
-            all_kline_full_df.to_parquet(all_kline_full_pkl.with_suffix('.parquet'), index=False)
-
-        # 针对每一个因子进行存储
-        cut_factors_df = all_factors_df[
-                (all_factors_df['candle_begin_time'] >= pd.to_datetime(conf.start_date)) &
-                (all_factors_df['candle_begin_time'] < pd.to_datetime(conf.end_date))]
-        # V2 优化：将因子分片存储为单个 Parquet 文件，极大减少文件操作开销
-        shard_pq = get_file_path('data', 'cache', f'factors_shard_{shard_index}.parquet', as_path_type=True)
-        shard_pq.unlink(missing_ok=True)
+            if factor_executor is not None:
+                # 多进程模式：只传递币种序号和面板计算好的因子列名，子进程从共享内存中读取K线，
+                # 面板因子留在主进程中合并
+                panel_col_name_list = [col for col in (panel_factor_list[0] or {}) if col != 'candle_begin_time'] \
+                    if panel_factor_list else []
+                futures = [factor_executor.submit(
+                    process_shared_candle_df, factor_col_name_list, candle_idx, panel_col_name_list
+                ) for candle_idx in range(len(candle_df_list))]
+
+                for future in tqdm(as_completed(futures), total=len(candle_df_list), desc='🧮 时序因子计算'):
+                    idx, factor_df, aligned = future.result()
+                    if aligned:
+                        factor_df = merge_shared_factor_df(candle_df_list[idx], factor_df, panel_factor_list[idx])
+                    else:
+                        store_list[idx].clear()
+                    all_factor_df_list.append(factor_df)
+            else:
+                # V2 优化：如果缓存命中率高，并行反而更慢 (序列化开销 > 计算开销)
+                # 这里我们使用 ThreadPoolExecutor 替代 ProcessPoolExecutor，因为大部分操作是 I/O (读缓存)
+                # 且避免了 DataFrames 的序列化开销
+                from concurrent.futures import ThreadPoolExecutor
+                with ThreadPoolExecutor(max_workers=job_num) as executor:
+                    futures = [executor.submit(
+                        process_candle_df, candle_df, conf, factor_col_name_list, candle_idx,
+                        panel_factor_list[candle_idx]
+                    ) for candle_idx, candle_df in enumerate(candle_df_list)]
+
+                    for future in tqdm(as_completed(futures), total=len(candle_df_list), desc='🧮 时序因子计算'):
+                        idx, factor_df, panel_accepted = future.result()
+                        all_factor_df_list.append(factor_df)
+                        if not panel_accepted:
+                            store_list[idx].clear()
+
+            # 没有被使用的面板结果已经丢弃，剩下的写入因子仓库
+            with ThreadPoolExecutor(max_workers=job_num) as executor:
+                list(executor.map(flush_factor_store, store_list))
+            del panel_factor_list, store_list
+
+            # ====================================================================================================
+            # 3. ** 合并因子结果 **
+            # 合并并整理所有K线，到这里因子计算完成
+            # ====================================================================================================
+            all_factors_df = pd.concat(all_factor_df_list, ignore_index=True)
+            all_factors_df['symbol'] = pd.Categorical(all_factors_df['symbol'])
+
+            del all_factor_df_list
+
+            # ====================================================================================================
+            # 4. ** 因子结果分片存储 **
+            # 分片存储计算结果，节省内存占用，提高选币效率
+            # - 将合并好的df，分成2个部分：k线和因子列
+            # - k线数据存储为一个pkl，每一列因子存储为一个pkl，在选币时候按需读入合并成df
+            # ====================================================================================================
+            logger.debug('💾 分片存储因子结果...')
+
+            # 选币需要的k线
+            if not all_kline_pkl.exists():
+                # 存储裁切时间的数据
+                all_kline_df = all_factors_df[KLINE_COLS].sort_values(by=['candle_begin_time', 'symbol', 'is_spot'])
+                all_kline_df = all_kline_df[
+                    (all_kline_df['candle_begin_time'] >= pd.to_datetime(conf.start_date)) &
+                    (all_kline_df['candle_begin_time'] < pd.to_datetime(conf.end_date))]
+                all_kline_df.to_pickle(all_kline_pkl)
+                # 同时保存 Parquet (V2 优化)
+                all_kline_df.to_parquet(all_kline_pkl.with_suffix('.parquet'), index=False)
+                # 现货 -> 合约的行索引，整理选币结果时直接取数，不需要再读取K线数据
+                SwapIndex.from_kline(all_kline_df).save(swap_index_path)
+
+            if not all_kline_full_pkl.exists() and conf.has_section_factor:
+                # 存储不裁切的全量数据
+                all_kline_full_df = all_factors_df[KLINE_COLS].sort_values(by=['candle_begin_time', 'symbol', 'is_spot'])
+                all_kline_full_df.to_pickle(all_kline_full_pkl)
+                all_kline_full_df.to_parquet(all_kline_full_pkl.with_suffix('.parquet'), index=False)
+
+            # 针对每一个因子进行存储
+            cut_factors_df = all_factors_df[
+                    (all_factors_df['candle_begin_time'] >= pd.to_datetime(conf.start_date)) &
+                    (all_factors_df['candle_begin_time'] < pd.to_datetime(conf.end_date))]
+            # V2 优化：将因子分片存储为单个 Parquet 文件，极大减少文件操作开销
+            shard_pq = get_file_path('data', 'cache', f'factors_shard_{shard_index}.parquet', as_path_type=True)
+            shard_pq.unlink(missing_ok=True)
         
-        # 确保列都存在
-        valid_cols = [c for c in factor_col_name_list if c in all_factors_df.columns]
-        save_cols = ['candle_begin_time', 'symbol', 'is_spot'] + valid_cols
+            # 确保列都存在
+            valid_cols = [c for c in factor_col_name_list if c in all_factors_df.columns]
+            save_cols = ['candle_begin_time', 'symbol', 'is_spot'] + valid_cols
         
-        if conf.has_section_factor:
-            shard_full_pq = get_file_path('data', 'cache', f'factors_full_shard_{shard_index}.parquet', as_path_type=True)
-            shard_full_pq.unlink(missing_ok=True)
-            all_factors_df[save_cols].to_parquet(shard_full_pq, index=False)
+            if conf.has_section_factor:
+                shard_full_pq = get_file_path('data', 'cache', f'factors_full_shard_{shard_index}.parquet', as_path_type=True)
+                shard_full_pq.unlink(missing_ok=True)
+                all_factors_df[save_cols].to_parquet(shard_full_pq, index=False)
             
-        cut_factors_df[save_cols].to_parquet(shard_pq, index=False)
+            cut_factors_df[save_cols].to_parquet(shard_pq, index=False)
 
-        del all_factors_df, cut_factors_df
+            del all_factors_df, cut_factors_df, panel_factor_list
 
-        gc.collect()
+            gc.collect()
+    finally:
+        if factor_executor is not None:
+            factor_executor.shutdown()
+            shared_candle.unlink()
 
 
 def process_factor_df(factor_col_name):
@@ -467,12 +646,14 @@ def calc_select_factor_rank(df, factor_column='因子', ascending=True):
     
     # 计算分组排名和相关统计
     # descending 参数与 Pandas ascending 相反
+    # 选币数据已经按照 (candle_begin_time, symbol) 排好序，这里不再对整张表排序，
+    # 选完币之后只对选中的少量数据按照 rank 排序，见 `select_long_and_short_coin`
     pl_result = pl_df.with_columns([
         pl.col(factor_column).rank(method='min', descending=not ascending).over('candle_begin_time').alias('rank'),
     ]).with_columns([
         pl.col('rank').max().over('candle_begin_time').alias('rank_max'),
         pl.col('symbol').count().over('candle_begin_time').alias('总币数'),
-    ]).sort(['candle_begin_time', 'rank']).collect()
+    ]).collect()
     
     # 转换回 Pandas DataFrame
     result_df = pl_result.to_pandas()
@@ -527,7 +708,9 @@ def select_long_and_short_coin(strategy: StrategyConfig, long_df: pd.DataFrame,
 
     # ===整理数据
     df = pd.concat([long_df, short_df], ignore_index=True)  # 将做多和做空的币种数据合并
-    df.sort_values(by=['candle_begin_time', '方向'], ascending=[True, False], inplace=True)
+    # 只对选中的币排序：先多后空，同一方向内按照排名
+    df.sort_values(by=['candle_begin_time', '方向', 'rank'], ascending=[True, False, True], kind='stable',
+                   inplace=True)
     df.reset_index(drop=True, inplace=True)
 
     del df['总币数'], df['rank_max']
@@ -600,7 +783,131 @@ def select_coins_by_strategy(factor_df, stg_conf: StrategyConfig):
     return factor_df[[*KLINE_COLS, '方向', 'target_alloc_ratio']]
 
 
-def process_strategy(stg_conf: StrategyConfig, result_folder: Path, is_silent=False, unified_time='2017-01-01', factor_df=None):
+def calc_topk_rank(s: pl.Series, factor_column, ascending, top_nums_func) -> pl.Series:
+    """
+    Top-K 排名：每个周期只计算前 N 名的排名（method='min'），其他为 0
+    :param s: 包含 candle_begin_time 和因子列的 struct，已经按照时间排好序
+    :param factor_column: 因子列
+    :param ascending: 排名顺序
+    :param top_nums_func: 根据每个周期的总币数，计算每个周期需要的名次
+    :return: 排名
+    """
+    times = s.struct.field('candle_begin_time').to_numpy()
+    values = s.struct.field(factor_column).cast(pl.Float64).to_numpy()
+    group_starts = group_starts_by_time(times)
+    top_nums = top_nums_func(np.diff(group_starts))
+    return pl.Series('rank', topk_rank_min(values, group_starts, top_nums, ascending))
+
+
+def select_coins_by_strategy_pl(factor_lf: pl.LazyFrame, stg_conf: StrategyConfig) -> pd.DataFrame:
+    """
+    针对使用配置因子（use_custom_func=False）的策略，全部在 Polars LazyFrame 上完成选币，最后只 collect 一次：
+    - 计算复合选币因子（各因子排名 × 权重）
+    - 前置过滤（rank / pct / val）
+    - 计算排名，根据选币数量选币
+    - 后置过滤
+    - 根据多空比调整币种的权重
+    和 `select_coins_by_strategy` 的计算口径一致
+    :param factor_lf: 选币数据，已经按照 (candle_begin_time, symbol) 排好序
+    :param stg_conf: 策略配置
+    :return: 选币数据
+    """
+    # 选币数据中已经缓存好的截面排名，直接使用
+    cached_cols = {col for col in factor_lf.collect_schema().names() if col.startswith('__rank_')}
+
+    # 计算复合选币因子
+    factor_lf = factor_lf.with_columns(
+        calc_factor_common_expr(stg_conf.long_factor_list, cached_cols).alias(stg_conf.long_factor))
+    if stg_conf.short_factor != stg_conf.long_factor:
+        factor_lf = factor_lf.with_columns(
+            calc_factor_common_expr(stg_conf.short_factor_list, cached_cols).alias(stg_conf.short_factor))
+
+    def select_side(side_lf, factor_column, ascending, side_condition, top_nums_func=None):
+        # 计算排名，并根据选币数量选币
+        if top_nums_func is None:
+            rank_expr = pl.col(factor_column).rank(method='min', descending=not ascending).over('candle_begin_time')
+        else:
+            # Top-K：只计算每个周期前 N 名的排名，其他为 0，不会被选中
+            rank_expr = pl.struct('candle_begin_time', factor_column).map_batches(
+                lambda s: calc_topk_rank(s, factor_column, ascending, top_nums_func), return_dtype=pl.Int64)
+            side_condition = side_condition & (pl.col('rank') > 0)
+        side_lf = side_lf.with_columns(
+            rank_expr.alias('rank'),
+            pl.col('symbol').count().over('candle_begin_time').alias('总币数'),
+        )
+        return side_lf.filter(side_condition)
+
+    def top_nums_getter(coin_num, max_limit=None, min_limit=None):
+        if select_rank_mode != 'topk':
+            return None
+        return lambda total_nums: stg_conf.select_top_nums(total_nums, coin_num, max_limit, min_limit)
+
+    def with_ratio(side_lf, direction):
+        return side_lf.with_columns(
+            pl.lit(direction, dtype=pl.Int64).alias('方向'),
+            (1 / pl.len().over('candle_begin_time')).alias('target_alloc_ratio'),
+        )
+
+    select_cols = [*KLINE_COLS, *stg_conf.factor_columns, 'rank']
+    side_list = []
+    long_lf = None
+    if stg_conf.long_cap_weight > 0:
+        long_lf = factor_lf.filter(filter_common_expr(stg_conf.long_filter_list, cached_cols))
+        long_lf = select_side(long_lf, stg_conf.long_factor, True, stg_conf.select_by_coin_num_expr(
+            stg_conf.long_select_coin_num, max_limit=stg_conf.long_select_coin_num_max), top_nums_getter(
+            stg_conf.long_select_coin_num, max_limit=stg_conf.long_select_coin_num_max))
+        long_lf = with_ratio(long_lf, 1).select([*select_cols, '方向', 'target_alloc_ratio'])
+        side_list.append(long_lf)
+
+    if stg_conf.short_cap_weight > 0:
+        short_lf = factor_lf.filter(filter_common_expr(stg_conf.short_filter_list, cached_cols))
+        short_lf = short_lf.filter(pl.col('symbol_swap').ne_missing(''))  # 保留有合约的现货
+        if stg_conf.short_select_coin_num == 'long_nums':
+            # 空头与多头的选币数量保持一致
+            long_select_num = long_lf.group_by('candle_begin_time').agg(pl.len().alias('多头数量'))
+            short_lf = select_side(short_lf, stg_conf.short_factor, False, pl.lit(True))
+            short_lf = short_lf.join(long_select_num, on='candle_begin_time', how='left', maintain_order='left')
+            short_lf = short_lf.filter(pl.col('rank') <= pl.col('多头数量'))
+        else:
+            short_lf = select_side(short_lf, stg_conf.short_factor, False, stg_conf.select_by_coin_num_expr(
+                stg_conf.short_select_coin_num, min_limit=stg_conf.short_select_coin_num_min), top_nums_getter(
+                stg_conf.short_select_coin_num, min_limit=stg_conf.short_select_coin_num_min))
+        short_lf = with_ratio(short_lf, -1).select([*select_cols, '方向', 'target_alloc_ratio'])
+        side_list.append(short_lf)
+
+    # 先多后空，同一方向内按照排名
+    result_lf = pl.concat(side_list, how='vertical_relaxed').sort(
+        ['candle_begin_time', '方向', 'rank'], descending=[False, True, False], maintain_order=True)
+
+    # 后置过滤
+    long_condition = (pl.col('方向') == 1) & filter_common_expr(stg_conf.long_filter_list_post)
+    short_condition = (pl.col('方向') == -1) & filter_common_expr(stg_conf.short_filter_list_post)
+    result_lf = result_lf.filter(long_condition | short_condition)
+
+    # 根据多空比调整币种的权重
+    long_ratio = stg_conf.long_cap_weight / (stg_conf.long_cap_weight + stg_conf.short_cap_weight)
+    result_lf = result_lf.with_columns(
+        pl.when(pl.col('方向') == 1)
+        .then(pl.col('target_alloc_ratio') * long_ratio)
+        .otherwise(pl.col('target_alloc_ratio') * (1 - long_ratio))
+        .alias('target_alloc_ratio')
+    ).filter(pl.col('target_alloc_ratio').abs() > 1e-9)  # 去除权重为0的数据
+
+    return result_lf.select([*KLINE_COLS, '方向', 'target_alloc_ratio']).collect().to_pandas()
+
+
+def process_strategy(stg_conf: StrategyConfig, result_folder: Path, is_silent=False, unified_time='2017-01-01',
+                     factor_df=None, save_result=True) -> pd.DataFrame:
+    """
+    单个子策略选币
+    :param stg_conf: 策略配置
+    :param result_folder: 选币结果文件夹
+    :param is_silent: 是否静默
+    :param unified_time: offset 的参考时间
+    :param factor_df: 选币主数据集，为空时从硬盘读取
+    :param save_result: 是否把选币结果保存成 pkl，不保存时只在内存中返回
+    :return: 选币结果
+    """
     import logging
     if is_silent:
         logger.setLevel(logging.WARNING)  # 可以减少中间输出的log
@@ -610,43 +917,23 @@ def process_strategy(stg_conf: StrategyConfig, result_folder: Path, is_silent=Fa
 
     # 准备选币用数据 (V2 - L6 优化: 极其重要！此时 factor_df 已经是合并好的 Master DataSet)
     # 直接使用，不再进行任何磁盘读取或 Join
-    if factor_df is None:
-        import polars as pl
-        all_kline_pq = get_file_path(*ALL_KLINE_PATH_TUPLE, as_path_type=True).with_suffix('.parquet')
-        factor_df = pl.read_parquet(all_kline_pq).to_pandas() if all_kline_pq.exists() else pd.DataFrame()
-
-    factor_df = factor_df[factor_df['是否交易'] == 1]
-
-    select_scope = stg_conf.select_scope
-    order_first = stg_conf.order_first
-    if select_scope == 'spot':
-        condition = (factor_df['is_spot'] == 1)
-    elif select_scope == 'swap':
-        condition = (factor_df['is_spot'] == 0)
-    else:  # mix 混合
-        both_not_null = (factor_df['symbol_spot'] != '') & (factor_df['symbol_swap'] != '')
-        # 根据优先下单，处理选币的币种
-        order_first_symbol = (factor_df['is_spot'] == (1 if order_first == 'spot' else 0))
-        condition = (~both_not_null | order_first_symbol)
-    factor_df = factor_df.loc[condition, :].copy()
-
-    factor_df.dropna(subset=stg_conf.factor_columns, inplace=True)
-    factor_df.dropna(subset=['symbol'], how='any', inplace=True)
-
-    factor_df.sort_values(by=['candle_begin_time', 'symbol'], inplace=True)
-    factor_df.reset_index(drop=True, inplace=True)
-
-    logger.debug(f'[{stg_conf.name}] 选币数据准备完成，消耗时间：{time.time() - s:.2f}s')
-
-    result_df = select_coins_by_strategy(factor_df, stg_conf)
+    factor_df = load_selection_master() if factor_df is None else build_selection_master(factor_df)
+
+    # 主数据集已经排好序，并且预先计算好了 是否交易、选币范围、因子非空 的条件，这里只按行取数
+    if stg_conf.use_custom_func:
+        factor_df = factor_df.strategy_view(stg_conf)
+        logger.debug(f'[{stg_conf.name}] 选币数据准备完成，消耗时间：{time.time() - s:.2f}s')
+        result_df = select_coins_by_strategy(factor_df, stg_conf)
+    else:
+        # 配置因子的策略，全程使用 Polars 选币，不需要转换成 pandas
+        factor_df = factor_df.strategy_lazy_view(stg_conf)
+        result_df = select_coins_by_strategy_pl(factor_df, stg_conf)
+    del factor_df
     # 用于缓存选币结果，如果结果为空，也会生成对应的，空的pkl文件
     stg_select_result = result_folder / f'{stg_conf.get_fullname(as_folder_name=True)}.pkl'
 
     if result_df.empty:
-        pd.DataFrame(columns=SELECT_RES_COLS).to_pickle(stg_select_result)
-        return
-
-    del factor_df
+        return save_empty_select_result(stg_select_result, save_result)
 
     # 筛选合适的offset
     cal_offset_base_seconds = 3600 * 24 if stg_conf.is_day_period else 3600
@@ -657,9 +944,7 @@ def process_strategy(stg_conf: StrategyConfig, result_folder: Path, is_silent=Fa
     result_df = result_df[result_df['offset'].isin(stg_conf.offset_list)]
 
     if result_df.empty:
-        pd.DataFrame(columns=SELECT_RES_COLS).to_pickle(stg_select_result)
-        logger.setLevel(logging.DEBUG)
-        return
+        return save_empty_select_result(stg_select_result, save_result)
 
     # 添加其他的相关选币信息
     select_result_dict = dict()
@@ -683,14 +968,45 @@ def process_strategy(stg_conf: StrategyConfig, result_folder: Path, is_silent=Fa
         / len(stg_conf.offset_list)
         * select_result_df['方向']
     )
-    select_result_df['order_first'] = order_first
+    select_result_df['order_first'] = stg_conf.order_first
+
+    select_result_df = select_result_df[SELECT_RES_COLS]
 
     # 缓存到本地文件
-    select_result_df[SELECT_RES_COLS].to_pickle(stg_select_result)
+    if save_result:
+        select_result_df.to_pickle(stg_select_result)
 
     logger.debug(f'[{strategy_name}] 耗时: {(time.time() - s):.2f}s')
     gc.collect()
     logger.setLevel(logging.DEBUG)
+    return select_result_df
+
+
+def save_empty_select_result(stg_select_result: Path, save_result=True) -> pd.DataFrame:
+    import logging
+    select_result_df = pd.DataFrame(columns=SELECT_RES_COLS)
+    if save_result:
+        select_result_df.to_pickle(stg_select_result)
+    logger.setLevel(logging.DEBUG)
+    return select_result_df
+
+
+def build_selection_master(factor_df: pl.DataFrame | pd.DataFrame) -> SelectionMaster:
+    """
+    构建选币主数据集，除了 KLINE_COLS 之外的列都是因子列，子策略只会取自己需要的因子列
+    :param factor_df: 合并好的因子数据，Polars 或者 pandas DataFrame
+    :return: 选币主数据集
+    """
+    if isinstance(factor_df, SelectionMaster):
+        return factor_df
+    factor_columns = [col for col in factor_df.columns if col not in KLINE_COLS]
+    return SelectionMaster(factor_df, factor_columns=factor_columns)
+
+
+def load_selection_master() -> SelectionMaster:
+    all_kline_pq = get_file_path(*ALL_KLINE_PATH_TUPLE, as_path_type=True).with_suffix('.parquet')
+    factor_df = pl.read_parquet(all_kline_pq) if all_kline_pq.exists() else pd.DataFrame()
+    return build_selection_master(factor_df)
 
 
 # 选币数据整理 & 选币
@@ -713,23 +1029,38 @@ def select_coin_with_conf(conf: BacktestConfig, multi_process=True, silent=True)
     # ====================================================================================================
     result_folder = conf.get_result_folder()  # 选币结果文件夹
 
+    # 所有子策略共用一份排好序的选币主数据集
+    master = getattr(conf, 'shared_factor_df', None)
+    if not isinstance(master, SelectionMaster):
+        master = load_selection_master() if master is None else build_selection_master(master)
+        master.prepare_rank_cache(conf.strategy_list)  # 同一个配置内，子策略共用截面排名
+
+    # 选币结果直接保存在内存中，交给 concat_select_results 聚合，只有配置了 reserved_cache 才会保存子策略的 pkl
+    save_result = conf.is_reserved('strategy')
+    select_result_dict = {}
+
     if not multi_process:
         for index, strategy in enumerate(conf.strategy_list):
             logger.debug(f'ℹ️ [{index + 1}/{len(conf.strategy_list)}] {conf.name}')
-            process_strategy(strategy, result_folder, False, conf.unified_time)
-        return
-
-    # 多进程模式 -> V2 ThreadPool 模式 (避免 3.4GB Pickle 开销)
-    from concurrent.futures import ThreadPoolExecutor
-    with ThreadPoolExecutor(max_workers=job_num) as executor:
-        futures = [executor.submit(process_strategy, stg, result_folder, silent, conf.unified_time, getattr(conf, 'shared_factor_df', None)) for stg in conf.strategy_list]
-
-        for future in tqdm(as_completed(futures), total=len(conf.strategy_list), desc=f'🚀 {conf.name}'):
-            try:
-                future.result()
-            except Exception as e:
-                logger.exception(e)
-                exit(1)
+            select_result_dict[index] = process_strategy(strategy, result_folder, False, conf.unified_time, master,
+                                                         save_result)
+    else:
+        # 多进程模式 -> V2 ThreadPool 模式 (避免 3.4GB Pickle 开销)
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=job_num) as executor:
+            futures = {executor.submit(process_strategy, stg, result_folder, silent, conf.unified_time, master,
+                                       save_result): index for index, stg in enumerate(conf.strategy_list)}
+
+            for future in tqdm(as_completed(futures), total=len(conf.strategy_list), desc=f'🚀 {conf.name}'):
+                try:
+                    select_result_dict[futures[future]] = future.result()
+                except Exception as e:
+                    logger.exception(e)
+                    exit(1)
+
+    # 按照策略的顺序保存
+    conf.select_result_list = [select_result_dict[index] for index in range(len(conf.strategy_list))]
+    conf.shared_factor_df = None  # 选币完成，不再引用主数据集，所有配置选完之后就可以释放内存
     logger.setLevel(logging.DEBUG)  # 日志结果恢复一下
 
 
@@ -744,6 +1075,10 @@ def select_coins(confs: BacktestConfig | List[BacktestConfig], multi_process=Tru
     is_multi = True  
     is_silent = True
     if factor_df is not None:
+        if not isinstance(factor_df, SelectionMaster):
+            # 只排序、索引一次，所有配置共用，截面排名也在所有配置的子策略之间共用
+            factor_df = build_selection_master(factor_df)
+            factor_df.prepare_rank_cache([stg for conf in confs for stg in conf.strategy_list])
         for conf in confs:
             conf.shared_factor_df = factor_df
 
@@ -764,33 +1099,31 @@ def select_coins(confs: BacktestConfig | List[BacktestConfig], multi_process=Tru
 # 选币结果聚合
 # ======================================================================================
 # region 选币结果聚合
-def transfer_swap(select_coin, df_swap):
+def transfer_swap(select_coin, swap_index: SwapIndex):
     """
     将现货中的数据替换成合约数据，主要替换：close
     :param select_coin:     选币数据
-    :param df_swap:         合约数据
+    :param swap_index:      现货 -> 合约的行索引
     :return:
     """
-    trading_cols = ['symbol', 'is_spot', 'close', 'next_close']
-    spot_line_index = select_coin[(select_coin['symbol_swap'] != '') & (select_coin['is_spot'] == 1)].index
+    is_transfer = ((select_coin['symbol_swap'] != '') & (select_coin['is_spot'] == 1)).to_numpy()
 
-    spot_select_coin = select_coin.loc[spot_line_index].copy()
-    swap_select_coin = select_coin.loc[select_coin.index.difference(spot_line_index)].copy()
-    # ['candle_begin_time', 'symbol_swap', 'strategy', 'cap_weight', '方向', 'offset', 'target_alloc_ratio']
-    spot_select_coin = pd.merge(
-        spot_select_coin, df_swap[['candle_begin_time', *trading_cols]],
-        left_on=['candle_begin_time', 'symbol_swap'], right_on=['candle_begin_time', 'symbol'],
-        how='left', suffixes=('', '_2'))
+    spot_select_coin = select_coin[is_transfer]
+    swap_select_coin = select_coin[~is_transfer]
 
-    # merge完成之后，可能因为有些合约数据上线不超过指定的时间（min_kline_num）,造成合并异常，需要按照原现货逻辑执行
-    failed_merge_select_coin = spot_select_coin[spot_select_coin['close_2'].isna()][select_coin.columns].copy()
+    # 根据 (candle_begin_time, symbol_swap) 直接取合约数据的行号
+    rows = swap_index.lookup(spot_select_coin['candle_begin_time'], spot_select_coin['symbol_swap'])
+    close = np.where(rows >= 0, swap_index.close[rows], np.nan)
 
-    spot_select_coin = spot_select_coin.dropna(subset=['close_2'], how='any')
-    spot_select_coin['is_spot_2'] = spot_select_coin['is_spot_2'].astype(np.int8)
+    # 可能因为有些合约数据上线不超过指定的时间（min_kline_num）,造成找不到合约数据，需要按照原现货逻辑执行
+    is_found = ~np.isnan(close)
+    failed_merge_select_coin = spot_select_coin[~is_found]
 
-    spot_select_coin.drop(columns=trading_cols, inplace=True)
-    rename_dict = {f'{trading_col}_2': trading_col for trading_col in trading_cols}
-    spot_select_coin.rename(columns=rename_dict, inplace=True)
+    spot_select_coin = spot_select_coin[is_found].copy()
+    spot_select_coin['symbol'] = spot_select_coin['symbol_swap']
+    spot_select_coin['is_spot'] = np.int8(0)
+    spot_select_coin['close'] = close[is_found]
+    spot_select_coin['next_close'] = swap_index.next_close[rows[is_found]]
 
     # 将拆分的选币数据，合并回去
     select_coin = pd.concat([swap_select_coin, failed_merge_select_coin, spot_select_coin], axis=0)
@@ -799,32 +1132,62 @@ def transfer_swap(select_coin, df_swap):
     return select_coin
 
 
-def concat_select_results(conf: BacktestConfig) -> None:
+# 多个配置并行整理选币结果时，只让一个线程构建索引
+_swap_index_lock = threading.Lock()
+
+
+def load_transfer_swap_index() -> SwapIndex:
+    swap_index_path = get_file_path(*SWAP_INDEX_PATH_TUPLE, as_path_type=True)
+    swap_index = load_swap_index(swap_index_path)
+    if swap_index is not None:
+        return swap_index
+
+    with _swap_index_lock:
+        # 等锁的时候其他线程可能已经构建好了
+        swap_index = load_swap_index(swap_index_path)
+        if swap_index is None:
+            # 老的缓存没有索引，从K线数据构建一次
+            all_kline_df = pd.read_pickle(get_file_path(*ALL_KLINE_PATH_TUPLE))
+            swap_index = SwapIndex.from_kline(all_kline_df)
+            swap_index.save(swap_index_path)
+    return swap_index
+
+
+def concat_select_results(conf: BacktestConfig) -> pd.DataFrame:
     """
-    聚合策略选币结果，形成综合选币结果
+    聚合策略选币结果，形成综合选币结果。
+    优先使用选币时保存在内存中的结果（conf.select_result_list），没有的话读取每个策略的 pkl，
+    只有 reserved_cache 中包含 select 时才会保存 `选币结果.pkl`
     :param conf:
-    :return:
+    :return: 综合选币结果
     """
     # 如果是纯多头现货模式，那么就不转换合约数据，只下现货单
     all_select_result_df_list = []  # 存储每一个策略的选币结果
     result_folder = conf.get_result_folder()
     select_result_path = result_folder / '选币结果.pkl'
 
-    for strategy in conf.strategy_list:
-        stg_select_result = result_folder / f'{strategy.get_fullname(as_folder_name=True)}.pkl'
-        # 如果文件不存在，就跳过
-        if not os.path.exists(stg_select_result):
-            continue
-        # 如果文件存在，就读取
-        all_select_result_df_list.append(pd.read_pickle(stg_select_result))
-        # 删除该策略的选币结果，如果要保留可以注释
-        if not conf.is_reserved('strategy'):
-            stg_select_result.unlink()
+    select_result_list = getattr(conf, 'select_result_list', None)
+    if select_result_list is not None:
+        all_select_result_df_list = [df for df in select_result_list if df is not None]
+        conf.select_result_list = None  # 聚合之后释放内存
+    else:
+        for strategy in conf.strategy_list:
+            stg_select_result = result_folder / f'{strategy.get_fullname(as_folder_name=True)}.pkl'
+            # 如果文件不存在，就跳过
+            if not os.path.exists(stg_select_result):
+                continue
+            # 如果文件存在，就读取
+            all_select_result_df_list.append(pd.read_pickle(stg_select_result))
+            # 删除该策略的选币结果，如果要保留可以注释
+            if not conf.is_reserved('strategy'):
+                stg_select_result.unlink()
 
     # 如果没有任何策略的选币结果，就直接返回
     if not all_select_result_df_list:
-        pd.DataFrame(columns=SELECT_RES_COLS).to_pickle(select_result_path)
-        return
+        all_select_result_df = pd.DataFrame(columns=SELECT_RES_COLS)
+        if conf.is_reserved('select'):
+            all_select_result_df.to_pickle(select_result_path)
+        return all_select_result_df
 
     # 聚合选币结果
     all_select_result_df = pd.concat(all_select_result_df_list, ignore_index=True)
@@ -833,34 +1196,39 @@ def concat_select_results(conf: BacktestConfig) -> None:
 
     all_stg_select_first_time = all_select_result_df.groupby('strategy')['candle_begin_time'].first().max()
     all_select_result_df = all_select_result_df[all_select_result_df['candle_begin_time'] >= all_stg_select_first_time]
-    all_select_result_df.to_pickle(select_result_path)
+    if conf.is_reserved('select'):
+        all_select_result_df.to_pickle(select_result_path)
 
     return all_select_result_df
 
 
-def process_select_results(conf: BacktestConfig) -> pd.DataFrame:
+def process_select_results(conf: BacktestConfig, all_select_result_df: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    整理综合选币结果：优先下单合约的现货，替换成合约的数据
+    :param conf: 回测配置
+    :param all_select_result_df: concat_select_results 返回的综合选币结果，为空时读取 `选币结果.pkl`
+    :return: 整理后的选币结果
+    """
     select_result_path = conf.get_result_folder() / '选币结果.pkl'
-    if not select_result_path.exists():
-        logger.warning('没有生成选币文件，直接返回')
-        return pd.DataFrame(columns=SELECT_RES_COLS)
-    all_select_result_df = pd.read_pickle(select_result_path)
+    if all_select_result_df is None:
+        if not select_result_path.exists():
+            logger.warning('没有生成选币文件，直接返回')
+            return pd.DataFrame(columns=SELECT_RES_COLS)
+        all_select_result_df = pd.read_pickle(select_result_path)
+        # 删除选币文件，如果要保留可以注释
+        if not conf.is_reserved('select'):
+            select_result_path.unlink()
 
     # 不是纯多，且是现货策略
     # 筛选一下选币结果，判断其中的 优先下单标记是什么
     cond1 = all_select_result_df['order_first'] == 'swap'  # 优先下单合约
     cond2 = all_select_result_df['is_spot'] == 1  # 当前币种是现货
     if not all_select_result_df[cond1 & cond2].empty:
-        all_kline_df = pd.read_pickle(get_file_path(*ALL_KLINE_PATH_TUPLE))
         # 将含有现货的币种，替换掉其中close价格
-        df_swap = all_kline_df[(all_kline_df['is_spot'] == 0) & (all_kline_df['symbol_spot'] != '')]
         no_transfer_df = all_select_result_df[~(cond1 & cond2)]
-        all_select_result_df = transfer_swap(all_select_result_df[cond1 & cond2], df_swap)
+        all_select_result_df = transfer_swap(all_select_result_df[cond1 & cond2], load_transfer_swap_index())
         all_select_result_df = pd.concat([no_transfer_df, all_select_result_df], ignore_index=True)
 
-    # 删除选币文件，如果要保留可以注释
-    if not conf.is_reserved('select'):
-        select_result_path.unlink()
-
     return all_select_result_df
 
 
@@ -993,34 +1361,31 @@ def agg_strategy_offsets(pl_select: pl.DataFrame, stg_conf: StrategyConfig):
             pl.col('candle_begin_time').cast(pl.Datetime('us'))
         ])
 
-    # 构建完整时间范围 (使用 datetime_range 支持小时级间隔)
+    # 事件方式聚合：每次选币在 t 时刻 +w，在 t + hold_period 时刻 -w，只在变化点重新计算持仓，
+    # 不再构建 (小时 × 币种) 的完整网格做 rolling_sum。持仓截止到最后一次选币的时刻，和原来的网格范围一致
+    pl_agg = pl_agg.with_columns(
+        pl.col('symbol').cast(pl.String),
+        pl.col('candle_begin_time').cast(pl.Datetime('us'))
+    ).sort(['symbol', 'candle_begin_time'])
     time_min = pl_agg['candle_begin_time'].min()
     time_max = pl_agg['candle_begin_time'].max()
-    symbols = pl_agg['symbol'].unique().sort()
-    
-    candle_times = pl.datetime_range(time_min, time_max, interval='1h', eager=True)
-    
-    # 创建 symbol × time 的笛卡尔积作为完整索引
-    pl_full_index = pl.DataFrame({'candle_begin_time': candle_times}).join(
-        pl.DataFrame({'symbol': symbols}), how='cross'
-    )
-    
-    # 确保 datetime 精度一致 (μs) 以避免 SchemaError
-    pl_agg = pl_agg.with_columns(pl.col('candle_begin_time').cast(pl.Datetime('us')))
-    pl_full_index = pl_full_index.with_columns(pl.col('candle_begin_time').cast(pl.Datetime('us')))
-    
-    # Left join 得到完整的稀疏矩阵
-    pl_full = pl_full_index.join(pl_agg, on=['candle_begin_time', 'symbol'], how='left').fill_null(0)
+    hours = ((pl_agg['candle_begin_time'] - time_min).dt.total_hours()).to_numpy().astype(np.int64)
+    symbols = pl_agg['symbol'].unique(maintain_order=True)
+    sym_ids = pl_agg['symbol'].rle_id().to_numpy().astype(np.int64)
+    max_hour = int((time_max - time_min) // pd.Timedelta(hours=1))
+
+    out_sym, out_hour, out_val = expand_hold_windows(
+        sym_ids, hours, pl_agg['target_alloc_ratio'].to_numpy().astype(np.float64), hold_period, max_hour)
 
-    pl_result = pl_full.sort(['symbol', 'candle_begin_time']).with_columns(
-        pl.col('target_alloc_ratio').rolling_sum(window_size=hold_period, min_periods=1).over('symbol')
-    )
-    
-    # 强制 symbol 为 String 类型，避免 concat 时 String/Categorical 不一致错误
-    pl_result = pl_result.with_columns(pl.col('symbol').cast(pl.String))
-    
     # 返回 Polars DataFrame，不转 Pandas！
-    return pl_result
+    return pl.DataFrame({
+        'candle_begin_time': pl.Series(out_hour, dtype=pl.Int64) * 3_600_000_000,
+        'symbol': symbols.gather(out_sym),
+        'target_alloc_ratio': out_val,
+    }).with_columns(
+        (pl.lit(time_min, dtype=pl.Datetime('us')) + pl.duration(microseconds=pl.col('candle_begin_time')))
+        .alias('candle_begin_time')
+    )
 
 
 def agg_multi_strategy_ratio(conf: BacktestConfig, df_select: pd.DataFrame):
@@ -1078,9 +1443,13 @@ def agg_multi_strategy_ratio(conf: BacktestConfig, df_select: pd.DataFrame):
         _swap_select_short = agg_strategy_offsets(df_select_swap[df_select_swap['方向'] == -1], strategy)
         df_swap_select_list.append(_swap_select_short)
 
-def agg_multi_strategy_ratio(conf: BacktestConfig, df_select: pd.DataFrame):
+def agg_multi_strategy_ratio(conf: BacktestConfig, df_select: pd.DataFrame, coords: RatioCoords = None):
     """
     [L7 Zero-Copy Optimization] Polars-native Aggregation Pipeline
+    :param conf: 回测配置
+    :param df_select: 选币结果
+    :param coords: 本次回测共用的 (时间, 币种) 坐标系，不传则按照回测区间和选币结果中的币种构建
+    :return: 聚合后的 df_spot_ratio 和 df_swap_ratio（SparseRatio）
     """
     import polars as pl
     
@@ -1115,42 +1484,15 @@ def agg_multi_strategy_ratio(conf: BacktestConfig, df_select: pd.DataFrame):
     pl_swap_agg = pl.concat(pl_swap_list) if pl_swap_list else pl.DataFrame()
 
     # ====================================================================================================
-    # 2. 针对多策略进行聚合 (Polars Pivot)
+    # 2. 针对多策略进行聚合 (稀疏 CSR)
     # ====================================================================================================
-    candle_begin_times = pd.date_range(conf.start_date, conf.end_date, freq='H', inclusive='left')
-
-    # 将 Polars DataFrame 直接传给 pivot 函数 (需确保 to_ratio_pivot 支持 Polars 或在此处理)
-    # 我们可以稍微修改逻辑，直接在这里做最终 Pivot，或让 to_ratio_pivot 兼容
-    
-    # 这里直接在 Polars 内部做 Pivot，效率最高
-    def _polars_pivot_to_pandas(pl_df, times):
-        if pl_df.is_empty():
-            return pd.DataFrame(index=times, columns=[], dtype=float).fillna(0)
-        
-        # 按 candle_begin_time 和 symbol 再次聚合 (合并多策略)
-        pl_grouped = pl_df.group_by(['candle_begin_time', 'symbol']).agg(
-            pl.col('target_alloc_ratio').sum()
-        )
-        
-        # Pivot
-        pl_pivoted = pl_grouped.pivot(
-            on='symbol',
-            index='candle_begin_time',
-            values='target_alloc_ratio',
-            aggregate_function='sum'
-        ).sort('candle_begin_time')
-        
-        # 对齐时间 (Right Join)
-        pl_times = pl.DataFrame({'candle_begin_time': times})
-        pl_times = pl_times.with_columns(pl.col('candle_begin_time').cast(pl.Datetime('us')))
-        # 确保 pl_pivoted 时间列也是 us
-        pl_pivoted = pl_pivoted.with_columns(pl.col('candle_begin_time').cast(pl.Datetime('us')))
-        
-        pl_final = pl_times.join(pl_pivoted, on='candle_begin_time', how='left').fill_null(0)
-        return pl_final.to_pandas().set_index('candle_begin_time')
+    if coords is None:
+        coords = RatioCoords.from_range(conf.start_date, conf.end_date, pl_select['symbol'].unique().to_list())
 
-    df_spot_ratio = _polars_pivot_to_pandas(pl_spot_agg, candle_begin_times)
-    df_swap_ratio = _polars_pivot_to_pandas(pl_swap_agg, candle_begin_times)
+    # 不再 pivot 成 (小时 × 全部币种) 的稠密矩阵，长表直接转换成坐标系中的 (行, 列) 整数坐标，构造 CSR 格式的稀疏资金占比，
+    # 多策略、多offset在相同位置上的资金占比会在构造时累加
+    df_spot_ratio = coords.to_sparse(pl_spot_agg)
+    df_swap_ratio = coords.to_sparse(pl_swap_agg)
 
     # # 针对下架币的处理
     # df_spot_ratio = trim_ratio_delists(df_spot_ratio, candle_begin_times.max(), spot_dict, 'spot')
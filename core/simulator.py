@@ -49,6 +49,80 @@ print(b)  # 输出: [4, 5, 6]，因为 a 和 b 引用的是同一个列表，修
 """
 
 
+"""
+# 零分配的模拟器
+每根 K 线都要对所有币种做几次结算，原来每一步都会生成布尔掩码、花式索引的临时数组，以及新的成交额数组，
+几年的小时数据 × 几百个币种，大部分时间都花在了分配和释放内存上。
+
+这里每一步都是对币种的显式循环，中间结果都是标量，不再使用布尔掩码和花式索引，整个模拟过程不分配内存：
+- 求和顺序和原来一致（按币种顺序依次累加），结果逐位一致
+- on_open / on_close 不再返回每个币种的仓位价值数组，直接返回需要的汇总值
+
+# 活跃币种集合
+几百个币种里，同一时间真正持有或者准备持有的通常只有几个到几十个。
+模拟器维护一个活跃币种集合：当前持仓不为 0 或者目标持仓不为 0 的币种下标，按下标从小到大排列。
+结算、资金费、调仓、仓位价值都只循环活跃币种，每根 K 线的开销从 O(全部币种) 变成 O(活跃币种)：
+- set_target_lots 时重建集合（目标持仓本身就是全部币种的数组，这一步和计算目标持仓的开销同级）
+- on_execution 之后剔除已经清仓、目标也为 0 的币种
+- 不活跃币种的持仓一定为 0，跳过它们不影响结果；活跃集合按下标排序，求和顺序不变，结果逐位一致
+- last_prices 只维护活跃币种，不活跃币种的值没有意义（建仓时会被调仓价覆盖）
+
+# 成交明细
+开启 TradeLedger 之后，on_execution 每成交一个币种，就在结构化数组中追加一条
+(K 线序号, 币种序号, 市场, 调仓手数, 成交价, 手续费)，数组写满之后容量翻倍。
+现货和合约共用一个 TradeLedger，用 market 区分。没有开启时只多一次判断，不影响模拟速度。
+"""
+
+MARKET_SPOT = 0  # 现货
+MARKET_SWAP = 1  # 合约
+
+# 成交明细的结构
+TRADE_DTYPE = np.dtype([
+    ('bar', np.int64),  # K 线序号
+    ('symbol_id', np.int64),  # 币种序号
+    ('market', np.int8),  # 市场，MARKET_SPOT 或者 MARKET_SWAP
+    ('delta_lots', np.int64),  # 调仓手数（带方向）
+    ('price', np.float64),  # 成交价
+    ('fee', np.float64),  # 手续费
+])
+
+
+@jitclass
+class TradeLedger:
+    enabled: bool  # 是否记录成交明细
+    records: nb.from_dtype(TRADE_DTYPE)[:]  # 成交明细，前 n 条有效
+    n: int  # 成交笔数
+
+    def __init__(self, enabled, capacity):
+        """
+        初始化
+        :param enabled: 是否记录成交明细
+        :param capacity: 初始容量，写满之后自动扩容
+        """
+        self.enabled = enabled
+        self.records = np.empty(max(capacity, 1), dtype=TRADE_DTYPE)
+        self.n = 0
+
+    def append(self, bar, symbol_id, market, delta_lots, price, fee):
+        if self.n == len(self.records):
+            # 容量翻倍
+            records = np.empty(2 * len(self.records), dtype=TRADE_DTYPE)
+            records[:self.n] = self.records
+            self.records = records
+
+        rec = self.records[self.n]
+        rec.bar = bar
+        rec.symbol_id = symbol_id
+        rec.market = market
+        rec.delta_lots = delta_lots
+        rec.price = price
+        rec.fee = fee
+        self.n += 1
+
+    def to_array(self):
+        return self.records[:self.n].copy()
+
+
 @jitclass
 class Simulator:
     equity: float  # 账户权益, 单位 USDT
@@ -62,7 +136,13 @@ class Simulator:
     last_prices: nb.float64[:]  # 最新价格
     has_last_prices: bool  # 是否有最新价
 
-    def __init__(self, init_capital, lot_sizes, fee_rate, init_lots, min_order_limit):
+    active_ids: nb.int64[:]  # 活跃币种的下标（持仓或目标持仓不为 0），前 n_active 个有效，按下标排序
+    n_active: int  # 活跃币种数量
+
+    ledger: TradeLedger.class_type.instance_type  # 成交明细
+    market: int  # 市场，MARKET_SPOT 或者 MARKET_SWAP
+
+    def __init__(self, init_capital, lot_sizes, fee_rate, init_lots, min_order_limit, ledger, market):
         """
         初始化
         :param init_capital: 初始资金 
@@ -70,10 +150,14 @@ class Simulator:
         :param fee_rate: 手续费率
         :param init_lots: 初始持仓
         :param min_order_limit: 最小下单金额
+        :param ledger: 成交明细
+        :param market: 市场，写入成交明细
         """
         self.equity = init_capital  # 账户权益
         self.fee_rate = fee_rate  # 交易成本
         self.min_order_limit = min_order_limit  # 最小下单金额
+        self.ledger = ledger
+        self.market = market
 
         n = len(lot_sizes)
 
@@ -93,12 +177,55 @@ class Simulator:
         self.target_lots = np.zeros(n, dtype=np.int64)
         self.target_lots[:] = init_lots
 
+        # 活跃币种
+        self.active_ids = np.zeros(n, dtype=np.int64)
+        self.n_active = 0
+        self.update_active_ids()
+
+    def update_active_ids(self):
+        """
+        扫描全部币种，重建活跃币种集合
+        """
+        n_active = 0
+        for j in range(len(self.lots)):
+            if self.lots[j] != 0 or self.target_lots[j] != 0:
+                self.active_ids[n_active] = j
+                n_active += 1
+        self.n_active = n_active
+
+    def drop_inactive_ids(self):
+        """
+        从活跃币种集合中剔除持仓和目标持仓都为 0 的币种，保持原有顺序
+        """
+        n_active = 0
+        for k in range(self.n_active):
+            j = self.active_ids[k]
+            if self.lots[j] != 0 or self.target_lots[j] != 0:
+                self.active_ids[n_active] = j
+                n_active += 1
+        self.n_active = n_active
+
     def set_target_lots(self, target_lots):
         self.target_lots[:] = target_lots
+        self.update_active_ids()
+
+    def restore(self, target_lots, last_prices, has_last_prices):
+        """
+        从检查点恢复状态，账户权益和当前持仓在初始化的时候传入
+        :param target_lots: 目标持仓手数
+        :param last_prices: 最新价格
+        :param has_last_prices: 是否有最新价
+        """
+        self.target_lots[:] = target_lots
+        self.last_prices[:] = last_prices
+        self.has_last_prices = has_last_prices
+        self.update_active_ids()
 
     def fill_last_prices(self, prices):
-        mask = np.logical_not(np.isnan(prices))
-        self.last_prices[mask] = prices[mask]
+        for k in range(self.n_active):
+            j = self.active_ids[k]
+            if not np.isnan(prices[j]):
+                self.last_prices[j] = prices[j]
         self.has_last_prices = True
 
     def settle_equity(self, prices):
@@ -107,12 +234,15 @@ class Simulator:
         :param prices: 当前价格
         :return:
         """
-        mask = np.logical_and(self.lots != 0, np.logical_not(np.isnan(prices)))
         # 计算公式：
         # 1. 净值涨跌 = (最新价格 - 前最新价（前收盘价）) * 持币数量。
         # 2. 其中，持币数量 = min_qty * 持仓手数。
         # 3. 所有币种对应的净值涨跌累加起来
-        equity_delta = np.sum((prices[mask] - self.last_prices[mask]) * self.lot_sizes[mask] * self.lots[mask])
+        equity_delta = 0.
+        for k in range(self.n_active):
+            j = self.active_ids[k]
+            if self.lots[j] != 0 and not np.isnan(prices[j]):
+                equity_delta += (prices[j] - self.last_prices[j]) * self.lot_sizes[j] * self.lots[j]
 
         # 反映到净值上
         self.equity += equity_delta
@@ -131,22 +261,28 @@ class Simulator:
         # 根据开盘价和前最新价（前收盘价），结算当前账户权益
         self.settle_equity(open_prices)
 
-        # 根据标记价格和资金费率，结算资金费盈亏
-        mask = np.logical_and(self.lots != 0, np.logical_not(np.isnan(mark_prices)))
-        pos_val = notional_value = self.lot_sizes[mask] * self.lots[mask] * mark_prices[mask]
-        funding_fee = np.sum(notional_value * funding_rates[mask])
+        # 根据标记价格和资金费率，结算资金费盈亏，同时累计仓位名义价值的绝对值
+        funding_fee = 0.
+        pos_val_abs = 0.
+        for k in range(self.n_active):
+            j = self.active_ids[k]
+            if self.lots[j] != 0 and not np.isnan(mark_prices[j]):
+                notional_value = self.lot_sizes[j] * self.lots[j] * mark_prices[j]
+                funding_fee += notional_value * funding_rates[j]
+                pos_val_abs += abs(notional_value)
         self.equity -= funding_fee
 
         # 最新价为开盘价
         self.fill_last_prices(open_prices)
 
-        # 返回扣除资金费后开盘账户权益、资金费和带方向的仓位名义价值
-        return self.equity, funding_fee, pos_val
+        # 返回扣除资金费后开盘账户权益、资金费和仓位名义价值的绝对值之和
+        return self.equity, funding_fee, pos_val_abs
 
-    def on_execution(self, exec_prices):
+    def on_execution(self, exec_prices, bar):
         """
         模拟: K 线开盘时刻 -> 调仓时刻
         :param exec_prices:  执行价格
+        :param bar:          K 线序号，写入成交明细
         :return:            调仓后的账户权益、调仓后的仓位名义价值
         """
         if not self.has_last_prices:
@@ -155,19 +291,21 @@ class Simulator:
         # 根据调仓价和前最新价（开盘价），结算当前账户权益
         self.settle_equity(exec_prices)
 
-        # 计算需要买入或卖出的合约数量
-        delta = self.target_lots - self.lots
-        mask = np.logical_and(delta != 0, np.logical_not(np.isnan(exec_prices)))
-
-        # 计算成交额
-        turnover = np.zeros(len(self.lot_sizes), dtype=np.float64)
-        turnover[mask] = np.abs(delta[mask]) * self.lot_sizes[mask] * exec_prices[mask]
-
-        # 成交额小于 min_order_limit 则无法调仓
-        mask = np.logical_and(mask, turnover >= self.min_order_limit)
-
-        # 本期调仓总成交额
-        turnover_total = turnover[mask].sum()
+        # 计算需要买入或卖出的合约数量，以及成交额
+        turnover_total = 0.
+        for k in range(self.n_active):
+            j = self.active_ids[k]
+            delta = self.target_lots[j] - self.lots[j]
+            if delta != 0 and not np.isnan(exec_prices[j]):
+                turnover = abs(delta) * self.lot_sizes[j] * exec_prices[j]
+                # 成交额小于 min_order_limit 则无法调仓
+                if turnover >= self.min_order_limit:
+                    # 本期调仓总成交额
+                    turnover_total += turnover
+                    if self.ledger.enabled:
+                        self.ledger.append(bar, j, self.market, delta, exec_prices[j], turnover * self.fee_rate)
+                    # 更新已成功调仓的 symbol 持仓
+                    self.lots[j] = self.target_lots[j]
 
         if np.isnan(turnover_total):
             raise RuntimeError('Turnover is nan')
@@ -176,12 +314,12 @@ class Simulator:
         fee = turnover_total * self.fee_rate
         self.equity -= fee
 
-        # 更新已成功调仓的 symbol 持仓
-        self.lots[mask] = self.target_lots[mask]
-
         # 最新价为调仓价
         self.fill_last_prices(exec_prices)
 
+        # 剔除已经清仓的币种
+        self.drop_inactive_ids()
+
         # 返回扣除手续费的调仓后账户权益，成交额，和手续费
         return self.equity, turnover_total, fee
 
@@ -189,7 +327,7 @@ class Simulator:
         """
         模拟: K 线收盘 -> K 线收盘时刻
         :param close_prices: 收盘价
-        :return:           收盘后的账户权益
+        :return:           收盘后的账户权益，多头仓位价值，空头仓位价值（负数）
         """
         if not self.has_last_prices:
             self.fill_last_prices(close_prices)
@@ -202,8 +340,16 @@ class Simulator:
         # 最新价为收盘价
         self.fill_last_prices(close_prices)
 
-        mask = np.logical_and(self.lots != 0, np.logical_not(np.isnan(close_prices)))
-        pos_val = self.lot_sizes[mask] * self.lots[mask] * close_prices[mask]
+        long_pos_val = 0.
+        short_pos_val = 0.
+        for k in range(self.n_active):
+            j = self.active_ids[k]
+            if self.lots[j] != 0 and not np.isnan(close_prices[j]):
+                pos_val = self.lot_sizes[j] * self.lots[j] * close_prices[j]
+                if pos_val > 0:
+                    long_pos_val += pos_val
+                elif pos_val < 0:
+                    short_pos_val += pos_val
 
         # 返回收盘账户权益
-        return self.equity, pos_val
+        return self.equity, long_pos_val, short_pos_val
@@ -9,7 +9,9 @@
 
 Author: 邢不行
 """
+import hashlib
 import importlib
+from pathlib import Path
 
 import pandas as pd
 
@@ -32,12 +34,25 @@ class DummyFactor:
     def signal_multi_params(self, df, param_list: list | set | tuple) -> dict:
         raise NotImplementedError
 
+    def signal_panel(self, panel, param_list: list | set | tuple) -> dict:
+        # 面板计算：panel[字段] 是 (K线 × 币种) 的矩阵，返回 {参数: 因子值矩阵}
+        raise NotImplementedError
+
+    def signal_expr(self, n):
+        # polars 表达式写法，返回 pl.Expr，计算时会按币种分组
+        raise NotImplementedError
+
     def get_factor_list(self, n):
         raise NotImplementedError
 
+    def get_lookback(self, n) -> int:
+        # 计算一根K线的因子值，需要往前多少根K线的数据，用于因子的增量计算
+        raise NotImplementedError
+
 
 class FactorHub:
     _factor_cache = {}
+    _fingerprint_cache = {}
 
     # noinspection PyTypeChecker
     @staticmethod
@@ -65,6 +80,9 @@ class FactorHub:
 
             # 缓存策略对象
             FactorHub._factor_cache[factor_name] = factor_instance
+            # 因子文件内容的摘要，因子代码修改之后，因子仓库中的历史数据需要重算
+            FactorHub._fingerprint_cache[factor_name] = hashlib.md5(
+                Path(factor_module.__file__).read_bytes()).hexdigest()
 
             return factor_instance
         except ModuleNotFoundError:
@@ -72,6 +90,16 @@ class FactorHub:
         except AttributeError:
             raise ValueError(f"Error accessing factor content in module {factor_name}.")
 
+    @staticmethod
+    def get_fingerprint(factor_name) -> str:
+        """
+        获取因子文件内容的摘要
+        :param factor_name: 因子名称
+        :return: md5
+        """
+        FactorHub.get_by_name(factor_name)
+        return FactorHub._fingerprint_cache[factor_name]
+
 
 # 使用示例
 if __name__ == "__main__":
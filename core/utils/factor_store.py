@@ -0,0 +1,181 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from core.utils.log_kit import logger
+from core.utils.path_kit import get_folder_path
+
+"""
+# 因子仓库（追加写入的列式存储）
+以前的因子缓存按照 (币种, 因子, 参数, 第一根K线, 最后一根K线) 生成 md5 作为文件名，
+每更新一根新的K线，所有的缓存都会失效，然后全量重算。
+
+现在改为：每一列因子一个数据集，按照币种分区，每个分区只追加新的数据：
+
+data/cache/factor_store/
+└── H                                   # 周期类型，H：小时，D：日线
+    └── Bias_360                        # 因子列名
+        └── swap_BTC-USDT               # 币种分区，{市场}_{币种}
+            ├── _meta.json              # 分区信息：因子文件摘要、第一根K线、最后计算的K线、预热长度、行数、尾部K线校验
+            ├── part-00000.parquet      # 历史数据
+            └── part-00001.parquet      # 每次数据更新之后，只追加新增的尾部数据
+
+- 分区的内容由 (因子文件摘要, 第一根K线) 决定，因子代码修改或者历史数据变化之后，整个分区重算
+- 尾部K线校验 check：写入时记录最后 预热长度 + 一小段 K线内容的摘要，K线时间不变、但是数据被修正的时候，整个分区重算
+- 每一个分区只会被一个线程/进程写入（时序因子按币种并行计算），所以不需要加锁
+- 预热长度 warmup：计算尾部数据时，需要往前多取的K线数量。None 表示需要全部历史数据
+"""
+
+META_FILE = '_meta.json'
+# 分区的文件个数超过该值之后，合并成一个文件，避免小文件太多
+MAX_PART_NUM = 32
+
+
+def get_partition_path(factor_col, symbol, is_spot, period_type='H', auto_create=True):
+    """
+    获取因子分区的文件夹
+    :param factor_col: 因子列名，比如 Bias_360
+    :param symbol: 币种
+    :param is_spot: 是否是现货
+    :param period_type: 周期类型，H：小时，D：日线
+    :param auto_create: 是否自动创建文件夹
+    :return: 分区路径
+    """
+    market = 'spot' if int(is_spot) == 1 else 'swap'
+    return get_folder_path('data', 'cache', 'factor_store', period_type, str(factor_col), f'{market}_{symbol}',
+                           auto_create=auto_create, as_path_type=True)
+
+
+def read_meta(partition_path) -> dict | None:
+    meta_path = partition_path / META_FILE
+    if not meta_path.exists():
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_meta(partition_path, meta: dict):
+    # 先写临时文件再替换，避免中途退出造成 meta 文件损坏
+    tmp_path = partition_path / f'{META_FILE}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, partition_path / META_FILE)
+
+
+def load_factor_store(factor_col, symbol, is_spot, first_candle, fingerprint, period_type='H'):
+    """
+    读取因子仓库中已经计算好的历史数据
+    :param factor_col: 因子列名
+    :param symbol: 币种
+    :param is_spot: 是否是现货
+    :param first_candle: 当前K线数据的第一根K线时间，和仓库记录的不一致时，说明历史数据发生了变化，需要重算
+    :param fingerprint: 因子文件摘要，和仓库记录的不一致时，说明因子代码发生了变化，需要重算
+    :param period_type: 周期类型
+    :return: (candle_begin_time 数组, 因子值数组, 分区信息)，如果没有可用的数据，返回 None
+    """
+    partition_path = get_partition_path(factor_col, symbol, is_spot, period_type, auto_create=False)
+    meta = read_meta(partition_path) if partition_path.exists() else None
+    if meta is None or meta['first_candle'] != str(pd.to_datetime(first_candle)) or \
+            meta['fingerprint'] != fingerprint:
+        return None
+
+    part_files = sorted(partition_path.glob('part-*.parquet'))
+    if len(part_files) != meta['parts']:
+        return None
+
+    try:
+        df = pl.read_parquet(part_files)
+    except Exception as e:
+        logger.warning(f'读取因子仓库失败 {symbol} {factor_col}: {e}')
+        return None
+
+    if len(df) != meta['rows']:
+        return None
+
+    return df['candle_begin_time'].to_numpy(), df['value'].to_numpy(), meta
+
+
+def append_factor_store(factor_col, symbol, is_spot, candle_times, values, first_candle, fingerprint, warmup=None,
+                        period_type='H', overwrite=False, check=None):
+    """
+    追加写入因子数据
+    :param factor_col: 因子列名
+    :param symbol: 币种
+    :param is_spot: 是否是现货
+    :param candle_times: 新增数据的 candle_begin_time
+    :param values: 新增数据的因子值
+    :param first_candle: 第一根K线时间
+    :param fingerprint: 因子文件摘要
+    :param warmup: 预热长度，计算尾部数据时需要往前多取的K线数量，None 表示需要全部历史数据
+    :param period_type: 周期类型
+    :param overwrite: 是否清空分区之后重新写入（历史数据发生变化的时候）
+    :param check: 尾部K线校验信息，读取时用于判断K线数据是否被修正过
+    :return:
+    """
+    if len(candle_times) == 0:
+        return
+
+    partition_path = get_partition_path(factor_col, symbol, is_spot, period_type)
+    meta = None if overwrite else read_meta(partition_path)
+    if meta is None:
+        shutil.rmtree(partition_path, ignore_errors=True)
+        partition_path.mkdir(parents=True, exist_ok=True)
+        meta = dict(fingerprint=fingerprint, first_candle=str(pd.to_datetime(first_candle)), last_candle=None,
+                    warmup=warmup, rows=0, parts=0)
+
+    part_df = pl.DataFrame({
+        'candle_begin_time': pd.to_datetime(candle_times).values,
+        'value': np.asarray(values, dtype=np.float64),
+    })
+
+    try:
+        if meta['parts'] + 1 > MAX_PART_NUM:
+            # 小文件太多，合并成一个
+            part_files = sorted(partition_path.glob('part-*.parquet'))
+            part_df = pl.concat([pl.read_parquet(part_files), part_df])
+            for part_file in part_files:
+                part_file.unlink()
+            meta['parts'] = 0
+            meta['rows'] = 0
+
+        part_df.write_parquet(partition_path / f'part-{meta["parts"]:05d}.parquet', compression='zstd')
+    except Exception as e:
+        logger.warning(f'写入因子仓库失败 {symbol} {factor_col}: {e}')
+        shutil.rmtree(partition_path, ignore_errors=True)
+        return
+
+    meta['parts'] += 1
+    meta['rows'] += len(part_df)
+    meta['last_candle'] = str(pd.to_datetime(candle_times[-1]))
+    meta['warmup'] = warmup
+    meta['check'] = check
+    write_meta(partition_path, meta)
+
+
+def clear_factor_store(period_type=None):
+    """
+    清空因子仓库
+    :param period_type: 周期类型，None 表示全部清空
+    """
+    store_path = get_folder_path('data', 'cache', 'factor_store', as_path_type=True)
+    if period_type:
+        store_path = store_path / period_type
+    shutil.rmtree(store_path, ignore_errors=True)
@@ -0,0 +1,217 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from core.utils.log_kit import logger
+from core.utils.path_kit import get_folder_path
+
+"""
+# 行情 Pivot 数据的内存映射存储
+market_pivot_spot.pkl / market_pivot_swap.pkl 是 {字段: (时间 × 币种) 的 DataFrame}，
+每一个回测进程都会完整读入一份，同一台机器上并行跑多个回测时，每个进程各自占用好几个 G 的内存。
+
+这里把每个字段转换成 .npy 文件，通过 np.load(mmap_mode='r') 映射到内存：
+- 多个进程打开同一个文件时，共享操作系统的 page cache，不会重复占用内存
+- 按时间裁切是零拷贝的（行切片），按币种裁切只会拷贝需要的列
+
+data/cache/pivot_store/
+└── swap
+    ├── _current.json               # 当前使用的版本，原子替换
+    └── 1718000000000000000-12345   # 一个版本的数据，源文件更新之后构建新的版本，不会改动正在使用的版本
+        ├── _index.json             # 每个字段的币种索引，以及源文件的信息（源文件更新之后自动重建）
+        ├── open.npy                # (时间 × 币种) float64，C 顺序
+        ├── open_times.npy          # 时间索引
+        ├── close.npy
+        ├── vwap1m.npy
+        └── funding_rate.npy
+
+单精度模式（sim_precision = 'float32'）使用单独的 spot_float32 / swap_float32 文件夹，数据保存为 float32，
+内存映射和 page cache 的占用都减半。
+"""
+
+INDEX_FILE = '_index.json'
+CURRENT_FILE = '_current.json'
+
+
+def _source_files(base_path: Path, market_type) -> list:
+    # 优先使用 parquet 分字段的数据，没有的话使用 pkl
+    prefix = f'market_pivot_{market_type}'
+    pq_files = sorted(base_path.glob(f'{prefix}_*.parquet'))
+    if pq_files:
+        return pq_files
+    pkl_file = base_path / f'{prefix}.pkl'
+    return [pkl_file] if pkl_file.exists() else []
+
+
+def _source_signature(source_files) -> list:
+    return [[f.name, f.stat().st_size, f.stat().st_mtime_ns] for f in source_files]
+
+
+def read_pivot_source(base_path, market_type) -> dict:
+    """
+    从源文件读取 Pivot 数据：优先 parquet 分字段的数据，没有的话读取 pkl
+    :param base_path: 预处理数据路径
+    :param market_type: spot 或者 swap
+    :return: {字段: (时间 × 币种) 的 DataFrame}
+    """
+    prefix = f'market_pivot_{market_type}'
+    source_files = _source_files(Path(base_path), market_type)
+    if not source_files:
+        return {}
+    if source_files[0].suffix == '.pkl':
+        return pd.read_pickle(source_files[0])
+
+    import polars as pl
+    res = {}
+    for pq_file in source_files:
+        key = pq_file.stem.replace(f'{prefix}_', '')
+        df = pl.read_parquet(pq_file).to_pandas()
+        if 'candle_begin_time' in df.columns:
+            df['candle_begin_time'] = pd.to_datetime(df['candle_begin_time'])
+            df.set_index('candle_begin_time', inplace=True)
+        res[key] = df
+    return res
+
+
+def _read_current_version(store_path: Path) -> str | None:
+    try:
+        with open(store_path / CURRENT_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)['version']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _remove_stale_versions(store_path: Path, keep_versions):
+    """
+    删除不再使用的版本，以及老版本直接放在 store_path 下的数据。
+    已经打开的内存映射不受影响（Linux/macOS），删不掉的（例如 Windows 下正在使用的文件）跳过
+    """
+    for path in store_path.iterdir():
+        if path.name == CURRENT_FILE or path.name in keep_versions or '.tmp-' in path.name:
+            continue
+        try:
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+        except OSError:
+            pass
+
+
+def build_pivot_store(pivot_dict: dict, store_path: Path, signature: list, dtype=np.float64):
+    """
+    把 Pivot 数据写入内存映射存储。
+    每次构建写入一个新的版本文件夹，写完之后再原子替换 _current.json 切换版本，
+    正在读取老版本的进程不受影响，也不会读到写了一半的数据
+    :param pivot_dict: {字段: (时间 × 币种) 的 DataFrame}
+    :param store_path: 存储路径
+    :param signature: 源文件信息
+    :param dtype: 保存的精度，float64 或者 float32
+    """
+    store_path.mkdir(parents=True, exist_ok=True)
+    version = f'{time.time_ns()}-{os.getpid()}'
+    tmp_path = store_path / f'{version}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    try:
+        field_symbols = {}
+        for field, df in pivot_dict.items():
+            np.save(tmp_path / f'{field}.npy', np.ascontiguousarray(df.to_numpy(dtype=dtype)))
+            np.save(tmp_path / f'{field}_times.npy', pd.DatetimeIndex(df.index).values.astype('datetime64[ns]'))
+            field_symbols[field] = [str(symbol) for symbol in df.columns]
+
+        with open(tmp_path / INDEX_FILE, 'w', encoding='utf-8') as f:
+            json.dump(dict(fields=field_symbols, signature=signature), f, ensure_ascii=False)
+        os.replace(tmp_path, store_path / version)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    # 切换版本：先写临时文件再原子替换
+    prev_version = _read_current_version(store_path)
+    tmp_current = store_path / f'{CURRENT_FILE}.tmp-{os.getpid()}'
+    with open(tmp_current, 'w', encoding='utf-8') as f:
+        json.dump(dict(version=version), f)
+    os.replace(tmp_current, store_path / CURRENT_FILE)
+
+    # 保留上一个版本，刚读到老版本指针的进程仍然可以打开
+    _remove_stale_versions(store_path, {version, prev_version})
+
+
+def open_pivot_store(store_path: Path, signature: list) -> dict | None:
+    """
+    打开内存映射存储的当前版本
+    :param store_path: 存储路径
+    :param signature: 源文件信息，和存储记录的不一致时返回 None
+    :return: {字段: 以 memmap 为底层数据的 DataFrame}
+    """
+    version = _read_current_version(store_path)
+    if version is None:
+        return None
+    version_path = store_path / version
+    try:
+        with open(version_path / INDEX_FILE, 'r', encoding='utf-8') as f:
+            index_info = json.load(f)
+        if index_info['signature'] != signature:
+            return None
+
+        res = {}
+        for field, symbols in index_info['fields'].items():
+            mat = np.load(version_path / f'{field}.npy', mmap_mode='r')
+            index = pd.DatetimeIndex(np.load(version_path / f'{field}_times.npy'), name='candle_begin_time')
+            res[field] = pd.DataFrame(mat, index=index, columns=pd.Index(symbols), copy=False)
+    except (OSError, ValueError, KeyError):
+        # 版本已经被其他进程清理，重新构建
+        return None
+    return res
+
+
+def load_pivot_data(base_path, market_type, dtype=np.float64) -> dict:
+    """
+    加载行情 Pivot 数据：内存映射存储 -> parquet -> pkl。
+    第一次使用（或者源文件更新之后）会从 parquet/pkl 构建内存映射存储，之后所有进程共享同一份数据
+    :param base_path: 预处理数据路径
+    :param market_type: spot 或者 swap
+    :param dtype: 数据精度，float64 或者 float32
+    :return: {字段: (时间 × 币种) 的 DataFrame}
+    """
+    dtype = np.dtype(dtype)
+    store_name = market_type if dtype == np.float64 else f'{market_type}_{dtype.name}'
+    store_path = get_folder_path('data', 'cache', 'pivot_store', as_path_type=True) / store_name
+    source_files = _source_files(Path(base_path), market_type)
+    if not source_files:
+        # 没有源文件就无法确认存储的数据是不是最新的，不使用存储
+        return {}
+    signature = _source_signature(source_files)
+
+    pivot_dict = open_pivot_store(store_path, signature)
+    if pivot_dict is not None:
+        return pivot_dict
+
+    pivot_dict = read_pivot_source(base_path, market_type)
+    if not pivot_dict:
+        return {}
+
+    try:
+        logger.debug(f'💿 构建 {market_type} 行情数据的内存映射存储...')
+        build_pivot_store(pivot_dict, store_path, signature, dtype)
+        return open_pivot_store(store_path, signature) or {k: df.astype(dtype) for k, df in pivot_dict.items()}
+    except OSError as e:
+        logger.warning(f'构建内存映射存储失败，使用源数据: {e}')
+        return {k: df.astype(dtype) for k, df in pivot_dict.items()}
@@ -0,0 +1,240 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import hashlib
+import threading
+from collections import Counter
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+"""
+# 选币主数据集
+多策略回测的时候，所有子策略共用同一份合并好的因子数据（Master DataSet）。原来每个子策略都要：
+按 是否交易 过滤 -> 按选币范围过滤 -> copy -> dropna -> 按 (candle_begin_time, symbol) 排序，
+几十个子策略就是几十次对整张大表的拷贝和排序。
+
+这里只在构建的时候排序一次，并且预先计算好公共的条件：
+- 可交易：是否交易 == 1，并且 symbol 不为空
+- 选币范围：spot / swap / mix_spot / mix_swap
+- 因子非空：按因子列缓存
+
+主数据集使用 Polars 保存，每个子策略只拿到一组行（已经按时间、币种排好序），取数时只取需要的列，不再排序：
+- strategy_lazy_view: Polars LazyFrame，给 Polars 选币使用（use_custom_func=False）
+- strategy_view: pandas DataFrame，给自定义函数选币使用
+
+# 截面排名缓存
+很多子策略会对同一个因子列做相同的截面排名，比如 `PctChange_360` 的 `pct:<0.5` 过滤、`LowPrice_360` 的排序。
+选币范围（可交易、选币范围、因子非空）相同的子策略，排名结果也完全相同，只需要计算一次。
+缓存的 key 为 (因子列, 是否正序, 排名方式, 是否百分比, 选币范围的哈希)：
+- 构建主数据集之后，调用 prepare_rank_cache 统计每个 key 会被多少个子策略用到，只缓存会被重复使用的排名
+- 每个子策略用完之后引用计数减一，减到 0 就释放内存
+"""
+
+
+def rank_column_name(col, ascending, method, pct) -> str:
+    """
+    缓存的排名在选币数据中的列名
+    """
+    return f'__rank_{col}_{"asc" if ascending else "desc"}_{method}{"_pct" if pct else ""}'
+
+
+def strategy_rank_keys(stg_conf) -> set:
+    """
+    子策略在复合因子、前置过滤中需要用到的截面排名，(因子列, 是否正序, 排名方式, 是否百分比)
+    后置过滤是在选中的币种中排名，每个子策略都不一样，不做缓存
+    """
+    keys = set()
+    for factor_config in stg_conf.long_factor_list + stg_conf.short_factor_list:
+        if factor_config.weight != 0:
+            keys.add((factor_config.col_name, factor_config.is_sort_asc, 'min', False))
+    for filter_config in stg_conf.long_filter_list + stg_conf.short_filter_list:
+        if filter_config.method is not None and filter_config.method.how in ('rank', 'pct'):
+            keys.add((filter_config.col_name, filter_config.is_sort_asc, 'average', filter_config.method.how == 'pct'))
+    return keys
+
+
+class RankCache:
+
+    def __init__(self):
+        self._ranks = {}
+        self._refs = Counter()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ranks)
+
+    def register(self, key):
+        with self._lock:
+            self._refs[key] += 1
+
+    def get(self, key, calc_func) -> np.ndarray | None:
+        """
+        获取缓存的排名，只被一个子策略用到的排名不缓存，返回 None
+        :param key: (因子列, 是否正序, 排名方式, 是否百分比, 选币范围的哈希)
+        :param calc_func: 计算排名的函数
+        """
+        with self._lock:
+            if key not in self._ranks and self._refs[key] < 2:
+                self._refs.pop(key, None)
+                return None
+            key_lock = self._locks.setdefault(key, threading.Lock())
+
+        # 同一个 key 只计算一次，其他线程等待计算完成
+        with key_lock:
+            ranks = self._ranks.get(key)
+            if ranks is None:
+                ranks = calc_func()
+                self._ranks[key] = ranks
+
+        with self._lock:
+            self._refs[key] -= 1
+            if self._refs[key] <= 0:
+                # 所有子策略都用完了，释放内存
+                self._refs.pop(key, None)
+                self._ranks.pop(key, None)
+                self._locks.pop(key, None)
+        return ranks
+
+
+class SelectionMaster:
+
+    def __init__(self, df: pl.DataFrame | pd.DataFrame, factor_columns: Iterable[str] = None):
+        """
+        :param df: 合并好的因子数据，Polars 或者 pandas DataFrame
+        :param factor_columns: 所有的因子列。传入之后，子策略只会取自己需要的因子列，不传则取全部列
+        """
+        if isinstance(df, pd.DataFrame):
+            if df.empty:
+                df = pd.DataFrame(columns=['candle_begin_time', 'symbol', 'is_spot', 'symbol_spot', 'symbol_swap', '是否交易'])
+            df = pl.from_pandas(df)
+        # 只排序这一次，子策略按行取数，顺序保持不变
+        self.df = df.sort(['candle_begin_time', 'symbol'], maintain_order=True, nulls_last=True)
+        self.factor_columns = set(factor_columns) if factor_columns is not None else None
+
+        is_spot = self.df['is_spot'].to_numpy() == 1
+        self._tradable = (self.df['是否交易'].to_numpy() == 1) & self.df['symbol'].is_not_null().to_numpy()
+        # 和 pandas 的 != '' 保持一致，空值也算不等于 ''
+        both_not_null = (self.df['symbol_spot'].ne_missing('') & self.df['symbol_swap'].ne_missing('')).to_numpy()
+        self._scope_masks = {
+            'spot': is_spot,
+            'swap': ~is_spot,
+            'mix_spot': ~both_not_null | is_spot,
+            'mix_swap': ~both_not_null | ~is_spot,
+        }
+        self._notna_masks = {}
+        self.rank_cache = RankCache()
+
+    def __len__(self):
+        return len(self.df)
+
+    @property
+    def empty(self):
+        return self.df.is_empty()
+
+    def notna_mask(self, col) -> np.ndarray:
+        # 多线程共享时，最多重复计算一次，结果一致
+        mask = self._notna_masks.get(col)
+        if mask is None:
+            series = self.df[col]
+            not_null = series.is_not_null()
+            if series.dtype.is_float():
+                # 和 pandas 的 notna 保持一致，NaN 也算空值
+                not_null = not_null & series.is_not_nan().fill_null(False)
+            mask = not_null.to_numpy()
+            self._notna_masks[col] = mask
+        return mask
+
+    def scope_mask(self, select_scope, order_first) -> np.ndarray:
+        """
+        选币范围的条件，和原来 process_strategy 中的逻辑一致
+        :param select_scope: spot / swap / mix
+        :param order_first: 优先下单的类型，mix 时生效
+        """
+        if select_scope in ('spot', 'swap'):
+            return self._scope_masks[select_scope]
+        # mix 混合：两边都有的币种，只保留优先下单的那一边
+        return self._scope_masks[f'mix_{order_first}']
+
+    def strategy_mask(self, stg_conf) -> np.ndarray:
+        """
+        子策略可以参与选币的行
+        :param stg_conf: 策略配置
+        """
+        mask = self._tradable & self.scope_mask(stg_conf.select_scope, stg_conf.order_first)
+        for col in stg_conf.factor_columns:
+            mask = mask & self.notna_mask(col)
+        return mask
+
+    def strategy_columns(self, stg_conf) -> list:
+        # 自定义函数可能用到配置之外的因子列，保留全部列
+        if self.factor_columns is None or stg_conf.use_custom_func:
+            return list(self.df.columns)
+        need_cols = set(stg_conf.factor_columns)
+        return [col for col in self.df.columns if col not in self.factor_columns or col in need_cols]
+
+    @staticmethod
+    def universe_hash(mask: np.ndarray) -> str:
+        return hashlib.blake2b(np.packbits(mask).tobytes(), digest_size=16).hexdigest()
+
+    def prepare_rank_cache(self, stg_conf_list):
+        """
+        统计所有子策略用到的截面排名，被多个子策略用到的排名会缓存
+        :param stg_conf_list: 所有会使用该主数据集选币的子策略
+        """
+        for stg_conf in stg_conf_list:
+            if stg_conf.use_custom_func:
+                continue
+            universe = self.universe_hash(self.strategy_mask(stg_conf))
+            for rank_key in strategy_rank_keys(stg_conf):
+                self.rank_cache.register((*rank_key, universe))
+
+    def calc_rank(self, mask: np.ndarray, col, ascending, method, pct) -> np.ndarray:
+        """
+        在选币范围内计算截面排名
+        :return: 排名，和选币范围内的行一一对应
+        """
+        rank = pl.col(col).rank(method=method, descending=not ascending).over('candle_begin_time')
+        if pct:
+            rank = rank / pl.col(col).count().over('candle_begin_time')
+        return self.df.lazy().select('candle_begin_time', col).filter(pl.Series(mask)).select(
+            rank.cast(pl.Float64)).collect().to_series().to_numpy()
+
+    def strategy_lazy_view(self, stg_conf) -> pl.LazyFrame:
+        """
+        子策略的选币数据（Polars）：只取需要的行和列，已经按 (candle_begin_time, symbol) 排好序。
+        被多个子策略用到的截面排名，会以 rank_column_name 的列名附加在选币数据中
+        :param stg_conf: 策略配置
+        :return: 选币数据
+        """
+        mask = self.strategy_mask(stg_conf)
+        lf = self.df.lazy().select(self.strategy_columns(stg_conf)).filter(pl.Series(mask))
+        if stg_conf.use_custom_func:
+            return lf
+
+        rank_cols = []
+        universe = self.universe_hash(mask)
+        for rank_key in sorted(strategy_rank_keys(stg_conf)):
+            ranks = self.rank_cache.get((*rank_key, universe), lambda: self.calc_rank(mask, *rank_key))
+            if ranks is not None:
+                rank_cols.append(pl.Series(rank_column_name(*rank_key), ranks))
+        return lf.with_columns(rank_cols) if rank_cols else lf
+
+    def strategy_view(self, stg_conf) -> pd.DataFrame:
+        """
+        子策略的选币数据（pandas）：只取需要的行和列，已经按 (candle_begin_time, symbol) 排好序
+        :param stg_conf: 策略配置
+        :return: 选币数据，index 从 0 开始
+        """
+        return self.strategy_lazy_view(stg_conf).collect().to_pandas()
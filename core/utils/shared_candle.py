@@ -0,0 +1,167 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import inspect
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+"""
+# 共享内存K线数据
+多进程计算因子的时候，如果把每个币种的 DataFrame 序列化传给子进程，序列化的开销比计算还大。
+这里把所有币种的K线按列拼接之后放到 multiprocessing.shared_memory 中，只需要放一次，
+子进程通过 spec（共享内存名称、类型、每个币种的起止位置）挂载，不需要反序列化。
+
+- 数值、时间类型的列：直接放入共享内存
+- 字符串类型的列（symbol_spot、symbol_swap 等）：转换成 int32 编码放入共享内存，编码表随 spec 一起传给子进程
+- get_candle_df 返回的是单个币种的拷贝，因子、after_merge_index 可以原地修改，和多线程模式的行为一致
+- 只有主进程（owner）负责登记和释放共享内存，子进程挂载时不向 resource_tracker 登记，
+  否则子进程退出时会提示 leaked shared_memory，甚至提前释放主进程还在使用的共享内存
+"""
+
+# python 3.13 开始 SharedMemory 支持 track 参数
+_SHM_SUPPORTS_TRACK = 'track' in inspect.signature(shared_memory.SharedMemory).parameters
+
+
+@contextmanager
+def _untracked_shared_memory():
+    """
+    挂载已有的共享内存时，不向 resource_tracker 登记。
+    resource_tracker 是主进程和子进程共用的，挂载之后再 unregister 会把主进程的登记也删掉，所以这里直接跳过登记
+    """
+    register = resource_tracker.register
+
+    def _register(name, rtype):
+        if rtype != 'shared_memory':
+            register(name, rtype)
+
+    resource_tracker.register = _register
+    try:
+        yield
+    finally:
+        resource_tracker.register = register
+
+
+def attach_shared_memory(name) -> shared_memory.SharedMemory:
+    """
+    挂载主进程创建的共享内存，不登记到 resource_tracker，只有主进程负责 unlink
+    """
+    if _SHM_SUPPORTS_TRACK:
+        return shared_memory.SharedMemory(name=name, track=False)
+    with _untracked_shared_memory():
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedCandleStore:
+
+    def __init__(self, spec: dict, shm_dict: Dict[str, shared_memory.SharedMemory], owner: bool):
+        self.spec = spec
+        self.offsets = spec['offsets']
+        self.symbols = spec['symbols']
+        self._shm_dict = shm_dict
+        self._owner = owner
+        self._col_dict = {}
+        self._category_dict = {}
+        for col, (shm_name, dtype, categories) in spec['columns'].items():
+            arr = np.ndarray((spec['rows'],), dtype=np.dtype(dtype), buffer=shm_dict[col].buf)
+            arr.flags.writeable = False  # 共享的数据只读，避免子进程之间互相影响
+            self._col_dict[col] = arr
+            if categories is not None:
+                self._category_dict[col] = np.asarray(categories, dtype=object)
+
+    @classmethod
+    def create(cls, candle_df_list: List[pd.DataFrame]) -> "SharedCandleStore":
+        """
+        把所有币种的K线数据放到共享内存
+        :param candle_df_list: 每个币种的K线数据
+        :return: 共享内存K线数据，使用完之后需要调用 unlink 释放
+        """
+        lengths = [len(candle_df) for candle_df in candle_df_list]
+        offsets = np.zeros(len(candle_df_list) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        rows = int(offsets[-1])
+
+        spec = dict(rows=rows, offsets=offsets, columns={}, column_order=list(candle_df_list[0].columns),
+                    symbols=[candle_df['symbol'].iloc[0] for candle_df in candle_df_list])
+        shm_dict = {}
+        try:
+            for col in candle_df_list[0].columns:
+                if col == 'symbol':
+                    continue  # 每个币种只有一个，随 spec 传递
+
+                sample = candle_df_list[0][col]
+                categories = None
+                if pd.api.types.is_numeric_dtype(sample) or pd.api.types.is_datetime64_dtype(sample):
+                    values = np.concatenate([candle_df[col].to_numpy() for candle_df in candle_df_list])
+                else:
+                    codes, uniques = pd.factorize(pd.concat([candle_df[col] for candle_df in candle_df_list]))
+                    values = codes.astype(np.int32)
+                    # 缺失值的编码是 -1，正好对应编码表最后一个 NaN
+                    categories = list(uniques) + [np.nan]
+
+                shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+                shm_dict[col] = shm
+                np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+                spec['columns'][col] = (shm.name, values.dtype.str, categories)
+        except BaseException:
+            for shm in shm_dict.values():
+                shm.close()
+                shm.unlink()
+            raise
+
+        return cls(spec, shm_dict, owner=True)
+
+    @classmethod
+    def attach(cls, spec: dict) -> "SharedCandleStore":
+        """
+        子进程中挂载共享内存
+        :param spec: 主进程 create 之后得到的 spec
+        :return: 共享内存K线数据
+        """
+        shm_dict = {col: attach_shared_memory(shm_name) for col, (shm_name, _, _) in spec['columns'].items()}
+        return cls(spec, shm_dict, owner=False)
+
+    def get_candle_df(self, idx) -> pd.DataFrame:
+        """
+        获取一个币种的K线数据，从共享内存中拷贝一份，返回的 DataFrame 可以原地修改
+        :param idx: 币种的序号，和 create 时候的 candle_df_list 一致
+        :return: 单个币种的K线数据
+        """
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        data = {}
+        for col in self.spec['column_order']:
+            if col == 'symbol':
+                data[col] = np.full(end - start, self.symbols[idx], dtype=object)
+                continue
+            values = self._col_dict[col][start:end]
+            if col in self._category_dict:
+                values = self._category_dict[col][values]
+            else:
+                values = values.copy()  # 共享内存只读，拷贝之后因子可以原地修改
+            data[col] = values
+        return pd.DataFrame(data, copy=False)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def close(self):
+        self._col_dict.clear()
+        for shm in self._shm_dict.values():
+            shm.close()
+
+    def unlink(self):
+        self.close()
+        if self._owner:
+            for shm in self._shm_dict.values():
+                shm.unlink()
@@ -0,0 +1,322 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import pickle
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+"""
+# 稀疏的目标资金占比
+df_spot_ratio / df_swap_ratio 是 (小时 × 全部币种) 的稠密矩阵，但是每个小时只持有几个到几十个币，
+99% 以上都是 0。几年的小时数据 × 几百个币种，每个子策略都要保存、读取、相加一遍，非常浪费。
+
+这里使用 CSR 格式（按行压缩）保存：
+- times:   行索引，candle_begin_time
+- symbols: 列索引，币种，已排序
+- indptr:  第 i 行的非零元素在 indices/data 中的位置为 indptr[i]:indptr[i + 1]
+- indices: 非零元素所在的列（symbols 中的序号），同一行内升序
+- data:    非零元素的值
+
+模拟交易的时候只需要把当前行的非零元素写入目标仓位，不需要稠密矩阵。
+
+# 坐标系
+多配置回测的时候，所有配置的时间范围相同，币种也来自同一份数据。RatioCoords 在一次回测中只构建一次：
+- 时间是等间隔的小时，行号直接用 (时间 - 起始时间) / 1小时 计算，不需要按时间查找
+- 币种编号表只建一次，每个配置的长表用整数 join 得到列号，不需要对字符串排序、去重
+每个配置的 (时间, 币种, 资金占比) 直接转换成整数坐标，再累加成 CSR。
+"""
+
+
+class SparseRatio:
+
+    def __init__(self, times, symbols, indptr, indices, data):
+        self.times = pd.DatetimeIndex(times, name='candle_begin_time')
+        self.symbols = list(symbols)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data = np.asarray(data, dtype=np.float64)
+
+    # ==================================================================================================
+    # 构造
+    # ==================================================================================================
+    @classmethod
+    def from_coo(cls, times, symbols, rows, cols, values) -> "SparseRatio":
+        """
+        从 (行, 列, 值) 三元组构造，相同位置的值累加，累加之后为 0 的位置剔除
+        :param times: 行索引
+        :param symbols: 列索引
+        :param rows: 行号
+        :param cols: 列号
+        :param values: 值
+        :return: SparseRatio
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        n_rows, n_cols = len(times), len(symbols)
+
+        if len(rows):
+            # 按照 (行, 列) 排序后合并重复位置
+            keys = rows * max(n_cols, 1) + cols
+            order = np.argsort(keys, kind='stable')
+            keys, values = keys[order], values[order]
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            keys = keys[starts]
+            values = np.add.reduceat(values, starts)
+            keep = values != 0
+            keys, values = keys[keep], values[keep]
+            rows, cols = keys // max(n_cols, 1), keys % max(n_cols, 1)
+
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=n_rows))
+        return cls(times, symbols, indptr, cols, values)
+
+    @classmethod
+    def from_long(cls, df: pd.DataFrame, times, time_col='candle_begin_time', symbol_col='symbol',
+                  value_col='target_alloc_ratio') -> "SparseRatio":
+        """
+        从长表（每行一个 时间-币种-资金占比）构造，不在 times 中的数据丢弃
+        :param df: 长表，pandas 或者 polars DataFrame
+        :param times: 行索引
+        :param time_col: 时间列
+        :param symbol_col: 币种列
+        :param value_col: 值列
+        :return: SparseRatio
+        """
+        times = pd.DatetimeIndex(times)
+        if len(df) == 0:
+            return cls.empty(times)
+
+        df_times = pd.DatetimeIndex(np.asarray(df[time_col]).astype('datetime64[ns]'))
+        symbol_values = np.asarray(df[symbol_col]).astype(str)
+        values = np.nan_to_num(np.asarray(df[value_col], dtype=np.float64), nan=0.)
+
+        rows = times.get_indexer(df_times)
+        valid = rows >= 0
+        symbols, cols = np.unique(symbol_values[valid], return_inverse=True)
+        return cls.from_coo(times, symbols.tolist(), rows[valid], cols, values[valid])
+
+    @classmethod
+    def from_dense(cls, df: pd.DataFrame) -> "SparseRatio":
+        """
+        从稠密的 (时间 × 币种) DataFrame 构造
+        """
+        if isinstance(df, SparseRatio):
+            return df
+        symbols = sorted(str(col) for col in df.columns)
+        mat = df.reindex(columns=symbols).to_numpy(dtype=np.float64) if symbols else np.zeros((len(df), 0))
+        mat = np.nan_to_num(mat, nan=0.)
+        rows, cols = np.nonzero(mat)
+        return cls.from_coo(df.index, symbols, rows, cols, mat[rows, cols])
+
+    @classmethod
+    def empty(cls, times) -> "SparseRatio":
+        return cls(times, [], np.zeros(len(times) + 1, dtype=np.int64), [], [])
+
+    # ==================================================================================================
+    # 属性
+    # ==================================================================================================
+    @property
+    def index(self) -> pd.DatetimeIndex:
+        return self.times
+
+    @property
+    def columns(self) -> pd.Index:
+        return pd.Index(self.symbols)
+
+    @property
+    def shape(self):
+        return len(self.times), len(self.symbols)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return f'<SparseRatio {len(self.times)} x {len(self.symbols)}, nnz={self.nnz}>'
+
+    def row_ids(self) -> np.ndarray:
+        """
+        每个非零元素所在的行号
+        """
+        return np.repeat(np.arange(len(self.times), dtype=np.int64), np.diff(self.indptr))
+
+    # ==================================================================================================
+    # 运算
+    # ==================================================================================================
+    def to_dense(self, symbols=None) -> pd.DataFrame:
+        """
+        转换成稠密的 (时间 × 币种) DataFrame
+        :param symbols: 列，默认为全部币种
+        """
+        mat = np.zeros(self.shape, dtype=np.float64)
+        mat[self.row_ids(), self.indices] = self.data
+        df = pd.DataFrame(mat, index=self.times, columns=pd.Index(self.symbols))
+        if symbols is not None:
+            df = df.reindex(columns=symbols, fill_value=0.)
+        return df
+
+    def reindex_columns(self, symbols) -> "SparseRatio":
+        """
+        按照新的币种列表重新编号，新列表中没有的币种丢弃
+        """
+        symbols = list(symbols)
+        if symbols == self.symbols:
+            return self
+        mapping = pd.Index(symbols).get_indexer(self.symbols)
+        cols = mapping[self.indices] if len(self.indices) else np.zeros(0, dtype=np.int64)
+        keep = cols >= 0
+        return SparseRatio.from_coo(self.times, symbols, self.row_ids()[keep], cols[keep], self.data[keep])
+
+    def select_rows(self, times) -> "SparseRatio":
+        """
+        按时间取行，和 DataFrame.loc[times] 一致，时间不存在时抛出 KeyError
+        """
+        times = pd.DatetimeIndex(times)
+        rows = self.times.get_indexer(times)
+        if (rows < 0).any():
+            raise KeyError(f'{times[rows < 0][:5].tolist()} not in index')
+
+        starts, ends = self.indptr[rows], self.indptr[rows + 1]
+        lengths = ends - starts
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(lengths)
+        # 每个元素在原数组中的位置
+        pos = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1], dtype=np.int64)
+        return SparseRatio(times, self.symbols, indptr, self.indices[pos], self.data[pos])
+
+    def mul_rows(self, weights) -> "SparseRatio":
+        """
+        每一行乘以对应的权重，和 DataFrame.mul(weights, axis=0) 一致
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        return SparseRatio.from_coo(self.times, self.symbols, self.row_ids(), self.indices,
+                                    self.data * np.repeat(weights, np.diff(self.indptr)))
+
+    def __mul__(self, other) -> "SparseRatio":
+        return SparseRatio(self.times, self.symbols, self.indptr, self.indices, self.data * float(other))
+
+    __rmul__ = __mul__
+
+    @classmethod
+    def sum(cls, ratio_list) -> "SparseRatio":
+        """
+        多个稀疏资金占比相加，行索引必须一致，列取并集
+        """
+        ratio_list = list(ratio_list)
+        times = ratio_list[0].times
+        for ratio in ratio_list[1:]:
+            if not ratio.times.equals(times):
+                raise ValueError('SparseRatio 相加时行索引必须一致')
+
+        symbols = sorted(set().union(*[ratio.symbols for ratio in ratio_list]))
+        symbol_index = pd.Index(symbols)
+        rows, cols, values = [], [], []
+        for ratio in ratio_list:
+            rows.append(ratio.row_ids())
+            cols.append(symbol_index.get_indexer(ratio.symbols)[ratio.indices] if ratio.nnz else ratio.indices)
+            values.append(ratio.data)
+        return cls.from_coo(times, symbols, np.concatenate(rows), np.concatenate(cols), np.concatenate(values))
+
+    def to_pickle(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def read_pickle(cls, path) -> "SparseRatio":
+        """
+        读取 df_spot_ratio.pkl / df_swap_ratio.pkl，兼容老版本保存的稠密 DataFrame
+        """
+        return cls.from_dense(pd.read_pickle(path))
+
+
+class RatioCoords:
+
+    def __init__(self, times, symbols):
+        """
+        :param times: 行索引
+        :param symbols: 币种，会去重并排序
+        """
+        self.times = pd.DatetimeIndex(times, name='candle_begin_time')
+        self.symbols = sorted(set(str(symbol) for symbol in symbols))
+        self._symbol_ids = pl.DataFrame({'symbol': self.symbols,
+                                         '__col': np.arange(len(self.symbols), dtype=np.int64)})
+        # 等间隔的小时，行号可以直接计算
+        self._hourly = len(self.times) > 0 and (
+                len(self.times) == 1 or bool((np.diff(self.times.asi8) == 3_600 * 10 ** 9).all()))
+
+    @classmethod
+    def from_range(cls, start_date, end_date, symbols) -> "RatioCoords":
+        """
+        回测区间 [start_date, end_date) 的小时坐标系
+        """
+        return cls(pd.date_range(start_date, end_date, freq='h', inclusive='left'), symbols)
+
+    def time_rows(self, df_times: pl.Series) -> np.ndarray:
+        """
+        时间对应的行号，不在行索引中的为 -1
+        """
+        if not self._hourly:
+            return self.times.get_indexer(pd.DatetimeIndex(df_times.to_numpy().astype('datetime64[ns]')))
+        # 统一到纳秒，(时间 - 起始时间) 能被 1 小时整除，并且在范围内的才有效
+        offsets = df_times.cast(pl.Datetime('ns')).to_physical().to_numpy() - self.times.asi8[0]
+        rows, remainder = np.divmod(offsets, 3_600 * 10 ** 9)
+        valid = (remainder == 0) & (rows >= 0) & (rows < len(self.times))
+        return np.where(valid, rows, -1)
+
+    def to_sparse(self, df, time_col='candle_begin_time', symbol_col='symbol',
+                  value_col='target_alloc_ratio') -> SparseRatio:
+        """
+        长表（时间-币种-资金占比）转换成 SparseRatio，和 SparseRatio.from_long 的结果一致：
+        不在行索引中的数据丢弃，列只保留有数据的币种
+        :param df: 长表，pandas 或者 polars DataFrame
+        """
+        if len(df) == 0:
+            return SparseRatio.empty(self.times)
+        if isinstance(df, pd.DataFrame):
+            df = pl.from_pandas(df[[time_col, symbol_col, value_col]])
+
+        df = df.select(pl.col(time_col).alias('candle_begin_time'), pl.col(symbol_col).cast(pl.String).alias('symbol'),
+                       pl.col(value_col).cast(pl.Float64).fill_nan(0.).fill_null(0.).alias('value'))
+        rows = self.time_rows(df['candle_begin_time'])
+        df = df.with_columns(pl.Series('__row', rows)).filter(pl.col('__row') >= 0)
+        df = df.join(self._symbol_ids, on='symbol', how='left', maintain_order='left')
+
+        symbols = self.symbols
+        if df['__col'].null_count():
+            # 坐标系之外的币种，临时追加到后面
+            extra = sorted(df.filter(pl.col('__col').is_null())['symbol'].unique().to_list())
+            symbols = self.symbols + extra
+            extra_ids = pl.DataFrame({'symbol': extra, '__extra': np.arange(len(self.symbols), len(symbols))})
+            df = df.join(extra_ids, on='symbol', how='left', maintain_order='left').with_columns(
+                pl.col('__col').fill_null(pl.col('__extra')))
+
+        rows, cols = df['__row'].to_numpy(), df['__col'].to_numpy().astype(np.int64)
+        # 只保留有数据的币种，列按币种名称排序
+        used = np.flatnonzero(np.bincount(cols, minlength=len(symbols)))
+        used_symbols = [symbols[i] for i in used]
+        order = np.argsort(used_symbols, kind='stable')
+        mapping = np.full(len(symbols), -1, dtype=np.int64)
+        mapping[used[order]] = np.arange(len(used), dtype=np.int64)
+        return SparseRatio.from_coo(self.times, [used_symbols[i] for i in order], rows, mapping[cols],
+                                    df['value'].to_numpy())
+
+
+def to_dense_ratio(ratio) -> pd.DataFrame:
+    """
+    兼容函数：SparseRatio 转换成稠密 DataFrame，DataFrame 原样返回
+    """
+    return ratio.to_dense() if isinstance(ratio, SparseRatio) else ratio
@@ -0,0 +1,107 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import os
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+"""
+# 现货 -> 合约 行索引
+优先下单合约（order_first == 'swap'）的现货选币结果，需要把 close、next_close 替换成对应合约的数据。
+原来每个配置都要重新读取 all_factors_kline.pkl，再和选币结果做一次 merge。
+
+这里在计算因子、保存 all_factors_kline 的时候，同时生成一份索引：
+- times:     时间索引
+- symbols:   合约币种索引
+- row_index: (时间 × 合约币种) -> 合约数据的行号，没有数据的为 -1
+- close / next_close: 合约数据
+
+替换的时候根据 (candle_begin_time, symbol_swap) 直接取行号，整数下标取数，不需要 merge。
+"""
+
+SWAP_INDEX_FILE = 'swap_index.npz'
+
+
+class SwapIndex:
+
+    def __init__(self, times, symbols, row_index, close, next_close):
+        self.times = pd.DatetimeIndex(times)
+        self.symbols = pd.Index(symbols)
+        self.row_index = np.asarray(row_index, dtype=np.int32)
+        self.close = np.asarray(close, dtype=np.float64)
+        self.next_close = np.asarray(next_close, dtype=np.float64)
+
+    @classmethod
+    def from_kline(cls, all_kline_df: pd.DataFrame) -> "SwapIndex":
+        """
+        根据 all_factors_kline 构建索引，合约数据的口径和原来的 transfer_swap 一致：is_spot == 0，并且有对应的现货
+        :param all_kline_df: 所有币种的K线数据
+        """
+        df_swap = all_kline_df[(all_kline_df['is_spot'] == 0) & (all_kline_df['symbol_spot'] != '')]
+        times = pd.DatetimeIndex(np.unique(df_swap['candle_begin_time'].to_numpy()))
+        symbols = pd.Index(np.unique(df_swap['symbol'].to_numpy().astype(str)))
+
+        row_index = np.full((len(times), len(symbols)), -1, dtype=np.int32)
+        row_index[times.get_indexer(df_swap['candle_begin_time']),
+                  symbols.get_indexer(df_swap['symbol'].astype(str))] = np.arange(len(df_swap), dtype=np.int32)
+        return cls(times, symbols, row_index, df_swap['close'].to_numpy(), df_swap['next_close'].to_numpy())
+
+    def lookup(self, times, symbol_swaps) -> np.ndarray:
+        """
+        根据 (时间, 合约币种) 获取合约数据的行号
+        :return: 行号，没有对应合约数据的为 -1
+        """
+        t_idx = self.times.get_indexer(pd.DatetimeIndex(times))
+        s_idx = self.symbols.get_indexer(pd.Index(symbol_swaps).astype(str))
+        rows = np.full(len(t_idx), -1, dtype=np.int64)
+        found = (t_idx >= 0) & (s_idx >= 0)
+        rows[found] = self.row_index[t_idx[found], s_idx[found]]
+        return rows
+
+    def save(self, path: Path):
+        """
+        先写到同一目录下的临时文件，再原子替换，其他线程、进程不会读到写了一半的文件
+        """
+        path = Path(path)
+        tmp_path = path.with_name(f'{path.name}.tmp-{os.getpid()}-{threading.get_ident()}')
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, times=self.times.values.astype('datetime64[ns]'),
+                         symbols=self.symbols.to_numpy().astype(str), row_index=self.row_index, close=self.close,
+                         next_close=self.next_close)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    @classmethod
+    def load(cls, path: Path) -> "SwapIndex":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['times'], data['symbols'], data['row_index'], data['close'], data['next_close'])
+
+
+@lru_cache(maxsize=1)
+def _load_swap_index(path: str, mtime_ns: int) -> SwapIndex:
+    return SwapIndex.load(Path(path))
+
+
+def load_swap_index(path: Path) -> SwapIndex | None:
+    """
+    加载索引，同一个进程中多个配置共用一份，文件更新之后重新加载
+    :param path: 索引文件路径
+    :return: 索引，文件不存在时返回 None
+    """
+    if not path.exists():
+        return None
+    return _load_swap_index(str(path), path.stat().st_mtime_ns)
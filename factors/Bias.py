@@ -9,6 +9,11 @@
 
 Author: 邢不行
 """
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from core.kernels import rolling_mean
 
 
 def signal(*args):
@@ -21,3 +26,27 @@ def signal(*args):
     df[factor_name] = df['bias']
 
     return df
+
+
+def signal_multi_params(df, param_list) -> dict:
+    # 使用 numba 多窗口滚动均值，一次遍历计算所有参数
+    param_list = list(param_list)
+    close = np.asarray(df['close'].values, dtype=np.float64)
+    ma_mat = rolling_mean(close, np.array(param_list, dtype=np.int64))
+    return {n: pd.Series(close / ma - 1, index=df.index) for n, ma in zip(param_list, ma_mat)}
+
+
+def signal_expr(n):
+    # polars 表达式写法，计算时会按币种分组，和 signal 的结果一致
+    return pl.col('close') / pl.col('close').rolling_mean(n, min_samples=1) - 1
+
+
+def signal_panel(panel, param_list):
+    # 面板计算：panel['close'] 是 (K线 × 币种) 的矩阵，一次计算所有币种
+    close = pd.DataFrame(panel['close'], copy=False)
+    return {n: (close / close.rolling(n, min_periods=1).mean() - 1).values for n in param_list}
+
+
+def get_lookback(n):
+    # 滚动窗口为 n，增量计算时只需要往前多取 n 根K线
+    return n
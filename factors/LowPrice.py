@@ -12,6 +12,9 @@ Author: 邢不行
 # ** 因子文件功能说明 **
 1. 因子库中的每个 Python 文件需实现 `signal` 函数，用于计算因子值。
 2. 除 `signal` 外，可根据需求添加辅助函数，不影响因子计算逻辑。
+3. 可选实现 `get_lookback` 函数，返回计算一根K线需要往前多少根K线，声明之后数据更新时只会增量计算新增的K线。
+4. 可选实现 `signal_panel` 函数，接收所有币种的K线矩阵（K线 × 币种），一次计算所有币种的因子值。
+5. 可选实现 `signal_expr` 函数，返回 polars 表达式，所有因子的表达式会合并成一个查询按币种分组计算，优先级最高。
 
 # ** signal 函数参数与返回值说明 **
 1. `signal` 函数的第一个参数为 `candle_df`，用于接收单个币种的 K 线数据。
@@ -30,6 +33,11 @@ Author: 邢不行
 - 如果策略配置中 `factor_list` 包含 ('QuoteVolumeMean', True, 7, 1)，则 `param` 为 7，`args[0]` 为 'QuoteVolumeMean_7'。
 - 如果策略配置中 `filter_list` 包含 ('QuoteVolumeMean', 7, 'pct:<0.8')，则 `param` 为 7，`args[0]` 为 'QuoteVolumeMean_7'。
 """
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from core.kernels import rolling_mean
 
 
 # 低价币因子
@@ -41,3 +49,27 @@ def signal(*args):
     df[factor_name] = df['close'].rolling(n, min_periods=1).mean()
 
     return df
+
+
+def signal_multi_params(df, param_list) -> dict:
+    # 使用 numba 多窗口滚动均值，一次遍历计算所有参数
+    param_list = list(param_list)
+    close = np.asarray(df['close'].values, dtype=np.float64)
+    ma_mat = rolling_mean(close, np.array(param_list, dtype=np.int64))
+    return {n: pd.Series(ma, index=df.index) for n, ma in zip(param_list, ma_mat)}
+
+
+def signal_expr(n):
+    # polars 表达式写法，计算时会按币种分组，和 signal 的结果一致
+    return pl.col('close').rolling_mean(n, min_samples=1)
+
+
+def signal_panel(panel, param_list):
+    # 面板计算：panel['close'] 是 (K线 × 币种) 的矩阵，一次计算所有币种
+    close = pd.DataFrame(panel['close'], copy=False)
+    return {n: close.rolling(n, min_periods=1).mean().values for n in param_list}
+
+
+def get_lookback(n):
+    # 滚动窗口为 n，增量计算时只需要往前多取 n 根K线
+    return n
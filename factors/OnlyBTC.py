@@ -20,3 +20,8 @@ def signal(*args):
     df[factor_name] = np.where(df['symbol'] == 'BTC-USDT', 1, np.nan)
 
     return df
+
+
+def get_lookback(n):
+    # 只和当前K线有关，不需要历史数据
+    return 0
@@ -12,6 +12,9 @@ Author: 邢不行
 # ** 因子文件功能说明 **
 1. 因子库中的每个 Python 文件需实现 `signal` 函数，用于计算因子值。
 2. 除 `signal` 外，可根据需求添加辅助函数，不影响因子计算逻辑。
+3. 可选实现 `get_lookback` 函数，返回计算一根K线需要往前多少根K线，声明之后数据更新时只会增量计算新增的K线。
+4. 可选实现 `signal_panel` 函数，接收所有币种的K线矩阵（K线 × 币种），一次计算所有币种的因子值。
+5. 可选实现 `signal_expr` 函数，返回 polars 表达式，所有因子的表达式会合并成一个查询按币种分组计算，优先级最高。
 
 # ** signal 函数参数与返回值说明 **
 1. `signal` 函数的第一个参数为 `candle_df`，用于接收单个币种的 K 线数据。
@@ -41,3 +44,8 @@ def signal(*args):
     df[factor_name] = np.where(df['symbol'] == n, 1, 0)
 
     return df
+
+
+def get_lookback(n):
+    # 只和当前K线有关，不需要历史数据
+    return 0
@@ -12,6 +12,9 @@ Author: 邢不行
 # ** 因子文件功能说明 **
 1. 因子库中的每个 Python 文件需实现 `signal` 函数，用于计算因子值。
 2. 除 `signal` 外，可根据需求添加辅助函数，不影响因子计算逻辑。
+3. 可选实现 `get_lookback` 函数，返回计算一根K线需要往前多少根K线，声明之后数据更新时只会增量计算新增的K线。
+4. 可选实现 `signal_panel` 函数，接收所有币种的K线矩阵（K线 × 币种），一次计算所有币种的因子值。
+5. 可选实现 `signal_expr` 函数，返回 polars 表达式，所有因子的表达式会合并成一个查询按币种分组计算，优先级最高。
 
 # ** signal 函数参数与返回值说明 **
 1. `signal` 函数的第一个参数为 `candle_df`，用于接收单个币种的 K 线数据。
@@ -30,6 +33,8 @@ Author: 邢不行
 - 如果策略配置中 `factor_list` 包含 ('QuoteVolumeMean', True, 7, 1)，则 `param` 为 7，`args[0]` 为 'QuoteVolumeMean_7'。
 - 如果策略配置中 `filter_list` 包含 ('QuoteVolumeMean', 7, 'pct:<0.8')，则 `param` 为 7，`args[0]` 为 'QuoteVolumeMean_7'。
 """
+import numpy as np
+import polars as pl
 
 
 def signal(*args):
@@ -40,3 +45,25 @@ def signal(*args):
     df[factor_name] = df['close'].pct_change(n)
 
     return df
+
+
+def signal_expr(n):
+    # polars 表达式写法，计算时会按币种分组，和 signal 的结果一致
+    return pl.col('close') / pl.col('close').shift(n) - 1
+
+
+def signal_panel(panel, param_list):
+    # 面板计算：panel['close'] 是 (K线 × 币种) 的矩阵，一次计算所有币种
+    close = panel['close']
+    result = {}
+    for n in param_list:
+        factor_mat = np.full(close.shape, np.nan)
+        # n 为 0 时 close[:-0] 是空数组，用 len(close) - n 截取，结果和 pct_change(0) 一样全部为 0
+        factor_mat[n:] = close[n:] / close[:len(close) - n] - 1
+        result[n] = factor_mat
+    return result
+
+
+def get_lookback(n):
+    # n 周期涨跌幅，增量计算时只需要往前多取 n 根K线
+    return n
@@ -16,8 +16,8 @@ from typing import List
 
 import pandas as pd
 
-from config import raw_data_path, backtest_name
-from core.backtest import step6_simulate_performance
+from config import backtest_name
+from core.backtest import run_pos_search
 from core.model.backtest_config import MultiEquityBacktestConfig
 from core.utils.log_kit import logger, divider
 from core.utils.path_kit import get_file_path
@@ -84,50 +84,15 @@ def find_best_params(strategies: List[dict]):
         me_conf_list.append(new_me_conf)
 
     # ====================================================================================================
-    # ** 5. 逐个进行仓位管理回测 **
+    # ** 5. 并行进行仓位管理回测 **
+    # 计算仓位比例 -> 聚合选币结果 -> 模拟交易，按照完成的顺序输出（参数遍历不处理 symbol_ratio_limit 仓位限制）
     # ====================================================================================================
-    divider('逐个回测', sep='-')
-    pivot_dict_spot = pd.read_pickle(raw_data_path / 'market_pivot_spot.pkl')
-    pivot_dict_swap = pd.read_pickle(raw_data_path / 'market_pivot_swap.pkl')
-
-    report_list = []
-    for i, me_conf_i in enumerate(me_conf_list):
-        # ====================================================================================================
-        # ** 5-1. 计算仓位比例 **
-        # 仓位管理策略接入，计算每一个时间周期中，子策略应该持仓的资金比例
-        # ====================================================================================================
-        seq = f'({i + 1} / {len(me_conf_list)})'
-        logger.debug(f'🗄️ {seq} {me_conf_i}')
-        s_time = time.time()
-        pos_ratio = me_conf_i.calc_ratios()
-
-        # ====================================================================================================
-        # ** 5-2. 聚合选币结果 **
-        # 根据子策略的资金比例，重新聚合成一个选币结果，及对应周期内币种的资金分配
-        # ====================================================================================================
-        df_spot_ratio, df_swap_ratio = me_conf_i.agg_pos_ratio(pos_ratio)
-        logger.ok(f'完成仓位管理模块的计算，已花费时间{time.time() - s_time:.3f}秒')
-
-        # ====================================================================================================
-        # ** 5-3. 模拟交易 **
-        # 根据生成好的选币结果+资金配比，重新模拟交易，得到回测报告
-        # ====================================================================================================
-        conf_all = me_conf_i.factory.generate_all_factor_config()
-        conf_all.name = me_conf_i.factory.backtest_name
-        # 用于参数遍历场景
-        conf_all.is_param_search = True
-
-        # 让我们荡起双桨🎵～
-        report = step6_simulate_performance(
-            conf_all,
-            df_spot_ratio, df_swap_ratio, pivot_dict_spot, pivot_dict_swap,
-            if_show_plot=False,  # 是否显示图表
-            description=str(me_conf),  # 图表描述替换为仓位管理策略
-        )
-
-        report_list.append(report)
-
-        logger.ok(f'{seq} {me_conf_i}')
+    divider('并行回测', sep='-')
+    s_time = time.time()
+    report_list = [None] * len(me_conf_list)
+    for done_num, (idx, report) in enumerate(run_pos_search(me_conf_list), 1):
+        report_list[idx] = report
+        logger.ok(f'({done_num} / {len(me_conf_list)}) {me_conf_list[idx]}，累计时间：{time.time() - s_time:.3f}秒')
 
     # ====================================================================================================
     # 6. 展示最优参数
@@ -0,0 +1,66 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import warnings
+
+import pandas as pd
+
+from config import raw_data_path
+from core.equity import compare_sim_precision
+from core.model.backtest_config import MultiEquityBacktestConfig
+from core.utils.log_kit import logger, divider
+from core.utils.path_kit import get_file_path
+from core.utils.pivot_store import load_pivot_data
+from core.utils.sparse_ratio import SparseRatio
+
+"""
+# 模拟精度验证
+config.py 中 sim_precision = 'float32' 时，价格和资金占比使用单精度传入模拟器。
+这个工具对每个子策略已经保存的目标资金占比（df_spot_ratio.pkl / df_swap_ratio.pkl），
+分别用 float64、float32 重新模拟一遍，输出资金曲线的偏差，用来判断单精度是否满足要求。
+
+使用前需要先跑一遍回测（backtest.py），生成子策略的目标资金占比。
+"""
+
+warnings.filterwarnings('ignore')
+pd.set_option('expand_frame_repr', False)
+pd.set_option('display.unicode.ambiguous_as_wide', True)
+pd.set_option('display.unicode.east_asian_width', True)
+
+if __name__ == '__main__':
+    me_conf = MultiEquityBacktestConfig()
+
+    # 基准使用 float64 的行情数据
+    pivot_dict_spot = load_pivot_data(raw_data_path, 'spot')
+    pivot_dict_swap = load_pivot_data(raw_data_path, 'swap')
+
+    result_list = []
+    for conf in me_conf.factory.config_list:
+        divider(conf.name, sep='-')
+        spot_path = conf.get_result_folder() / 'df_spot_ratio.pkl'
+        swap_path = conf.get_result_folder() / 'df_swap_ratio.pkl'
+        if not spot_path.exists() or not swap_path.exists():
+            logger.warning(f'{conf.name} 没有找到目标资金占比，请先运行回测')
+            continue
+
+        res = compare_sim_precision(conf, pivot_dict_spot, pivot_dict_swap,
+                                    SparseRatio.read_pickle(spot_path), SparseRatio.read_pickle(swap_path))
+        res.name = conf.name
+        logger.info(f'\n{res}')
+        result_list.append(res)
+
+    if result_list:
+        result_df = pd.DataFrame(result_list)
+        save_path = get_file_path('data', '模拟精度验证.csv', as_path_type=True)
+        result_df.to_csv(save_path, encoding='utf-8-sig')
+        divider('汇总', sep='-')
+        logger.info(f'\n{result_df}')
+        logger.ok(f'结果已保存：{save_path}')
@@ -0,0 +1,203 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import inspect
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+"""
+# 模拟器性能测试
+用随机生成的行情和目标资金占比（多年的小时数据 × 几百个币种）测试 start_simulation 的速度。
+填写 baseline_ref 之后，会把该 git 版本的 core 导出到临时目录，在子进程中用完全相同的数据再测一遍，
+对比速度并检查资金曲线是否逐位一致，例如：
+- baseline_ref = 'HEAD~1'：和上一个提交对比
+- baseline_ref = ''：只测试当前版本
+
+早期版本的 start_simulation 使用稠密的 (K线 × 币种) 目标资金占比，测试时会根据函数参数自动转换，
+其他参数不兼容的版本（参数名称不同）会在子进程中报错。
+"""
+
+# ====================================================================================================
+# ** 测试配置 **
+# ====================================================================================================
+n_years = 5  # 回测年数，每年 8760 根小时K线
+n_spot = 300  # 现货币种数量
+n_swap = 600  # 合约币种数量
+hold_num = 20  # 每个周期持有的币种数量（现货、合约各自）
+hold_period = 24  # 持仓周期（小时），每个周期换一批币
+rebalance_every_bar = True  # True：每个小时都重新计算目标仓位；False：只在换仓的时候计算
+precision = 'float64'  # 价格、资金占比的精度，float64 或者 float32
+n_repeat = 3  # 重复次数，取最快的一次
+baseline_ref = ''  # 对比的 git 版本，为空则不对比
+seed = 2024  # 随机种子
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+
+
+def make_inputs():
+    """
+    生成 start_simulation 需要的所有参数（不包括仓位计算），相同的配置每次生成的数据完全一致
+    """
+    rng = np.random.default_rng(seed)
+    n_bars = n_years * 8760
+    dtype = np.float32 if precision == 'float32' else np.float64
+
+    def market(n_syms):
+        base = np.cumprod(1 + rng.normal(0, 0.01, (n_bars, n_syms)), axis=0) * rng.uniform(0.01, 500, n_syms)
+        open_p = base * (1 + rng.normal(0, 0.001, (n_bars, n_syms)))
+        vwap1m_p = base * (1 + rng.normal(0, 0.001, (n_bars, n_syms)))
+        # 模拟上市时间不同的币种，上市前没有价格
+        listing = rng.integers(0, n_bars // 2, n_syms)
+        for j in np.flatnonzero(rng.random(n_syms) < 0.3):
+            open_p[:listing[j], j] = base[:listing[j], j] = vwap1m_p[:listing[j], j] = np.nan
+        return open_p.astype(dtype), base.astype(dtype), vwap1m_p.astype(dtype)
+
+    def ratio_csr(close_p, allow_short):
+        # 每个持仓周期从已上市的币种中选 hold_num 个，等权
+        rows, cols, values = [], [], []
+        for start in range(0, n_bars, hold_period):
+            listed = np.flatnonzero(~np.isnan(close_p[start]))
+            picks = np.sort(rng.choice(listed, hold_num, replace=False))
+            sign = np.where(rng.random(hold_num) < 0.5, -1., 1.) if allow_short else np.ones(hold_num)
+            for i in range(start, min(start + hold_period, n_bars)):
+                rows.append(np.full(hold_num, i))
+                cols.append(picks)
+                values.append(sign * 0.5 / hold_num)
+        rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+        indptr = np.zeros(n_bars + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=n_bars))
+        return indptr, cols.astype(np.int64), values.astype(dtype)
+
+    spot_open_p, spot_close_p, spot_vwap1m_p = market(n_spot)
+    swap_open_p, swap_close_p, swap_vwap1m_p = market(n_swap)
+    spot_indptr, spot_indices, spot_data = ratio_csr(spot_close_p, False)
+    swap_indptr, swap_indices, swap_data = ratio_csr(swap_close_p, True)
+
+    if rebalance_every_bar:
+        require_rebalance = np.ones(n_bars, dtype=np.int8)
+    else:
+        require_rebalance = (np.arange(n_bars) % hold_period == 0).astype(np.int8)
+
+    return dict(
+        init_capital=100000.,
+        leverages=np.ones(n_bars, dtype=np.float64),
+        spot_lot_sizes=np.full(n_spot, 0.001),
+        swap_lot_sizes=np.full(n_swap, 0.001),
+        spot_c_rate=0.001,
+        swap_c_rate=0.0005,
+        spot_min_order_limit=10.,
+        swap_min_order_limit=5.,
+        min_margin_rate=0.05,
+        spot_ratio_indptr=spot_indptr,
+        spot_ratio_indices=spot_indices,
+        spot_ratio_data=spot_data,
+        swap_ratio_indptr=swap_indptr,
+        swap_ratio_indices=swap_indices,
+        swap_ratio_data=swap_data,
+        spot_open_p=spot_open_p,
+        spot_close_p=spot_close_p,
+        spot_vwap1m_p=spot_vwap1m_p,
+        swap_open_p=swap_open_p,
+        swap_close_p=swap_close_p,
+        swap_vwap1m_p=swap_vwap1m_p,
+        funding_rates=rng.normal(0, 1e-4, (n_bars, n_swap)).astype(dtype),
+        require_rebalance=require_rebalance,
+    )
+
+
+def run_benchmark(result_file=None) -> dict:
+    """
+    测试当前 sys.path 中的 core 模块
+    :param result_file: 资金曲线的保存路径，用于和对比版本检查是否一致
+    :return: 测试结果
+    """
+    from core.equity import start_simulation
+    from core.rebalance import RebAlways
+
+    kwargs = make_inputs()
+    kwargs['pos_calc'] = RebAlways(kwargs['spot_lot_sizes'], kwargs['swap_lot_sizes'])
+    n_bars = len(kwargs['leverages'])
+
+    params = inspect.signature(getattr(start_simulation, 'py_func', start_simulation)).parameters
+    if 'spot_ratio' in params:
+        # 早期版本使用稠密的目标资金占比
+        for market, n_syms in [('spot', n_spot), ('swap', n_swap)]:
+            indptr = kwargs.pop(f'{market}_ratio_indptr')
+            indices = kwargs.pop(f'{market}_ratio_indices')
+            data = kwargs.pop(f'{market}_ratio_data')
+            ratio = np.zeros((n_bars, n_syms), dtype=data.dtype)
+            ratio[np.repeat(np.arange(n_bars), np.diff(indptr)), indices] = data
+            kwargs[f'{market}_ratio'] = ratio
+
+    # 第一次调用包含 numba 编译时间，不计入
+    s_time = time.perf_counter()
+    start_simulation(**kwargs)
+    compile_time = time.perf_counter() - s_time
+
+    best = np.inf
+    res = None
+    for _ in range(n_repeat):
+        s_time = time.perf_counter()
+        res = start_simulation(**kwargs)
+        best = min(best, time.perf_counter() - s_time)
+
+    if result_file:
+        np.save(result_file, np.vstack(res))
+    return dict(seconds=best, compile_seconds=compile_time, n_bars=n_bars, us_per_bar=best / n_bars * 1e6,
+                final_equity=float(res[0][-1]))
+
+
+def run_baseline(ref) -> (dict, np.ndarray):
+    """
+    导出 git 版本 ref 的 core 到临时目录，在子进程中测试，start_simulation 的参数需要和 run_benchmark 兼容
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        archive = subprocess.run(['git', 'archive', ref, 'core', 'update_min_qty.py'], cwd=PROJECT_ROOT,
+                                 capture_output=True, check=True).stdout
+        subprocess.run(['tar', '-x', '-C', tmp_dir], input=archive, check=True)
+        result_file = Path(tmp_dir) / 'baseline.npy'
+        output = subprocess.run([sys.executable, __file__, '--worker', tmp_dir, str(result_file)],
+                                cwd=PROJECT_ROOT, capture_output=True, text=True, check=True).stdout
+        return json.loads(output.strip().splitlines()[-1]), np.load(result_file)
+
+
+def print_result(title, res):
+    print(f'{title}: {res["seconds"]:.3f}秒（编译 {res["compile_seconds"]:.1f}秒），'
+          f'{res["us_per_bar"]:.1f}微秒/K线，最终权益 {res["final_equity"]:,.4f}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--worker':
+        # 子进程：优先导入对比版本的 core
+        sys.path.insert(0, str(PROJECT_ROOT))
+        sys.path.insert(0, sys.argv[2])
+        print(json.dumps(run_benchmark(sys.argv[3])))
+        sys.exit(0)
+
+    sys.path.insert(0, str(PROJECT_ROOT))
+    print(f'{n_years}年小时数据，现货{n_spot}个、合约{n_swap}个币种，每个周期持有{hold_num}个，精度{precision}')
+    with tempfile.TemporaryDirectory() as _tmp:
+        current_file = Path(_tmp) / 'current.npy'
+        current = run_benchmark(current_file)
+        print_result('当前版本', current)
+
+        if baseline_ref:
+            baseline, baseline_res = run_baseline(baseline_ref)
+            print_result(f'对比版本（{baseline_ref}）', baseline)
+            print(f'加速比: {baseline["seconds"] / current["seconds"]:.2f}x')
+            same = np.array_equal(np.load(current_file), baseline_res, equal_nan=True)
+            print(f'模拟结果逐位一致: {same}')
@@ -0,0 +1,74 @@
+"""
+邢不行｜策略分享会
+仓位管理框架
+
+版权所有 ©️ 邢不行
+微信: xbx1717
+
+本代码仅供个人学习使用，未经授权不得复制、修改或用于商业用途。
+
+Author: 邢不行
+"""
+import warnings
+
+import pandas as pd
+
+from config import raw_data_path
+from core.equity import calc_sensitivity, get_sim_dtype
+from core.model.backtest_config import MultiEquityBacktestConfig
+from core.utils.log_kit import logger, divider
+from core.utils.path_kit import get_file_path
+from core.utils.pivot_store import load_pivot_data
+from core.utils.sparse_ratio import SparseRatio
+
+"""
+# 交易参数敏感性分析
+对每个子策略已经保存的目标资金占比（df_spot_ratio.pkl / df_swap_ratio.pkl），
+用 param_grid 中所有的参数组合重新模拟，所有组合在一次并行调用中完成，
+输出每组参数的累积净值、年化收益、最大回撤、手续费等，用来判断策略对交易成本、杠杆的敏感程度。
+
+使用前需要先跑一遍回测（backtest.py），生成子策略的目标资金占比。
+"""
+
+# ====================================================================================================
+# ** 参数网格 **
+# 取所有组合，没有填写的参数使用 config.py 中的配置
+# 支持：spot_c_rate, swap_c_rate, leverage, margin_rate, spot_min_order_limit, swap_min_order_limit
+# ====================================================================================================
+param_grid = {
+    'swap_c_rate': [2e-4, 4e-4, 6e-4, 8e-4, 1e-3],  # 合约手续费
+    'spot_c_rate': [1e-3, 2e-3],  # 现货手续费
+    'leverage': [1, 1.5, 2],  # 杠杆
+}
+
+warnings.filterwarnings('ignore')
+pd.set_option('expand_frame_repr', False)
+pd.set_option('display.unicode.ambiguous_as_wide', True)
+pd.set_option('display.unicode.east_asian_width', True)
+
+if __name__ == '__main__':
+    me_conf = MultiEquityBacktestConfig()
+
+    pivot_dict_spot = load_pivot_data(raw_data_path, 'spot', get_sim_dtype())
+    pivot_dict_swap = load_pivot_data(raw_data_path, 'swap', get_sim_dtype())
+
+    result_list = []
+    for conf in me_conf.factory.config_list:
+        divider(conf.name, sep='-')
+        spot_path = conf.get_result_folder() / 'df_spot_ratio.pkl'
+        swap_path = conf.get_result_folder() / 'df_swap_ratio.pkl'
+        if not spot_path.exists() or not swap_path.exists():
+            logger.warning(f'{conf.name} 没有找到目标资金占比，请先运行回测')
+            continue
+
+        res = calc_sensitivity(conf, pivot_dict_spot, pivot_dict_swap,
+                               SparseRatio.read_pickle(spot_path), SparseRatio.read_pickle(swap_path), param_grid)
+        res.insert(0, '策略', conf.name)
+        logger.info(f'\n{res}')
+        result_list.append(res)
+
+    if result_list:
+        result_df = pd.concat(result_list, ignore_index=True)
+        save_path = get_file_path('data', '交易参数敏感性.csv', as_path_type=True)
+        result_df.to_csv(save_path, encoding='utf-8-sig', index=False)
+        logger.ok(f'结果已保存：{save_path}')